@@ -0,0 +1,401 @@
+"""
+Benchmarks for the ERA5 ETL, run against local stores.
+
+## encoding
+
+Write a few days of synthetic, ERA5-shaped data with each encoding profile
+from `etl.ENCODING_PROFILES` and report the write throughput, stored bytes, and
+read latency for the common access patterns: a full map at one hour, and a
+regional time series.
+
+    python -m azure.benchmark encoding --days 3 --profile default --profile zstd
+
+## pipeline
+
+Write a few days of synthetic, CDS-shaped NetCDF files (short variable names,
+int16-packed, with ``expver`` on some days) and run them through the daily job's
+path: open, load (reading and decoding the files), `etl.transform`,
+``xr.combine_by_coords``, `etl.write_period` (a fresh write, then appends), and
+`etl.compact_incremental`. This reports the time in each phase, throughput, peak
+RSS, and the number of objects in the store, for local file and in-memory stores.
+Each store is benchmarked in its own process, after the files are generated.
+
+Results can be saved with ``--save-baseline`` and compared against later with
+``--baseline``, which exits non-zero if any timing, the peak RSS, or the object
+count regressed by more than ``--tolerance``.
+
+    python -m azure.benchmark pipeline --kind forecast --days 3 --save-baseline base.json
+    python -m azure.benchmark pipeline --kind forecast --days 3 --baseline base.json
+"""
+
+from __future__ import annotations
+
+import argparse
+import concurrent.futures
+import json
+import multiprocessing
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import uuid
+from typing import Any
+
+import fsspec
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from azure import etl
+
+SHAPE = (24, 721, 1440)
+
+
+def synthetic_day(
+    period: pd.Period, variables: list[str], shape: tuple[int, int, int] = SHAPE
+) -> xr.Dataset:
+    """
+    A day of data shaped like the ETL's output for `variables`.
+
+    The fields are smooth in space and time plus noise, and are quantized like the
+    CDS's int16 packing, so they compress roughly like the real data.
+    """
+    ntime, nlat, nlon = shape
+    time = etl.hourly_index(pd.PeriodIndex([period], freq=etl.FREQ))
+    lat = np.linspace(90, -90, nlat, dtype="float32")
+    lon = np.linspace(0, 360, nlon, endpoint=False, dtype="float32")
+    rng = np.random.default_rng(abs(period.ordinal))
+
+    base = np.cos(np.deg2rad(lat))[:, None] * np.sin(np.deg2rad(lon))[None, :]
+    hours = np.arange(ntime)[:, None, None]
+    data_vars = {}
+    for i, name in enumerate(variables):
+        field = 10 * base[None] * np.cos(2 * np.pi * (hours + i) / 24)
+        field = field + rng.normal(0, 0.5, shape)
+        scale = (field.max() - field.min()) / 2**16
+        field = (np.round(field / scale) * scale).astype("float32")
+        data_vars[name] = xr.DataArray(
+            field, dims=("time", "lat", "lon"), attrs=etl.ATTRS[name]
+        )
+
+    return xr.Dataset(
+        data_vars,
+        coords={"time": time, "lat": ("lat", lat), "lon": ("lon", lon)},
+        attrs=etl.DS_ATTRS,
+    )
+
+
+def directory_size(path: str) -> tuple[int, int]:
+    """
+    The total bytes and number of files under `path`.
+    """
+    nbytes = nfiles = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            nbytes += os.path.getsize(os.path.join(root, name))
+            nfiles += 1
+    return nbytes, nfiles
+
+
+def timeit(func, repeat: int = 3) -> float:
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - t0)
+    return statistics.median(times)
+
+
+def bench_encoding(
+    profile: str,
+    days: list[xr.Dataset],
+    periods: pd.PeriodIndex,
+    directory: str,
+) -> dict[str, Any]:
+    path = os.path.join(directory, f"{profile}.zarr")
+    write_options = etl.WriteOptions(
+        mode="region", region=periods, preallocate=True, encoding_profile=profile
+    )
+
+    t0 = time.perf_counter()
+    for period, ds in zip(periods, days):
+        etl.write_period(ds, period, "file", path, {}, write_options=write_options)
+    write_seconds = time.perf_counter() - t0
+
+    nbytes, nfiles = directory_size(path)
+    raw = sum(ds.nbytes for ds in days)
+
+    result = xr.open_dataset(path, engine="zarr", chunks={})
+    name = list(days[0].data_vars)[0]
+    var = result[name]
+    snapshot = timeit(lambda: var.isel(time=len(var.time) // 2).values)
+    timeseries = timeit(lambda: var.sel(lat=slice(50, 40), lon=slice(0, 10)).values)
+    return {
+        "profile": profile,
+        "write_seconds": write_seconds,
+        "write_MBps": raw / write_seconds / 1e6,
+        "stored_bytes": nbytes,
+        "objects": nfiles,
+        "compression_ratio": raw / nbytes,
+        "snapshot_seconds": snapshot,
+        "timeseries_seconds": timeseries,
+    }
+
+
+def encoding(args) -> list[dict[str, Any]]:
+    periods = pd.period_range(etl.FIRST_PERIOD, periods=args.days, freq=etl.FREQ)
+    variables = args.variable or ["air_temperature_at_2_metres"]
+    shape = (24, args.nlat, args.nlon)
+    days = [synthetic_day(period, variables, shape) for period in periods]
+
+    results = []
+    directory = tempfile.mkdtemp(dir=args.directory)
+    try:
+        for profile in args.profile or list(etl.ENCODING_PROFILES):
+            results.append(bench_encoding(profile, days, periods, directory))
+            print(json.dumps(results[-1]))
+    finally:
+        shutil.rmtree(directory)
+    return results
+
+
+def synthetic_cds_file(
+    short_name: str,
+    period: pd.Period,
+    path: str,
+    shape: tuple[int, int, int] = SHAPE,
+    expver: bool = False,
+) -> str:
+    """
+    Write a day of data for `short_name` shaped like a CDS NetCDF download.
+
+    Like the CDS, the data are packed to int16 with a scale factor and offset.
+    With `expver`, an ``expver`` variable is included, as the CDS sometimes does.
+    """
+    ntime, nlat, nlon = shape
+    ds = synthetic_day(period, ["air_temperature_at_2_metres"], shape)
+    field = ds["air_temperature_at_2_metres"].data + 280
+    lo, hi = float(field.min()), float(field.max())
+    scale = (hi - lo) / (2**16 - 2)
+    cds_ds = xr.Dataset(
+        {short_name: (("time", "latitude", "longitude"), field, {"units": "K"})},
+        coords={
+            "time": ds.time.data,
+            "latitude": ds.lat.data,
+            "longitude": ds.lon.data,
+        },
+        attrs={"Conventions": "CF-1.6", "history": "synthetic"},
+    )
+    if expver:
+        cds_ds["expver"] = ("time", np.ones(ntime, dtype="int32"))
+
+    encoding = {
+        short_name: {
+            "dtype": "int16",
+            "scale_factor": scale,
+            "add_offset": (hi + lo) / 2,
+            "_FillValue": -32767,
+        }
+    }
+    cds_ds.to_netcdf(path, encoding=encoding)
+    return path
+
+
+def bench_pipeline(
+    store_type: str,
+    files: dict[pd.Period, list[str]],
+    directory: str,
+) -> dict[str, Any]:
+    """
+    Run `files` through the ETL into a new `store_type` store.
+
+    The peak RSS is the high-water mark of the whole process, so this should
+    run in a fresh process; see `pipeline`.
+    """
+    if store_type == "file":
+        protocol, path = "file", os.path.join(directory, "pipeline.zarr")
+    else:
+        protocol, path = "memory", f"/benchmark-{uuid.uuid4().hex}.zarr"
+    store = fsspec.filesystem(protocol).get_mapper(path)
+
+    timings = dict.fromkeys(
+        ["open", "load", "transform", "combine", "write_append"], 0.0
+    )
+    raw = 0
+    for i, (period, filenames) in enumerate(files.items()):
+        t0 = time.perf_counter()
+        datasets = [
+            xr.open_dataset(f, chunks={"time": 24}, use_cftime=False) for f in filenames
+        ]
+        t1 = time.perf_counter()
+        # read and decode the NetCDF files, which the ETL does lazily in `write`.
+        for x in datasets:
+            x.load()
+        t2 = time.perf_counter()
+        transformed = [etl.transform(x) for x in datasets]
+        t3 = time.perf_counter()
+        ds = xr.combine_by_coords(transformed, join="exact")
+        assert isinstance(ds, xr.Dataset)
+        t4 = time.perf_counter()
+        etl.write_period(ds, period, protocol, path, {})
+        t5 = time.perf_counter()
+
+        timings["open"] += t1 - t0
+        timings["load"] += t2 - t1
+        timings["transform"] += t3 - t2
+        timings["combine"] += t4 - t3
+        if i == 0:
+            timings["write_fresh"] = t5 - t4
+        else:
+            timings["write_append"] += t5 - t4
+        raw += ds.nbytes
+        for x in datasets:
+            x.close()
+
+    objects_before_compact = len(store)
+    t0 = time.perf_counter()
+    etl.compact_incremental(store)
+    timings["compact"] = time.perf_counter() - t0
+
+    total = sum(timings.values())
+    result = {
+        "store": store_type,
+        "days": len(files),
+        "variables": len(next(iter(files.values()))),
+        **{f"{k}_seconds": v for k, v in timings.items()},
+        "total_seconds": total,
+        "MBps": raw / total / 1e6,
+        "peak_rss_bytes": etl.peak_rss(),
+        "objects_before_compact": objects_before_compact,
+        "objects": len(store),
+    }
+    if protocol == "memory":
+        fsspec.filesystem("memory").rm(path, recursive=True)
+    return result
+
+
+# Metrics where larger values are regressions.
+COMPARED = ("_seconds", "peak_rss_bytes", "objects")
+
+
+def compare(
+    results: list[dict[str, Any]], baseline: list[dict[str, Any]], tolerance: float
+) -> list[str]:
+    """
+    The metrics in `results` that regressed by more than `tolerance` (a fraction)
+    relative to the `baseline` result for the same store, days, and variables.
+    """
+
+    def identity(x):
+        return x["store"], x["days"], x["variables"]
+
+    by_key = {identity(x): x for x in baseline}
+    regressions = []
+    for result in results:
+        base = by_key.get(identity(result))
+        if base is None:
+            continue
+        for key, value in result.items():
+            if not key.endswith(COMPARED) or not base.get(key):
+                continue
+            change = value / base[key] - 1
+            if change > tolerance:
+                regressions.append(
+                    f"{result['store']} {key}: {base[key]:.4g} -> {value:.4g} "
+                    f"(+{change:.0%})"
+                )
+    return regressions
+
+
+def pipeline(args) -> list[dict[str, Any]]:
+    periods = pd.period_range(etl.FIRST_PERIOD, periods=args.days, freq=etl.FREQ)
+    short_names = {v: k for k, v in etl.NAMES.items()}
+    variables = [
+        short_names[etl.filenames_to_keys[v]] for v in etl.KINDS_TO_VARIABLES[args.kind]
+    ]
+    shape = (24, args.nlat, args.nlon)
+
+    results = []
+    directory = tempfile.mkdtemp(dir=args.directory)
+    try:
+        files = {
+            period: [
+                synthetic_cds_file(
+                    name,
+                    period,
+                    os.path.join(directory, f"{period}-{name}.nc"),
+                    shape,
+                    expver=i % 2 == 1,
+                )
+                for name in variables
+            ]
+            for i, period in enumerate(periods)
+        }
+        for store_type in args.store or ["file", "memory"]:
+            # a fresh process per store, so the peak RSS is that store's alone.
+            with concurrent.futures.ProcessPoolExecutor(
+                1, mp_context=multiprocessing.get_context("spawn")
+            ) as pool:
+                future = pool.submit(bench_pipeline, store_type, files, directory)
+                results.append(future.result())
+            print(json.dumps(results[-1]))
+    finally:
+        shutil.rmtree(directory)
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+    return results
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    p = subparsers.add_parser("encoding", help="Compare encoding profiles.")
+    p.add_argument("--days", type=int, default=3)
+    p.add_argument("--profile", action="append", choices=list(etl.ENCODING_PROFILES))
+    p.add_argument("--variable", action="append", choices=list(etl.ATTRS))
+    p.add_argument("--nlat", type=int, default=SHAPE[1])
+    p.add_argument("--nlon", type=int, default=SHAPE[2])
+    p.add_argument("--directory", default=None, help="Where to write the stores.")
+    p.set_defaults(func=encoding)
+
+    p = subparsers.add_parser(
+        "pipeline", help="Time the transform, combine, write, and compact steps."
+    )
+    p.add_argument("--kind", choices=list(etl.KINDS_TO_VARIABLES), default="forecast")
+    p.add_argument("--days", type=int, default=3)
+    p.add_argument("--store", action="append", choices=["file", "memory"])
+    p.add_argument("--nlat", type=int, default=SHAPE[1])
+    p.add_argument("--nlon", type=int, default=SHAPE[2])
+    p.add_argument("--directory", default=None, help="Where to write the files.")
+    p.add_argument("--save-baseline", default=None, help="Save the results here.")
+    p.add_argument("--baseline", default=None, help="Compare against saved results.")
+    p.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="The fractional increase in a metric counted as a regression.",
+    )
+    p.set_defaults(func=pipeline)
+
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    args = parse_args(args)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
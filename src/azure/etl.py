@@ -13,20 +13,38 @@ See the following links for more information:
 * https://cds.climate.copernicus.eu/cdsapp#!/dataset/reanalysis-era5-single-levels?tab=overview
 * https://confluence.ecmwf.int/display/CKB/ERA5%3A+data+documentation
 """
+
 from __future__ import annotations
 
 import argparse
+import concurrent.futures
+import contextlib
+import copy
+import dataclasses
 import enum
 import functools
+import hashlib
+import io
+import json
 import logging
+import multiprocessing
 import os
+import queue
+import random
+import resource
+import socket
 import subprocess
 import sys
 import tempfile
+import threading
 import time
-from typing import Any
+import uuid
+from typing import Any, Callable
 
+import dask.array
 import fsspec
+import fsspec.implementations.local
+import numcodecs
 import numpy as np
 import pandas as pd
 import rich.logging
@@ -41,6 +59,17 @@ logger = logging.getLogger(__name__)
 FREQ = "D"  # daily
 FIRST_PERIOD = pd.Period("1959-01-01", freq=FREQ)
 FIRST_LAST_DATETIME = pd.Timestamp("1958-12-31")
+CDS_URL = "https://cds.climate.copernicus.eu/api/v2"
+CDS_DATASET = "reanalysis-era5-single-levels"
+# CDS download formats, and their file extensions. NetCDF is converted by CDS
+# before download; GRIB is ECMWF's native format, decoded here with cfgrib.
+DOWNLOAD_FORMATS = {"netcdf": ".nc", "grib": ".grib"}
+# The global attributes of CDS's NetCDF files, which `normalize_grib` reproduces.
+CDS_NETCDF_ATTRS = {"Conventions": "CF-1.6"}
+# ETL bookkeeping kept under this prefix in the Zarr stores.
+SIDECAR = "_era5"
+# netCDF / HDF5 aren't thread-safe, so opening downloads from worker threads is serialized.
+OPEN_LOCK = threading.Lock()
 
 
 class Kind(str, enum.Enum):
@@ -245,12 +274,16 @@ filenames_to_keys = {
 }
 
 
-def build_daily_query(variable: str, period: pd.Period):
+def build_daily_query(
+    variable: str, period: pd.Period, download_format: str = "netcdf"
+):
     assert period.freq == FREQ
+    if download_format not in DOWNLOAD_FORMATS:
+        raise ValueError(f"Unknown download format '{download_format}'")
 
     params = {
         "product_type": "reanalysis",
-        "format": "netcdf",
+        "format": download_format,
         "variable": variable,
         "year": str(period.year),
         "month": f"{period.month:0>2}",
@@ -260,6 +293,121 @@ def build_daily_query(variable: str, period: pd.Period):
     return params
 
 
+def build_batch_query(
+    variable: str, periods: pd.PeriodIndex, download_format: str = "netcdf"
+):
+    """
+    Build a single CDS request for `variable` on every day in `periods`.
+
+    CDS takes the product of the year, month, and day lists, so all the periods
+    must be in the same month.
+    """
+    assert periods.freq == FREQ
+    months = {(period.year, period.month) for period in periods}
+    if len(months) != 1:
+        raise ValueError(f"Periods must be from a single month. Got {sorted(months)}")
+
+    params = build_daily_query(variable, periods[0], download_format)
+    params["day"] = [str(period.day) for period in periods]
+    return params
+
+
+def batch_periods(
+    periods: pd.PeriodIndex, days_per_request: int = 1
+) -> list[pd.PeriodIndex]:
+    """
+    Split `periods` into batches of at most `days_per_request` consecutive days
+    from the same month, each fetched with one CDS request per variable.
+    """
+    batches: list[list[pd.Period]] = []
+    for period in periods:
+        if (
+            batches
+            and len(batches[-1]) < days_per_request
+            and period == batches[-1][-1] + 1
+            and period.month == batches[-1][-1].month
+        ):
+            batches[-1].append(period)
+        else:
+            batches.append([period])
+    return [pd.PeriodIndex(batch, freq=FREQ) for batch in batches]
+
+
+def split_days(
+    ds: xr.Dataset, periods: pd.PeriodIndex
+) -> list[tuple[pd.Period, xr.Dataset]]:
+    """
+    Split a multi-day download into one dataset per period.
+
+    Every day is checked before any is returned, so a bad download fails before
+    any of its days are written.
+    """
+    days = []
+    for period in periods:
+        day = ds.sel(time=slice(period.start_time, period.end_time))
+        if len(day.time) != 24:
+            raise ValueError(
+                f"Expected 24 hours for {period}, got {len(day.time)} in the download"
+            )
+        days.append((period, day))
+    return days
+
+
+def normalize_grib(grib_ds: xr.Dataset) -> xr.Dataset:
+    """
+    Reshape a GRIB download, as decoded by cfgrib, to match the NetCDF download
+    of the same request, so `transform` treats them alike.
+
+    cfgrib indexes accumulated and min / max fields by forecast reference
+    ``time`` and ``step``, so those are flattened onto their hourly valid times,
+    dropping the (time, step) pairs that weren't requested. GRIB keys and
+    cfgrib's scalar coordinates (``number``, ``surface``, ...) are dropped.
+    """
+    ds = grib_ds
+    if "step" in ds.dims:
+        ds = ds.stack(valid=("time", "step")).reset_index("valid", drop=True)
+        ds = ds.assign_coords(valid=ds["valid_time"].values)
+        ds = ds.drop_vars("valid_time").rename(valid="time")
+        ds = ds.dropna("time", how="all").sortby("time").transpose("time", ...)
+    elif "valid_time" in ds.coords:
+        # the same as `time` for analyses.
+        ds = ds.assign_coords(time=ds["valid_time"].values)
+
+    keep = {"time", "latitude", "longitude"}
+    ds = ds.drop_vars([name for name in ds.coords if name not in keep])
+    ds = ds.assign_coords(
+        latitude=ds["latitude"].astype("float32"),
+        longitude=ds["longitude"].astype("float32"),
+    )
+    for name in ds.variables:
+        ds[name].attrs = {
+            k: v for k, v in ds[name].attrs.items() if k in ("units", "long_name")
+        }
+    # as in CDS's NetCDF files.
+    ds["time"].attrs = {"long_name": "time"}
+    ds.attrs = dict(CDS_NETCDF_ATTRS)
+    if ds.chunks:
+        ds = ds.chunk({"time": 24})
+    return ds
+
+
+def open_download(filename: str, download_format: str = "netcdf") -> xr.Dataset:
+    """
+    Open a CDS download. GRIB downloads are reshaped with `normalize_grib`.
+    """
+    with OPEN_LOCK:
+        if download_format == "grib":
+            ds = xr.open_dataset(
+                filename,
+                engine="cfgrib",
+                chunks={"time": 24},
+                # don't write .idx files next to the download
+                backend_kwargs={"indexpath": ""},
+            )
+            return normalize_grib(ds)
+        return xr.open_dataset(filename, chunks={"time": 24}, use_cftime=False)
+
+
 def transform(cds_ds: xr.Dataset) -> xr.Dataset:
     """
     Transform an xarray Dataset to match what's provided by era5-pds.
@@ -301,259 +449,3633 @@ def transform(cds_ds: xr.Dataset) -> xr.Dataset:
     return result
 
 
+def peak_rss() -> int:
+    """
+    The peak resident set size of this process so far, in bytes.
+    """
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+
+# The per-stage totals kept by `Metrics`.
+STAGE_FIELDS = ["count", "seconds", "bytes", "logical_bytes", "objects", "errors"]
+
+
+class Metrics:
+    """
+    Timings and counters for each stage of the ETL.
+
+    Each `span` records its wall time, the process's peak RSS when it finished,
+    any ``bytes`` (stored), ``logical_bytes`` (in memory), or ``objects`` the
+    stage set on it, and its tags (like kind, period, and variable). Spans and
+    counters are written as JSON lines to `jsonl_path` as they finish, and
+    aggregated for `summary` and the Prometheus textfile written by `finish`.
+
+    An instance is passed down through the ETL's functions like the journal
+    and cache; functions given none record to a throwaway instance.
+    """
+
+    def __init__(
+        self,
+        jsonl_path: str | None = None,
+        prometheus_path: str | None = None,
+        **tags,
+    ):
+        self.jsonl_path = jsonl_path
+        self.prometheus_path = prometheus_path
+        self.tags = tags
+        self.started = time.time()
+        self.stages: dict[tuple[str, str], dict[str, float]] = {}
+        self.counters: dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def span(self, stage: str, **tags):
+        """
+        Time the body of the ``with`` block as `stage`.
+
+        The yielded dict is the record that's emitted, so stages can add
+        ``bytes`` and ``objects`` to it.
+        """
+        record: dict[str, Any] = {"type": "span", "stage": stage, **self.tags, **tags}
+        start = time.time()
+        t0 = time.perf_counter()
+        try:
+            yield record
+        except BaseException as e:
+            record["error"] = type(e).__name__
+            raise
+        finally:
+            record["start"] = start
+            record["seconds"] = time.perf_counter() - t0
+            record["peak_rss_bytes"] = peak_rss()
+            self._emit(record)
+
+    def count(self, name: str, value: float = 1, **tags) -> None:
+        """
+        Add `value` to the counter `name`.
+        """
+        record = {"type": "counter", "name": name, "value": value, **self.tags, **tags}
+        record["start"] = time.time()
+        self._emit(record)
+
+    def tagged(self, **tags) -> Metrics:
+        """
+        A view of these metrics that adds `tags` to everything it records.
+        """
+        view = copy.copy(self)
+        view.tags = {**self.tags, **tags}
+        return view
+
+    def _emit(self, record: dict[str, Any]) -> None:
+        with self._lock:
+            if record["type"] == "span":
+                key = (record["stage"], str(record.get("kind", "")))
+                stage = self.stages.setdefault(key, dict.fromkeys(STAGE_FIELDS, 0))
+                stage["count"] += 1
+                stage["seconds"] += record["seconds"]
+                stage["bytes"] += record.get("bytes", 0)
+                stage["logical_bytes"] += record.get("logical_bytes", 0)
+                stage["objects"] += record.get("objects", 0)
+                stage["errors"] += "error" in record
+            else:
+                name = record["name"]
+                self.counters[name] = self.counters.get(name, 0) + record["value"]
+
+            if self.jsonl_path:
+                with open(self.jsonl_path, "a") as f:
+                    f.write(json.dumps(record, default=str) + "\n")
+
+    def summary(self) -> dict[str, Any]:
+        with self._lock:
+            stages: dict[str, dict[str, float]] = {}
+            for (name, _), stage in self.stages.items():
+                total = stages.setdefault(name, dict.fromkeys(stage, 0))
+                for k, v in stage.items():
+                    total[k] += v
+            return {
+                **self.tags,
+                "started": self.started,
+                "seconds": time.time() - self.started,
+                "peak_rss_bytes": peak_rss(),
+                "stages": stages,
+                "counters": dict(self.counters),
+            }
+
+    def prometheus(self) -> str:
+        """
+        The aggregated metrics in the Prometheus text exposition format.
+        """
+        lines = []
+        with self._lock:
+            for field in STAGE_FIELDS:
+                metric = f"era5_etl_stage_{field}_total"
+                lines.append(f"# TYPE {metric} counter")
+                for (stage, kind), values in sorted(self.stages.items()):
+                    labels = f'stage="{stage}",kind="{kind}"'
+                    lines.append(f"{metric}{{{labels}}} {values[field]}")
+            for name, value in sorted(self.counters.items()):
+                lines.append(f"# TYPE era5_etl_{name}_total counter")
+                lines.append(f"era5_etl_{name}_total {value}")
+        lines.append("# TYPE era5_etl_peak_rss_bytes gauge")
+        lines.append(f"era5_etl_peak_rss_bytes {peak_rss()}")
+        lines.append("# TYPE era5_etl_run_seconds gauge")
+        lines.append(f"era5_etl_run_seconds {time.time() - self.started}")
+        lines.append("# TYPE era5_etl_last_run_timestamp_seconds gauge")
+        lines.append(f"era5_etl_last_run_timestamp_seconds {time.time()}")
+        return "\n".join(lines) + "\n"
+
+    def finish(self) -> dict[str, Any]:
+        """
+        Log and return the run summary, and write the Prometheus textfile.
+        """
+        summary = self.summary()
+        logger.info("Run summary: %s", json.dumps(summary, default=str))
+        if self.jsonl_path:
+            with open(self.jsonl_path, "a") as f:
+                f.write(json.dumps({"type": "summary", **summary}, default=str) + "\n")
+        if self.prometheus_path:
+            # the textfile collector may read at any time, so write then rename.
+            tmp = f"{self.prometheus_path}.{uuid.uuid4().hex}.tmp"
+            with open(tmp, "w") as f:
+                f.write(self.prometheus())
+            os.replace(tmp, self.prometheus_path)
+        return summary
+
+
+def n_chunks(ds: xr.Dataset) -> int:
+    """
+    The number of chunk objects writing `ds` to Zarr creates.
+    """
+    n = 0
+    for var in ds.variables.values():
+        chunks = var.encoding.get("chunks") or (
+            var.data.chunksize if isinstance(var.data, dask.array.Array) else var.shape
+        )
+        n += int(np.prod([-(-size // c) for size, c in zip(var.shape, chunks)]))
+    return n
+
+
+class ErrorClass(str, enum.Enum):
+    retryable = "retryable"
+    throttled = "throttled"
+    fatal = "fatal"
+
+
+# Phrases in CDS error messages meaning the service is overloaded, rather than
+# that the request is bad.
+THROTTLE_MESSAGES = [
+    "queued too long",
+    "too many requests",
+    "rate limit",
+    "temporarily unavailable",
+    "service unavailable",
+]
+
+
+def classify_error(e: BaseException) -> ErrorClass:
+    """
+    Whether a failed CDS call should be retried, and whether it's a sign of throttling.
+
+    HTTP 429 and CDS queue-time errors are throttling. Other 5xx responses and
+    connection errors are retryable. Everything else, including 4xx responses
+    for invalid requests, is fatal.
+    """
+    status = getattr(getattr(e, "response", None), "status_code", None)
+    if status == 429:
+        return ErrorClass.throttled
+    if status is not None:
+        return ErrorClass.retryable if status >= 500 else ErrorClass.fatal
+
+    message = str(e).lower()
+    if any(phrase in message for phrase in THROTTLE_MESSAGES):
+        return ErrorClass.throttled
+    if isinstance(e, (ConnectionError, TimeoutError, urllib3.exceptions.HTTPError)):
+        return ErrorClass.retryable
+    # requests' exceptions don't subclass the builtins; match them by name.
+    if type(e).__name__ in {
+        "ConnectionError",
+        "Timeout",
+        "ReadTimeout",
+        "ChunkedEncodingError",
+    }:
+        return ErrorClass.retryable
+    return ErrorClass.fatal
+
+
+@dataclasses.dataclass
+class RetryPolicy:
+    """
+    How `retry` retries a failed CDS call.
+
+    The delay before retry ``n`` is drawn uniformly from zero to
+    ``min(max_delay, base_delay * 2 ** (n - 1))`` ("full jitter"), so clients
+    that fail together don't retry together. Throttling errors wait
+    `throttle_multiplier` times longer. `budget`, if set, caps the retries
+    across every call sharing this policy, so a CDS outage fails the run
+    instead of retrying for hours.
+    """
+
+    max_attempts: int = 10
+    base_delay: float = 5.0
+    max_delay: float = 600.0
+    throttle_multiplier: float = 4.0
+    budget: int | None = None
+    retries: int = 0
+    _lock: threading.Lock = dataclasses.field(
+        default_factory=threading.Lock, repr=False, compare=False
+    )
+
+    def delay(self, attempt: int, error: ErrorClass) -> float:
+        cap = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        if error == ErrorClass.throttled:
+            cap = min(self.max_delay, cap * self.throttle_multiplier)
+        return random.uniform(0, cap)
+
+    def spend(self) -> bool:
+        """
+        Take one retry from the budget, returning False if it's exhausted.
+        """
+        with self._lock:
+            if self.budget is not None and self.retries >= self.budget:
+                return False
+            self.retries += 1
+            return True
+
+
+class ConcurrencyLimiter:
+    """
+    An AIMD limit on the number of CDS requests in flight.
+
+    Each successful request raises the limit by ``1 / limit`` (about one per
+    round of requests), and each throttling error halves it, between `minimum`
+    and `maximum`. Requests wait in `slot` while the limit is reached.
+    """
+
+    def __init__(self, maximum: int, minimum: int = 1, initial: int | None = None):
+        self.maximum = maximum
+        self.minimum = minimum
+        self.limit = float(initial or maximum)
+        self.in_flight = 0
+        self._condition = threading.Condition()
+
+    @contextlib.contextmanager
+    def slot(self):
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                self._condition.wait()
+            self.in_flight += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self.in_flight -= 1
+                self._condition.notify_all()
+
+    def increase(self) -> None:
+        with self._condition:
+            self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self._condition.notify_all()
+
+    def decrease(self) -> None:
+        with self._condition:
+            self.limit = max(self.minimum, self.limit / 2)
+            logger.warning("CDS is throttling; limiting to %d requests", self.limit)
+
+
 def retry(func):
+    """
+    Retry `func` on retryable errors, following its ``retry_policy`` argument.
+
+    Throttling errors also shrink the ``limiter`` argument, if given. Fatal
+    errors are raised immediately. Once the attempts or the policy's budget are
+    used up, a RuntimeError is raised from the last error.
+    """
+
     @functools.wraps(func)
     def wrapper(*args, **kwargs):
-        e = RuntimeError
-        for i in range(1, 11):
+        policy = kwargs.get("retry_policy") or RetryPolicy()
+        limiter = kwargs.get("limiter")
+        metrics = kwargs.get("metrics")
+        for attempt in range(1, policy.max_attempts + 1):
             try:
                 return func(*args, **kwargs)
-            except ConnectionResetError:
-                logger.exception("Connection reset error on try %d/10", i)
-            time.sleep(5)
-        else:
-            logger.warning("Failed 10 times. Re-raising")
-            raise e
+            except Exception as e:
+                error = classify_error(e)
+                if error == ErrorClass.fatal:
+                    raise
+                if error == ErrorClass.throttled and limiter is not None:
+                    limiter.decrease()
+                if attempt == policy.max_attempts:
+                    raise RuntimeError(
+                        f"{func.__name__} failed after {attempt} attempts"
+                    ) from e
+                if not policy.spend():
+                    raise RuntimeError(
+                        f"{func.__name__} failed, and the retry budget of "
+                        f"{policy.budget} is used up"
+                    ) from e
+                delay = policy.delay(attempt, error)
+                logger.warning(
+                    "%s error on try %d/%d: %s. Retrying in %.1fs",
+                    error.value,
+                    attempt,
+                    policy.max_attempts,
+                    e,
+                    delay,
+                )
+                if metrics is not None:
+                    metrics.count("retries", function=func.__name__, error=error.value)
+                time.sleep(delay)
 
     return wrapper
 
 
+def make_cds_client(cds_api_key: str):
+    """
+    Create a CDS API client.
 
-@retry
-def fetch_day(variable: str, day: pd.Period, cds_api_key: str, basedir: str | None = None) -> xr.Dataset:
+    Anything with a ``retrieve(name, request, target)`` method can be used in its
+    place by the functions below, which is how the ETL is tested without CDS.
+    """
     import cdsapi
 
-    cds = cdsapi.Client(url="https://cds.climate.copernicus.eu/api/v2", key=cds_api_key)
     urllib3.disable_warnings()
+    return cdsapi.Client(url=CDS_URL, key=cds_api_key)
 
-    params = build_daily_query(variable, day)
-    filename = f"{variable}.nc"
-    if basedir:
-        filename = os.path.join(basedir, filename)
 
-    cds.retrieve("reanalysis-era5-single-levels", params, filename)
-    return xr.open_dataset(filename, chunks={"time": 24}, use_cftime=False)
+class DownloadCache:
+    """
+    An on-disk cache of CDS downloads, keyed by the dataset and request.
 
+    Files are placed atomically and checked against a stored SHA-256 digest when
+    read, and the least-recently-used files are evicted once the cache grows past
+    `max_bytes`. Files handed out by `get` and `put` are pinned, so they aren't
+    evicted while they're open, until they're given back with `release`.
 
-def do_one(
-    kind: str,
-    period: pd.Period,
-    cds_api_key: str,
-    output_protocol: str,
-    output_path: str,
-    output_storage_options: dict[str, Any],
-) -> None:
-    """
-    Copy and convert for one month - kind.
+    Partial downloads left behind by a crash are removed once they're older than
+    `part_max_age` seconds.
     """
-    variables = KINDS_TO_VARIABLES[kind]
-    td = tempfile.TemporaryDirectory()
-    N = len(variables)
-    datasets = []
 
-    with td:
-        for i, variable in enumerate(variables, 1):
-            logger.info(
-                "Downloading period - variable: %s - %s [%d / %d]",
-                period,
-                variable,
-                i,
-                N,
-            )
-            datasets.append(fetch_day(variable, period, cds_api_key, basedir=td.name))
+    def __init__(
+        self,
+        directory: str,
+        max_bytes: int = 50 * 2**30,
+        part_max_age: float = 24 * 60 * 60,
+    ):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.part_max_age = part_max_age
+        self._pinned: dict[str, int] = {}
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, dataset: str, params: dict[str, Any]) -> str:
+        return request_key(dataset, params)
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.nc")
+
+    def __contains__(self, key: str) -> bool:
+        # cheap; `get` does the integrity check.
+        return os.path.exists(f"{self.path(key)}.sha256")
+
+    def temporary_path(self) -> str:
+        """
+        A path in the cache directory to download to before `put`.
+        """
+        return os.path.join(self.directory, f".{uuid.uuid4().hex}.part")
+
+    def get(self, key: str) -> str | None:
+        """
+        The cached file for `key`, or None if it's missing or fails its integrity check.
+        """
+        path = self.path(key)
+        try:
+            with open(f"{path}.sha256") as f:
+                expected = f.read().strip()
+        except FileNotFoundError:
+            return None
+
+        if not os.path.exists(path) or _sha256(path) != expected:
+            logger.warning("Discarding corrupt cache entry %s", path)
+            self._remove(key)
+            return None
+
+        self._pin(key)
+        os.utime(path)
+        return path
+
+    def put(self, key: str, filename: str) -> str:
+        """
+        Move `filename`, from `temporary_path`, into the cache under `key`.
+        """
+        path = self.path(key)
+        digest = _sha256(filename)
+        tmp = self.temporary_path()
+        with open(tmp, "w") as f:
+            f.write(digest)
+        self._pin(key)
+        os.replace(filename, path)
+        os.replace(tmp, f"{path}.sha256")
+        self.evict()
+        return path
+
+    def release(self, path: str) -> None:
+        """
+        Unpin a file from `get` or `put` once it's closed, and evict if needed.
+        """
+        key = os.path.basename(path)[: -len(".nc")]
+        with self._lock:
+            count = self._pinned.get(key, 0) - 1
+            if count > 0:
+                self._pinned[key] = count
+            else:
+                self._pinned.pop(key, None)
+        self.evict()
+
+    def _pin(self, key: str) -> None:
+        with self._lock:
+            self._pinned[key] = self._pinned.get(key, 0) + 1
+
+    def evict(self) -> None:
+        """
+        Remove the least-recently-used entries until the cache is under `max_bytes`.
+        """
+        with self._lock:
+            entries = []
+            now = time.time()
+            for entry in os.scandir(self.directory):
+                stat = entry.stat()
+                if entry.name.endswith(".nc"):
+                    entries.append((stat.st_mtime, stat.st_size, entry.name[:-3]))
+                elif (
+                    entry.name.endswith(".part")
+                    and now - stat.st_mtime > self.part_max_age
+                ):
+                    logger.info("Removing stale partial download %s", entry.name)
+                    os.remove(entry.path)
+
+            total = sum(size for _, size, _ in entries)
+            for _, size, key in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                if key in self._pinned:
+                    continue
+                logger.info("Evicting %s from the download cache", key)
+                self._remove(key)
+                total -= size
+
+    def _remove(self, key: str) -> None:
+        for path in [f"{self.path(key)}.sha256", self.path(key)]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
 
-        logger.info("Transforming variables")
-        transformed = [transform(ds) for ds in datasets]
-        logger.info("Transformed variables")
 
-        logger.info("Combining variables")
-        ds = xr.combine_by_coords(transformed, join="exact")
-        logger.info("Combined variables")
+def _sha256(filename: str) -> str:
+    h = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(2**20), b""):
+            h.update(block)
+    return h.hexdigest()
 
-        store = fsspec.filesystem(output_protocol, **output_storage_options).get_mapper(
-            output_path
-        )
-        kwargs: dict[str, Any] = {"consolidated": True}
-        if period != FIRST_PERIOD:
-            kwargs["mode"] = "a"
-            kwargs["append_dim"] = "time"
 
-        logger.info(
-            "Writing output to %s://%s", output_protocol, output_path, extra=kwargs
-        )
+def request_key(dataset: str, params: dict[str, Any]) -> str:
+    """
+    A stable identifier for a CDS request.
+    """
+    token = json.dumps([dataset, params], sort_keys=True)
+    return hashlib.sha256(token.encode()).hexdigest()
 
-        # TODO: validate that index is expected
-        ds.to_zarr(store, **kwargs)
 
-    logger.info("Wrote output to %s://%s", output_protocol, output_path)
+def write_json(fs, path: str, state: Any) -> None:
+    """
+    Replace the JSON document at `path` in one step.
+    """
+    data = json.dumps(state, indent=2, sort_keys=True).encode()
+    if isinstance(fs, fsspec.implementations.local.LocalFileSystem):
+        # a single PUT is atomic on blob storage; locally, write then rename.
+        fs.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{uuid.uuid4().hex}.tmp"
+        fs.pipe_file(tmp, data)
+        os.replace(tmp, path)
+    else:
+        fs.pipe_file(path, data)
 
 
-def determine_next_period(
-    output_protocol, output_path, output_storage_options
-) -> tuple[pd.Timestamp, pd.Period]:
+class CDSRequestFailed(Exception):
     """
-    Determine the next period to fetch, based on what's present in storage and the present date.
+    CDS reported that a request failed.
     """
-    store = fsspec.filesystem(output_protocol, **output_storage_options).get_mapper(
-        output_path
-    )
-    if not store.fs.exists(os.path.join(output_path, ".zmetadata")):
-        # initial write to this
-        return FIRST_LAST_DATETIME, FIRST_PERIOD
 
-    last = xr.open_dataset(store, engine="zarr").time[-1]
-    dt = pd.to_datetime(last.data)
-    hour = pd.Timedelta(hours=1)
-    if dt.hour != 23:
-        raise ValueError(f"Last hour written '{dt.hour}' is not 23! Check on the data.")
 
-    period = pd.Period(dt + hour, freq=FREQ)
-    return dt, period
+class CDSAPIBackend:
+    """
+    The broker's interface to the CDS API: submit, check, and download requests.
 
+    Any object with these three methods can stand in for it, which is how the
+    broker is tested without CDS.
+    """
 
-def parse_args(args=None):
-    parser = argparse.ArgumentParser()
-    parser.add_argument("kind", choices=["forecast", "analysis"])
-    parser.add_argument(
-        "--credential", type=str, default=os.environ.get("ETL_CREDENTIAL")
-    )
-    parser.add_argument("--output-protocol", type=str, default="abfs")
-    parser.add_argument("--output-path", type=str, default=None)
-    # parser.add_argument("--output-storage_options", type=str)
-    parser.add_argument("--cds-api-key", default=os.environ.get("ETL_CDS_API_KEY"))
-    parser.add_argument("--start-period", default=None)
-    parser.add_argument("--end-period", default=None)
+    def __init__(self, cds_api_key: str):
+        import cdsapi
 
-    return parser.parse_args(args)
+        urllib3.disable_warnings()
+        self.client = cdsapi.Client(
+            url=CDS_URL, key=cds_api_key, wait_until_complete=False
+        )
+        self._results: dict[str, Any] = {}
 
+    def _result(self, request_id: str):
+        import cdsapi.api
 
-def prepare():
-    try:
-        import cdsapi  # noqa: F401
-    except ImportError:
-        subprocess.call([sys.executable, "-m", "pip", "install", "git+https://github.com/TomAugspurger/cdsapi.git@loggingfix"])
+        if request_id not in self._results:
+            # a request submitted by an earlier run.
+            self._results[request_id] = cdsapi.api.Result(
+                self.client, {"request_id": request_id, "state": "queued"}
+            )
+        return self._results[request_id]
+
+    def submit(self, dataset: str, params: dict[str, Any]) -> str:
+        result = self.client.retrieve(dataset, params)
+        request_id = result.reply["request_id"]
+        self._results[request_id] = result
+        return request_id
+
+    def status(self, request_id: str) -> tuple[str, str | None]:
+        """
+        The request's state ("queued", "running", "completed", or "failed"), and
+        the error message if it failed.
+        """
+        result = self._result(request_id)
+        result.update(request_id)
+        reply = result.reply
+        error = reply.get("error", {})
+        message = f"{error.get('message')}. {error.get('reason')}" if error else None
+        return reply["state"], message
+
+    def download(self, request_id: str, target: str) -> None:
+        self._result(request_id).download(target)
+        self._results.pop(request_id, None)
+
+
+class CDSBroker:
+    """
+    Submit CDS requests up front, poll them from one thread, and hand out each
+    result as soon as it's ready.
 
+    CDS does most of its work while requests wait in its queue, so keeping many
+    requests queued at once is what makes a run fast. `submit` queues a request
+    (at most `max_queued` are outstanding at CDS at once; the rest wait here, in
+    order) and `result` blocks until it's done and downloads it.
 
-def main(args=None):
-    args = parse_args(args)
-    logger.setLevel(logging.INFO)
-    logger.addHandler(rich.logging.RichHandler())
+    Request IDs are recorded in the JSON document at `path` as they're
+    submitted, so a restarted run picks up its requests instead of submitting
+    them again.
+    """
 
-    credential = args.credential
-    kind = args.kind
-    output_protocol = args.output_protocol
-    output_path = args.output_path
-    cds_api_key = args.cds_api_key
-    start_period = args.start_period
-    end_period = args.end_period
-    # output_storage_options = args.output_storage_options
+    def __init__(
+        self,
+        backend,
+        fs,
+        path: str,
+        max_queued: int = 16,
+        poll_interval: float = 30.0,
+    ):
+        self.backend = backend
+        self.fs = fs
+        self.path = path
+        self.max_queued = max_queued
+        self.poll_interval = poll_interval
+        try:
+            self.state = json.loads(fs.cat_file(path))
+        except FileNotFoundError:
+            self.state = {"version": 1, "requests": {}}
+        # requests not yet submitted to CDS, and finished ones (with any error), by key.
+        self._waiting: dict[str, dict[str, Any]] = {}
+        self._ready: dict[str, str | None] = {}
+        self._condition = threading.Condition()
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    @property
+    def requests(self) -> dict[str, dict[str, Any]]:
+        """
+        The requests submitted to CDS and not yet downloaded, by key.
+        """
+        return self.state["requests"]
+
+    def submit(self, params: dict[str, Any]) -> str:
+        """
+        Queue `params` for submission, if it isn't already. Returns its key.
+        """
+        key = request_key(CDS_DATASET, params)
+        with self._condition:
+            if key not in self.requests and key not in self._waiting:
+                self._waiting[key] = params
+            self._condition.notify_all()
+        self._start()
+        return key
+
+    def result(self, params: dict[str, Any], target: str) -> None:
+        """
+        Wait for `params` to complete at CDS, and download it to `target`.
+
+        Raises `CDSRequestFailed` if CDS reports that it failed. The failed
+        request is forgotten, so calling this again submits it again.
+        """
+        key = self.submit(params)
+        with self._condition:
+            while key not in self._ready:
+                if self._stop.is_set():
+                    raise RuntimeError("The CDS broker was closed")
+                self._condition.wait()
+            error = self._ready.pop(key)
+            request_id = self.requests[key]["request_id"]
+            if error is not None:
+                self.requests.pop(key)
+                self._flush()
+        if error is not None:
+            raise CDSRequestFailed(f"CDS request {request_id} failed: {error}")
+
+        logger.info("Downloading CDS request %s", request_id)
+        self.backend.download(request_id, target)
+        with self._condition:
+            self.requests.pop(key, None)
+            self._flush()
+            self._condition.notify_all()
+
+    def close(self) -> None:
+        self._stop.set()
+        with self._condition:
+            self._condition.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _flush(self) -> None:
+        write_json(self.fs, self.path, self.state)
+
+    def _start(self) -> None:
+        with self._condition:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="era5-cds-broker", daemon=True
+                )
+                self._thread.start()
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            try:
+                self._submit_waiting()
+                self._poll()
+            except Exception:
+                logger.exception("Error in the CDS broker. Trying again")
+            with self._condition:
+                if not self._stop.is_set():
+                    self._condition.wait(self.poll_interval)
+
+    def _submit_waiting(self) -> None:
+        while True:
+            with self._condition:
+                outstanding = sum(1 for key in self.requests if key not in self._ready)
+                if not self._waiting or outstanding >= self.max_queued:
+                    return
+                key = next(iter(self._waiting))
+                params = self._waiting[key]
+            request_id = self.backend.submit(CDS_DATASET, params)
+            logger.info(
+                "Submitted CDS request %s for %s", request_id, params["variable"]
+            )
+            with self._condition:
+                del self._waiting[key]
+                self.requests[key] = {"request_id": request_id, "params": params}
+                self._flush()
+
+    def _poll(self) -> None:
+        with self._condition:
+            pending = {
+                key: entry["request_id"]
+                for key, entry in self.requests.items()
+                if key not in self._ready
+            }
+        for key, request_id in pending.items():
+            state, message = self.backend.status(request_id)
+            if state in ("completed", "failed"):
+                with self._condition:
+                    self._ready[key] = None if state == "completed" else message
+                    self._condition.notify_all()
 
-    # assert kind in
 
-    output_storage_options = {"account_name": "cpdataeuwest", "credential": credential}
+@retry
+def fetch_days(
+    variable: str,
+    periods: pd.PeriodIndex,
+    cds_api_key: str,
+    basedir: str | None = None,
+    client=None,
+    cache: DownloadCache | None = None,
+    metrics: Metrics | None = None,
+    retry_policy: RetryPolicy | None = None,
+    limiter: ConcurrencyLimiter | None = None,
+    broker: CDSBroker | None = None,
+    download_format: str = "netcdf",
+) -> xr.Dataset:
+    params = build_batch_query(variable, periods, download_format)
+    return retrieve(
+        params,
+        cds_api_key,
+        basedir=basedir,
+        client=client,
+        cache=cache,
+        metrics=metrics,
+        limiter=limiter,
+        broker=broker,
+    )
 
-    if output_path is None:
-        output_path = f"era5/{kind}.zarr"
 
-    last, next_period = determine_next_period(
-        output_protocol=output_protocol,
-        output_path=output_path,
-        output_storage_options=output_storage_options,
-    )
+def retrieve(
+    params: dict[str, Any],
+    cds_api_key: str,
+    basedir: str | None = None,
+    client=None,
+    cache: DownloadCache | None = None,
+    metrics: Metrics | None = None,
+    limiter: ConcurrencyLimiter | None = None,
+    broker: CDSBroker | None = None,
+) -> xr.Dataset:
+    """
+    Download `params` from CDS and open it, consulting `cache` first if given.
 
-    if start_period is None:
-        start_period = next_period
-    else:
-        start_period = pd.Period(start_period, freq=FREQ)
+    The download goes through `broker` if given, and otherwise waits for a slot
+    from `limiter`, if given.
+    """
+    metrics = metrics or Metrics()
+
+    def download(target: str) -> None:
+        if broker is not None:
+            broker.result(params, target)
+            return
+        with limiter.slot() if limiter is not None else contextlib.nullcontext():
+            (client or make_cds_client(cds_api_key)).retrieve(
+                CDS_DATASET, params, target
+            )
+        if limiter is not None:
+            limiter.increase()
+
+    tags = {k: params[k] for k in ["variable", "year", "month", "day"]}
+    with metrics.span("download", **tags) as span:
+        span["cached"] = False
+        if cache is not None:
+            key = cache.key(CDS_DATASET, params)
+            filename = cache.get(key)
+            if filename is None:
+                tmp = cache.temporary_path()
+                try:
+                    download(tmp)
+                    filename = cache.put(key, tmp)
+                finally:
+                    if os.path.exists(tmp):
+                        os.remove(tmp)
+            else:
+                logger.info("Using cached download for %s", params["variable"])
+                span["cached"] = True
+        else:
+            filename = params["variable"] + DOWNLOAD_FORMATS[params["format"]]
+            if basedir:
+                filename = os.path.join(basedir, filename)
 
-    if (start_period - pd.Period(last, freq=FREQ)) != pd.offsets.Day(1):
-        raise ValueError(
-            f"start_period={start_period} is not consecutive with the last timestamp={last}"
-        )
+            download(filename)
+        if not span["cached"]:
+            span["bytes"] = os.path.getsize(filename)
+            span["objects"] = 1
 
-    cutoff_period = pd.Period(pd.Timestamp.today() - pd.offsets.DateOffset(months=3, days=1), freq=FREQ)
-    if end_period is None:
-        end_period = cutoff_period
-    else:
-        end_period = pd.Period(end_period, freq=FREQ)
+    return open_download(filename, params["format"])
 
-    if end_period > cutoff_period:
-        raise ValueError(
-            f"end_period={end_period} is later than 3 months ago (={cutoff_period})"
-        )
 
-    periods = pd.period_range(start_period, end_period, freq=FREQ)
-    N = len(periods)
+@dataclasses.dataclass
+class FetchResult:
+    """
+    The outcome of downloading one variable for a period.
+    """
 
-    logger.info("Preparing")
-    prepare()
+    variable: str
+    dataset: xr.Dataset | None = None
+    error: BaseException | None = None
 
-    logger.info("Beginning extract for kind=%s - periods=%s", kind, periods)
+    @property
+    def ok(self) -> bool:
+        return self.error is None
 
-    for i, period in enumerate(periods, 1):
-        logger.info("Starting %s - %s [%d/%d]", kind, period, i, N)
-        do_one(
-            kind,
-            period,
-            cds_api_key=cds_api_key,
-            output_protocol=output_protocol,
-            output_path=output_path,
-            output_storage_options=output_storage_options,
-        )
-        logger.info("Finished %s - %s [%d/%d]", kind, period, i, N)
 
-    if len(periods):
-        logger.info("Starting compact 'time' dimension")
-        prefix = output_path
-        if output_protocol == "abfs":
-            # strip the container name
-            container_name, prefix = output_path.split("/", 1)
-            account_name = output_storage_options["account_name"]
+def fetch_variables(
+    variables: list[str],
+    periods: pd.PeriodIndex,
+    cds_api_key: str,
+    basedir: str | None = None,
+    max_concurrent_requests: int = 1,
+    client=None,
+    cache: DownloadCache | None = None,
+    metrics: Metrics | None = None,
+    retry_policy: RetryPolicy | None = None,
+    limiter: ConcurrencyLimiter | None = None,
+    broker: CDSBroker | None = None,
+    download_format: str = "netcdf",
+) -> list[FetchResult]:
+    """
+    Download all the variables for a batch of periods, with up to
+    `max_concurrent_requests` CDS requests in flight at once, or fewer if
+    `limiter` has backed off.
 
-            cc = azure.storage.blob.ContainerClient(
-                f"https://{account_name}.blob.core.windows.net",
-                container_name,
-                credential=credential,
+    The results are in the same order as `variables`. A failure for one variable
+    is recorded on its result and doesn't cancel the others.
+    """
+    N = len(variables)
+    label = str(periods[0]) if len(periods) == 1 else f"{periods[0]}/{periods[-1]}"
+    metrics = metrics or Metrics()
+
+    def fetch(i: int, variable: str) -> FetchResult:
+        logger.info(
+            "Downloading period - variable: %s - %s [%d / %d]",
+            label,
+            variable,
+            i,
+            N,
+        )
+        try:
+            ds = fetch_days(
+                variable,
+                periods,
+                cds_api_key,
+                basedir=basedir,
+                client=client,
+                cache=cache,
+                metrics=metrics,
+                retry_policy=retry_policy,
+                limiter=limiter,
+                broker=broker,
+                download_format=download_format,
             )
-            compact(prefix, cc)
-            logger.info("Finished compact 'time' dimension")
+        except Exception as e:
+            metrics.count("download_failures", variable=variable, period=label)
+            logger.exception(
+                "Failed to download period - variable: %s - %s", label, variable
+            )
+            return FetchResult(variable, error=e)
+        logger.info("Downloaded period - variable: %s - %s", label, variable)
+        return FetchResult(variable, dataset=ds)
 
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=max_concurrent_requests
+    ) as pool:
+        futures = [
+            pool.submit(fetch, i, variable) for i, variable in enumerate(variables, 1)
+        ]
+        return [future.result() for future in futures]
 
-def compact(prefix: str, cc: azure.storage.blob.ContainerClient):
+
+def check_results(results: list[FetchResult], label: str) -> list[xr.Dataset]:
     """
-    Compact the `time` dimension into a single chunk.
+    Raise if any variable failed to download, otherwise return the datasets.
     """
-    # using azure.storage.blob rather than adlfs / fsspec to
-    # avoid any caching issues.
-    prefix = prefix.rstrip("/")
-    store = zarr.ABSStore(prefix=prefix, client=cc)
-    ds = xr.open_dataset(store, engine="zarr", chunks={})
+    failed = [result for result in results if not result.ok]
+    if failed:
+        raise RuntimeError(
+            f"Failed to download {len(failed)}/{len(results)} variables for {label}: "
+            f"{[result.variable for result in failed]}"
+        ) from failed[0].error
+    return [result.dataset for result in results if result.dataset is not None]
 
-    time = ds["time"]
-    time.encoding["chunks"] = len(
-        time,
-    )
-    time.encoding["preferred_chunks"] = {"time": len(time)}
-    ds["time"].encoding
 
-    new_store = zarr.MemoryStore()
-    ds[["time"]].to_zarr(new_store)
+def close_datasets(
+    datasets: list[xr.Dataset], cache: DownloadCache | None = None
+) -> None:
+    """
+    Close the downloaded datasets, releasing their files in `cache`.
+    """
+    for ds in datasets:
+        source = ds.encoding.get("source")
+        ds.close()
+        if (
+            cache is not None
+            and source
+            and os.path.dirname(source) == os.path.abspath(cache.directory)
+        ):
+            cache.release(source)
+
+
+def combine(
+    datasets: list[xr.Dataset],
+    period: pd.Period | None = None,
+    metrics: Metrics | None = None,
+) -> xr.Dataset:
+    """
+    Transform and combine the per-variable datasets for a period.
+    """
+    metrics = metrics or Metrics()
+    tags = {} if period is None else {"period": str(period)}
+
+    logger.info("Transforming variables")
+    transformed = []
+    for ds in datasets:
+        with metrics.span(
+            "transform", variable=",".join(map(str, ds.data_vars)), **tags
+        ):
+            transformed.append(transform(ds))
+    logger.info("Transformed variables")
+
+    logger.info("Combining variables")
+    with metrics.span("combine", **tags):
+        combined = xr.combine_by_coords(transformed, join="exact")
+    logger.info("Combined variables")
+    # every input is a Dataset, so the result is too.
+    assert isinstance(combined, xr.Dataset)
+    return combined
+
+
+class Journal:
+    """
+    A durable record of the appends in progress.
 
-    for k, v in new_store.items():
-        if k.startswith("time/"):
-            name = f"{prefix}/{k}"
-            print(k, "->", name)
-            cc.upload_blob(name, v, overwrite=True)
+    The journal is a small JSON document, by default at ``_era5/journal.json``
+    in the Zarr store. Before a period is appended, the current length of
+    ``time`` is recorded, so that `recover` can detect, and undo, an append that
+    was interrupted partway through. Committed periods are dropped from it (the
+    store itself records them), so it only ever holds the append in flight.
+
+    It's written twice per period, so it only protects appends: a resumed run
+    starts after the last committed period, and relies on the download cache to
+    avoid downloading again.
+    """
 
+    def __init__(self, fs, path: str):
+        self.fs = fs
+        self.path = path
+        self._lock = threading.Lock()
+        try:
+            self.state = json.loads(fs.cat_file(path))
+        except FileNotFoundError:
+            self.state = {"version": 2, "last_committed": None, "periods": {}}
+
+    @classmethod
+    def for_store(cls, store, worker: str | None = None) -> "Journal":
+        """
+        The journal kept in `store`. Pass `worker` to keep a separate journal for
+        each of several workers writing to the same store.
+        """
+        name = "journal" if worker is None else f"journal-{worker}"
+        return cls(store.fs, f"{store.root}/{SIDECAR}/{name}.json")
+
+    @property
+    def periods(self) -> dict[str, dict[str, Any]]:
+        return self.state["periods"]
+
+    def begin(self, period: pd.Period, time_length: int) -> None:
+        """
+        Record that `period` is about to be appended to ``time`` of `time_length`.
+        """
+        with self._lock:
+            self.periods[str(period)] = {"time_length": time_length}
+            self._flush()
+
+    def commit(self, period: pd.Period) -> None:
+        """
+        Record that `period` was completely written.
+        """
+        with self._lock:
+            self.periods.pop(str(period), None)
+            last = self.state["last_committed"]
+            if last is None or pd.Period(last, freq=FREQ) < period:
+                self.state["last_committed"] = str(period)
+            self._flush()
+
+    def _flush(self) -> None:
+        write_json(self.fs, self.path, self.state)
+
+    def recover(self, store) -> None:
+        """
+        Repair any append that was interrupted after it started writing.
+
+        An interrupted append can leave some arrays longer than others, or all of
+        them longer than the consolidated metadata says. Arrays are truncated back
+        to the recorded length, unless every array was fully appended, in which
+        case only the consolidated metadata is refreshed.
+        """
+        for period, entry in sorted(self.periods.items()):
+            if ".zmetadata" not in store:
+                continue
+            before = entry["time_length"]
+            lengths = time_lengths(store)
+            expected = before + 24
+            if all(n == expected for n in lengths.values()):
+                logger.warning("Append of %s completed; refreshing metadata", period)
+                zarr.consolidate_metadata(store)
+                self.commit(pd.Period(period, freq=FREQ))
+                continue
+            if any(n != before for n in lengths.values()):
+                logger.warning(
+                    "Append of %s was interrupted (lengths %s). Truncating to %d",
+                    period,
+                    lengths,
+                    before,
+                )
+                truncate(store, before)
+            with self._lock:
+                self.periods.pop(period)
+                self._flush()
+
+
+def time_lengths(store) -> dict[str, int]:
+    """
+    The length along ``time`` of every array in the store, read from each array's
+    own metadata rather than the (possibly stale) consolidated metadata.
+    """
+    consolidated = json.loads(store[".zmetadata"])["metadata"]
+    lengths = {}
+    for key, attrs in consolidated.items():
+        if (
+            key.endswith("/.zattrs")
+            and attrs.get("_ARRAY_DIMENSIONS", [None])[0] == "time"
+        ):
+            name = key.rsplit("/", 1)[0]
+            lengths[name] = json.loads(store[f"{name}/.zarray"])["shape"][0]
+    return lengths
+
+
+def truncate(store, length: int) -> None:
+    """
+    Shrink every ``time`` array in the store to `length` and re-consolidate.
+    """
+    for name, n in time_lengths(store).items():
+        if n != length:
+            array = zarr.open_array(store, path=name, mode="r+")
+            array.resize(length, *array.shape[1:])
     zarr.consolidate_metadata(store)
 
-    # Remove any stale fragments
-    KEEP = {".zarray", ".zattrs", "0"}
 
-    for blob in cc.list_blobs(name_starts_with=f"{prefix}/time/"):
-        if blob.name.split("/")[-1] not in KEEP:
-            logger.info("Deleting %s", blob.name)
-            cc.delete_blob(blob)
+@dataclasses.dataclass(frozen=True)
+class EncodingProfile:
+    """
+    The compressor and spatial chunking for a variable in the output store.
+
+    `cname` of None keeps Zarr's default compressor. A chunk size of None along
+    ``lat`` or ``lon`` means the full grid. Chunks are always 24 hours long.
+    """
+
+    cname: str | None = None
+    clevel: int = 5
+    shuffle: str = "shuffle"
+    lat_chunk: int | None = None
+    lon_chunk: int | None = None
+
+    def encoding(self, var: xr.DataArray) -> dict[str, Any]:
+        encoding: dict[str, Any] = {}
+        if self.cname is not None:
+            encoding["compressor"] = numcodecs.Blosc(
+                cname=self.cname, clevel=self.clevel, shuffle=SHUFFLES[self.shuffle]
+            )
+        if self.lat_chunk or self.lon_chunk:
+            sizes = dict(zip(var.dims, var.shape))
+            encoding["chunks"] = (
+                24,
+                min(self.lat_chunk or sizes["lat"], sizes["lat"]),
+                min(self.lon_chunk or sizes["lon"], sizes["lon"]),
+            )
+        return encoding
+
+
+SHUFFLES = {
+    "noshuffle": numcodecs.Blosc.NOSHUFFLE,
+    "shuffle": numcodecs.Blosc.SHUFFLE,
+    "bitshuffle": numcodecs.Blosc.BITSHUFFLE,
+}
+
+ENCODING_PROFILES = {
+    "default": EncodingProfile(),
+    "lz4": EncodingProfile(cname="lz4", clevel=5),
+    "zstd": EncodingProfile(cname="zstd", clevel=3),
+    "zstd-9": EncodingProfile(cname="zstd", clevel=9),
+    "zstd-bitshuffle": EncodingProfile(cname="zstd", clevel=3, shuffle="bitshuffle"),
+    "zstd-tiled": EncodingProfile(cname="zstd", clevel=3, lat_chunk=181, lon_chunk=360),
+}
+
+
+# The range of each variable that's representable when packed into 16-bit integers,
+# in its units. These are generous physical limits; values outside them raise
+# rather than being clipped.
+PACKED_RANGES = {
+    "eastward_wind_at_10_metres": (-120.0, 120.0),
+    "northward_wind_at_10_metres": (-120.0, 120.0),
+    "eastward_wind_at_100_metres": (-120.0, 120.0),
+    "northward_wind_at_100_metres": (-120.0, 120.0),
+    "dew_point_temperature_at_2_metres": (170.0, 330.0),
+    "air_temperature_at_2_metres": (170.0, 340.0),
+    "air_temperature_at_2_metres_1hour_Maximum": (170.0, 340.0),
+    "air_temperature_at_2_metres_1hour_Minimum": (170.0, 340.0),
+    "sea_surface_temperature": (260.0, 320.0),
+    "precipitation_amount_1hour_Accumulation": (0.0, 0.4),
+    "integral_wrt_time_of_surface_direct_downwelling_shortwave_flux_in_air_1hour_Accumulation": (  # noqa: E501
+        0.0,
+        5e6,
+    ),
+    "surface_air_pressure": (30000.0, 110000.0),
+    "air_pressure_at_mean_sea_level": (85000.0, 110000.0),
+}
+# Variables with missing values (sea surface temperature is missing over land).
+# The fixed-scale-offset filter can't represent them, so they're always packed
+# with CF encoding.
+HAS_MISSING_VALUES = {"sea_surface_temperature"}
+PACKINGS = ["none", "cf", "filter"]
+# The encoding of a packed variable in a CDS NetCDF download.
+CF_PACKING_KEYS = ["dtype", "scale_factor", "add_offset", "_FillValue", "missing_value"]
+# int16 codes -32767 to 32767 span the range; -32768 is the fill value.
+PACKED_STEPS = 2**16 - 2
+PACKED_FILL_VALUE = -(2**15)
+
+
+def packing_parameters(name: str, mode: str) -> dict[str, Any]:
+    """
+    How `name` is packed into int16 with `mode`, as recorded in the
+    ``era5:packing`` attribute.
+
+    Values are rounded to the nearest multiple of ``scale_factor`` from
+    ``add_offset``, so the error of a packed value is at most ``max_error``,
+    half of ``scale_factor``, on top of float32 rounding.
+    """
+    valid_min, valid_max = PACKED_RANGES[name]
+    scale_factor = (valid_max - valid_min) / PACKED_STEPS
+    if mode == "filter" and name in HAS_MISSING_VALUES:
+        mode = "cf"
+    return {
+        "mode": mode,
+        "valid_min": valid_min,
+        "valid_max": valid_max,
+        "scale_factor": scale_factor,
+        "add_offset": (valid_max + valid_min) / 2,
+        "max_error": scale_factor / 2,
+    }
+
+
+def packing_encoding(var: xr.DataArray, packing: dict[str, Any]) -> dict[str, Any]:
+    """
+    The Zarr encoding for `var` packed as described by `packing`.
+
+    With ``mode="cf"``, the array is stored as int16 with CF ``scale_factor`` and
+    ``add_offset`` attributes, which readers decode (xarray decodes to float64, as
+    it does CDS's NetCDF files). With ``mode="filter"``, the
+    array stays float32 and a numcodecs ``FixedScaleOffset`` filter packs it into
+    int16 inside each chunk, so readers don't need to do anything.
+    """
+    if packing["mode"] == "cf":
+        return {
+            "dtype": "int16",
+            "scale_factor": packing["scale_factor"],
+            "add_offset": packing["add_offset"],
+            "_FillValue": PACKED_FILL_VALUE,
+        }
+    return {
+        "filters": [
+            numcodecs.FixedScaleOffset(
+                offset=packing["add_offset"],
+                scale=1 / packing["scale_factor"],
+                dtype=var.dtype.str,
+                astype="<i2",
+            )
+        ]
+    }
+
+
+def check_packing(ds: xr.Dataset, packing: dict[str, dict[str, Any]]) -> None:
+    """
+    Raise a ValueError if any of `ds` can't be packed as described by `packing`:
+    values outside the packed range, or missing values with the filter.
+    """
+    names = [name for name in packing if name in ds.data_vars]
+    stats = dask.compute(
+        {
+            name: (ds[name].min(), ds[name].max(), ds[name].isnull().any())
+            for name in names
+        }
+    )[0]
+    for name, (lo, hi, missing) in stats.items():
+        p = packing[name]
+        if float(lo) < p["valid_min"] or float(hi) > p["valid_max"]:
+            raise ValueError(
+                f"{name} has values in [{float(lo)}, {float(hi)}], outside its "
+                f"packed range [{p['valid_min']}, {p['valid_max']}]"
+            )
+        if p["mode"] == "filter" and bool(missing):
+            raise ValueError(f"{name} has missing values, which can't be packed")
+
+
+@dataclasses.dataclass
+class WriteOptions:
+    """
+    How periods are written to the Zarr store.
+
+    mode
+        ``"append"`` grows the store along ``time``, one period at a time and in
+        order. ``"region"`` writes each period into a store pre-allocated for
+        `region`, so periods can be written in any order by independent workers.
+    region
+        The periods to pre-allocate the store for, with ``mode="region"``.
+    preallocate
+        With ``mode="region"``, pre-allocate the store if it doesn't exist yet.
+        This should be done once, by a single worker, before independent workers
+        start writing; without it, writing to a store that isn't pre-allocated
+        raises.
+    encoding_profile
+        The name of the `ENCODING_PROFILES` entry to use for each variable,
+        unless it's overridden in `variable_encoding_profiles`. Encodings only
+        apply when a store is created.
+    packing
+        ``"none"`` stores floats. ``"cf"`` and ``"filter"`` pack each variable
+        into int16 over its `PACKED_RANGES` range, halving the bytes stored and
+        read; see `packing_parameters` for the error bound and
+        `packing_encoding` for the two representations. Like encodings, packing
+        only applies when a store is created.
+    streaming
+        Write each period one variable at a time, so only one variable's
+        chunks are in memory at once, rather than all of them in one
+        ``to_zarr``. ``time1_bounds``, and ``time`` when appending, are
+        written after the variables. The store is the same, byte for byte.
+        The write that creates the store is never streamed.
+    aggregates
+        Keep daily and monthly aggregates of each appended day in the sibling
+        ``-daily`` and ``-monthly`` stores; see `update_aggregates`. Days
+        rewritten in place by ``--fill-gaps`` are re-aggregated; other region
+        writes aren't aggregated.
+    overviews
+        Keep each variable coarsened by each of `OVERVIEW_FACTORS` in the
+        sibling ``-overview-<factor>x`` stores; see `coarsen_day`. Like the
+        aggregates, they're kept for appended days and days rewritten by
+        ``--fill-gaps``.
+    """
+
+    mode: str = "append"
+    region: pd.PeriodIndex | None = None
+    preallocate: bool = False
+    encoding_profile: str = "default"
+    variable_encoding_profiles: dict[str, str] = dataclasses.field(default_factory=dict)
+    packing: str = "none"
+    streaming: bool = False
+    aggregates: bool = False
+    overviews: bool = False
+
+
+def apply_encoding(ds: xr.Dataset, write_options: WriteOptions) -> xr.Dataset:
+    """
+    Set the encoding for each variable from its profile and packing, and record
+    them in the dataset attrs.
+    """
+    ds = ds.copy()
+    profiles = {}
+    packing = {}
+    for name, var in ds.data_vars.items():
+        if "lat" not in var.dims:
+            continue
+        profile_name = write_options.variable_encoding_profiles.get(
+            str(name), write_options.encoding_profile
+        )
+        profile = ENCODING_PROFILES[profile_name]
+        # CDS packs each file with its own scale and offset, which would be fixed
+        # for the whole store, and overflow, if it were kept.
+        for key in CF_PACKING_KEYS:
+            var.encoding.pop(key, None)
+        var.encoding.update(profile.encoding(var))
+        profiles[name] = {"name": profile_name, **dataclasses.asdict(profile)}
+        if write_options.packing != "none" and name in PACKED_RANGES:
+            packing[name] = packing_parameters(str(name), write_options.packing)
+            var.encoding.update(packing_encoding(var, packing[name]))
+    ds.attrs["era5:encoding_profiles"] = profiles
+    ds.attrs["era5:packing"] = packing
+    return ds
+
+
+def hourly_index(periods: pd.PeriodIndex) -> pd.DatetimeIndex:
+    return pd.date_range(
+        periods[0].start_time, periods[-1].end_time.floor("h"), freq="h"
+    )
+
+
+def make_template(ds: xr.Dataset, periods: pd.PeriodIndex) -> xr.Dataset:
+    """
+    Make a lazy dataset like `ds`, but covering every hour of `periods`.
+
+    Writing it with ``compute=False`` pre-allocates the store: the metadata and
+    coordinates are written, but none of the data chunks.
+    """
+    time = hourly_index(periods)
+    variables = {}
+    for name, var in ds.data_vars.items():
+        shape = (len(time),) + var.shape[1:]
+        data = dask.array.empty(shape, dtype=var.dtype, chunks=(24,) + var.shape[1:])
+        variables[name] = xr.Variable(var.dims, data, var.attrs, var.encoding)
+
+    template = xr.Dataset(
+        variables,
+        coords={"lat": ds.lat, "lon": ds.lon, "time": ("time", time, ds.time.attrs)},
+        attrs=ds.attrs,
+    )
+    template.time.encoding = {**ds.time.encoding, "chunks": (len(time),)}
+    template.attrs["era5:region_start"] = str(periods[0])
+    template.attrs["era5:region_end"] = str(periods[-1])
+    return template
+
+
+def read_region(store) -> pd.PeriodIndex | None:
+    """
+    The periods a store was pre-allocated for, or None for an append store.
+    """
+    try:
+        attrs = json.loads(store[".zattrs"])
+    except KeyError:
+        return None
+    if "era5:region_start" not in attrs:
+        return None
+    return pd.period_range(
+        attrs["era5:region_start"], attrs["era5:region_end"], freq=FREQ
+    )
+
+
+def mark_filled(store, period: pd.Period, entry: dict[str, Any] | None = None) -> None:
+    """
+    Record that `period` was written to a region store, with its manifest `entry`.
+
+    Each period gets its own object, so independent workers don't contend for
+    the manifest; `commit_manifest` folds them into it.
+    """
+    store[f"{SIDECAR}/filled/{period}"] = json.dumps(entry or {}).encode()
+
+
+def filled_periods(store) -> set[pd.Period]:
+    """
+    The periods already written to the store, according to its manifest.
+    """
+    return {pd.Period(day, freq=FREQ) for day in read_manifest(store)["days"]}
+
+
+def preallocate(ds: xr.Dataset, store, region: pd.PeriodIndex) -> bool:
+    """
+    Pre-allocate `store` for `region`, using `ds` as the template for a day.
+
+    The consolidated metadata is written last, so it marks a completed
+    pre-allocation. A store without it, left by a crash partway through, is
+    overwritten. Returns whether the store was pre-allocated by this call.
+    """
+    if ".zmetadata" in store:
+        return False
+    logger.info("Pre-allocating store for %s/%s", region[0], region[-1])
+    make_template(ds, region).to_zarr(store, compute=False, consolidated=True, mode="w")
+    return True
+
+
+def spatial_variables(ds: xr.Dataset) -> list[str]:
+    """
+    The data variables on the lat/lon grid, as opposed to ``time1_bounds``.
+    """
+    return [str(name) for name, var in ds.data_vars.items() if "lat" in var.dims]
+
+
+def write_streaming(ds: xr.Dataset, store, start: int) -> None:
+    """
+    Append `ds` to `store`, whose ``time`` has length `start`, one variable at a
+    time.
+
+    Each variable on the lat/lon grid is grown, computed, written and released
+    before the next, bounding memory by one variable. ``time`` and
+    ``time1_bounds`` are appended last, so an interrupted append leaves
+    ``time`` as it was, for `Journal.recover` to undo. The consolidated
+    metadata is left to the caller.
+    """
+    stop = start + ds.sizes["time"]
+    spatial = spatial_variables(ds)
+    for name in spatial:
+        array = zarr.open_array(store, path=name, mode="r+")
+        array.resize(stop, *array.shape[1:])
+        ds[[name]].drop_vars(["lat", "lon", "time"]).to_zarr(
+            store, region={"time": slice(start, stop)}, consolidated=False
+        )
+    ds.drop_vars(spatial).to_zarr(
+        store, mode="a", append_dim="time", consolidated=False
+    )
+
+
+def write_region(
+    ds: xr.Dataset,
+    period: pd.Period,
+    store,
+    region: pd.PeriodIndex,
+    expver: list[int] | None = None,
+    streaming: bool = False,
+) -> None:
+    """
+    Write one period into its slot of a pre-allocated store.
+
+    Only the chunks for `period` are written; the array metadata isn't touched,
+    so independent workers can write different periods at once. The period's
+    manifest entry is recorded once it's written. With `streaming`, the
+    variables are written one at a time (see `write_streaming`).
+    """
+    if period not in region:
+        raise ValueError(
+            f"{period} is outside the store's range {region[0]}/{region[-1]}"
+        )
+    expected = hourly_index(pd.PeriodIndex([period], freq=FREQ))
+    if not ds.indexes["time"].equals(expected):
+        raise ValueError(f"Unexpected time index for {period}: {ds.indexes['time']}")
+
+    if ".zmetadata" not in store:
+        raise FileNotFoundError(
+            f"The store at {store.root} isn't pre-allocated. Run once with "
+            "--preallocate before writing regions."
+        )
+
+    start = (period.start_time - region[0].start_time) // pd.Timedelta(hours=1)
+    data = ds.drop_vars(["lat", "lon", "time"])
+    if json.loads(store["time/.zarray"])["chunks"][0] != len(expected):
+        # a compacted append store, being filled in place: load the day so Zarr
+        # can update the part of each larger chunk it covers.
+        data = data.load()
+    time_region = {"time": slice(start, start + len(expected))}
+    if streaming:
+        # one variable at a time, leaving time1_bounds for last.
+        for name in spatial_variables(data):
+            data[[name]].to_zarr(store, region=time_region, consolidated=False)
+        data = data.drop_vars(spatial_variables(data))
+    if data.data_vars:
+        data.to_zarr(store, region=time_region, consolidated=False)
+    mark_filled(store, period, manifest_entry(ds, store, expver))
+
+
+def write_period(
+    ds: xr.Dataset,
+    period: pd.Period,
+    output_protocol: str,
+    output_path: str,
+    output_storage_options: dict[str, Any],
+    write_options: WriteOptions | None = None,
+    journal: Journal | None = None,
+    metrics: Metrics | None = None,
+    expver: list[int] | None = None,
+) -> None:
+    """
+    Write one period's dataset to the Zarr store, and record it in the store's
+    manifest along with its `expver` (see `download_expver`).
+
+    Appends must continue the store's ``time`` exactly, from 00:00 of `period`
+    to 23:00.
+
+    The ``write`` span records the dataset's in-memory size as ``logical_bytes``;
+    the compressed size isn't known without listing the store.
+    """
+    write_options = write_options or WriteOptions()
+    metrics = metrics or Metrics()
+    fs = fsspec.filesystem(output_protocol, **output_storage_options)
+    store = fs.get_mapper(output_path)
+    aggregate_stores = [
+        fs.get_mapper(derived_path(output_path, name)) for name in AGGREGATE_STORES
+    ]
+    overview_stores = {
+        factor: fs.get_mapper(derived_path(output_path, f"overview-{factor}x"))
+        for factor in OVERVIEW_FACTORS
+    }
+    if write_options.mode == "region":
+        assert write_options.region is not None
+        if write_options.preallocate and ".zmetadata" not in store:
+            preallocate(apply_encoding(ds, write_options), store, write_options.region)
+        logger.info(
+            "Writing %s to region of %s://%s", period, output_protocol, output_path
+        )
+        packing = json.loads(store.get(".zattrs", b"{}")).get("era5:packing", {})
+        check_packing(ds, packing)
+        with metrics.span("write", period=str(period), mode="region") as span:
+            span["logical_bytes"] = ds.nbytes
+            span["objects"] = n_chunks(ds)
+            write_region(
+                ds,
+                period,
+                store,
+                write_options.region,
+                expver,
+                streaming=write_options.streaming,
+            )
+        if journal is not None:
+            journal.commit(period)
+        if write_options.aggregates:
+            with metrics.span("aggregates", period=str(period)):
+                rewrite_aggregates(ds, period, *aggregate_stores)
+        if write_options.overviews:
+            with metrics.span("overviews", period=str(period)):
+                rewrite_overviews(ds, period, overview_stores)
+        logger.info("Wrote output to %s://%s", output_protocol, output_path)
+        return
+
+    expected = hourly_index(pd.PeriodIndex([period], freq=FREQ))
+    if not ds.indexes["time"].equals(expected):
+        raise ValueError(f"Unexpected time index for {period}: {ds.indexes['time']}")
+    last = read_last_timestamp(store)
+    if period != FIRST_PERIOD and last != expected[0] - pd.Timedelta(hours=1):
+        raise ValueError(
+            f"Can't append {period} to a store ending at {last}. Use --fill-gaps "
+            "for days that are already in the store."
+        )
+
+    kwargs: dict[str, Any] = {"consolidated": True}
+    if period != FIRST_PERIOD:
+        kwargs["mode"] = "a"
+        kwargs["append_dim"] = "time"
+        # appending replaces the store's attrs, so carry over the ETL's own.
+        existing = json.loads(store[".zattrs"])
+        ds = ds.assign_attrs(
+            {k: v for k, v in existing.items() if k.startswith("era5:")}
+        )
+    else:
+        ds = apply_encoding(ds, write_options)
+
+    check_packing(ds, ds.attrs.get("era5:packing", {}))
+    logger.info("Writing output to %s://%s", output_protocol, output_path, extra=kwargs)
+
+    if journal is not None:
+        before = (
+            0
+            if period == FIRST_PERIOD
+            else json.loads(store["time/.zarray"])["shape"][0]
+        )
+        journal.begin(period, before)
+
+    streaming = write_options.streaming and period != FIRST_PERIOD
+    with metrics.span("write", period=str(period), mode="append") as span:
+        span["logical_bytes"] = ds.nbytes
+        span["objects"] = n_chunks(ds)
+        if streaming:
+            write_streaming(ds, store, json.loads(store["time/.zarray"])["shape"][0])
+            zarr.consolidate_metadata(store)
+        else:
+            ds.to_zarr(store, **kwargs)
+        write_high_water_mark(store, pd.Timestamp(ds.indexes["time"][-1]))
+
+    if journal is not None:
+        lengths = time_lengths(store)
+        if set(lengths.values()) != {before + len(ds.time)}:
+            raise RuntimeError(
+                f"Inconsistent lengths after writing {period}: {lengths}"
+            )
+        journal.commit(period)
+    # after the commit, so the manifest never lists a day that recovery undoes.
+    update_manifest(store, {str(period): manifest_entry(ds, store, expver)})
+    if write_options.aggregates:
+        with metrics.span("aggregates", period=str(period)):
+            update_aggregates(ds, period, store, *aggregate_stores)
+    if write_options.overviews:
+        with metrics.span("overviews", period=str(period)):
+            update_overviews(ds, period, store, overview_stores)
+
+    logger.info("Wrote output to %s://%s", output_protocol, output_path)
+
+
+def do_batch(
+    kind: str,
+    periods: pd.PeriodIndex,
+    cds_api_key: str,
+    output_protocol: str,
+    output_path: str,
+    output_storage_options: dict[str, Any],
+    max_concurrent_requests: int = 1,
+    client=None,
+    write_options: WriteOptions | None = None,
+    cache: DownloadCache | None = None,
+    journal: Journal | None = None,
+    metrics: Metrics | None = None,
+    retry_policy: RetryPolicy | None = None,
+    limiter: ConcurrencyLimiter | None = None,
+    broker: CDSBroker | None = None,
+    download_format: str = "netcdf",
+) -> None:
+    """
+    Copy and convert a batch of consecutive days - kind.
+
+    Each variable is downloaded with a single CDS request covering every period
+    in the batch, and then split back into days that are appended in order.
+    """
+    variables = KINDS_TO_VARIABLES[kind]
+    metrics = metrics or Metrics(kind=kind)
+    td = tempfile.TemporaryDirectory()
+    label = str(periods[0]) if len(periods) == 1 else f"{periods[0]}/{periods[-1]}"
+
+    with td:
+        results = fetch_variables(
+            variables,
+            periods,
+            cds_api_key,
+            basedir=td.name,
+            max_concurrent_requests=max_concurrent_requests,
+            client=client,
+            cache=cache,
+            metrics=metrics,
+            retry_policy=retry_policy,
+            limiter=limiter,
+            broker=broker,
+            download_format=download_format,
+        )
+        try:
+            datasets = check_results(results, label)
+            days = zip(*(split_days(ds, periods) for ds in datasets))
+
+            for day in days:
+                period = day[0][0]
+                ds = combine([x for _, x in day], period, metrics)
+                write_period(
+                    ds,
+                    period,
+                    output_protocol,
+                    output_path,
+                    output_storage_options,
+                    write_options=write_options,
+                    journal=journal,
+                    metrics=metrics,
+                    expver=download_expver([x for _, x in day]),
+                )
+        finally:
+            close_datasets([r.dataset for r in results if r.dataset is not None], cache)
+
+
+def do_one(
+    kind: str,
+    period: pd.Period,
+    cds_api_key: str,
+    output_protocol: str,
+    output_path: str,
+    output_storage_options: dict[str, Any],
+    max_concurrent_requests: int = 1,
+    client=None,
+    write_options: WriteOptions | None = None,
+    cache: DownloadCache | None = None,
+    journal: Journal | None = None,
+    metrics: Metrics | None = None,
+    retry_policy: RetryPolicy | None = None,
+    limiter: ConcurrencyLimiter | None = None,
+    broker: CDSBroker | None = None,
+    download_format: str = "netcdf",
+) -> None:
+    """
+    Copy and convert for one day - kind.
+    """
+    do_batch(
+        kind,
+        pd.PeriodIndex([period], freq=FREQ),
+        cds_api_key=cds_api_key,
+        output_protocol=output_protocol,
+        output_path=output_path,
+        output_storage_options=output_storage_options,
+        max_concurrent_requests=max_concurrent_requests,
+        client=client,
+        write_options=write_options,
+        cache=cache,
+        journal=journal,
+        metrics=metrics,
+        retry_policy=retry_policy,
+        limiter=limiter,
+        broker=broker,
+        download_format=download_format,
+    )
+
+
+# Seconds to wait for the pipeline's other stages to stop after an error.
+PIPELINE_JOIN_TIMEOUT = 10
+
+
+class _Stop(Exception):
+    """
+    Raised in a pipeline stage when a later stage has failed.
+    """
+
+
+def _put(q: queue.Queue, item, stop: threading.Event) -> None:
+    while True:
+        if stop.is_set():
+            raise _Stop
+        try:
+            q.put(item, timeout=1)
+            return
+        except queue.Full:
+            pass
+
+
+def _get(q: queue.Queue, stop: threading.Event):
+    while True:
+        if stop.is_set():
+            raise _Stop
+        try:
+            return q.get(timeout=1)
+        except queue.Empty:
+            pass
+
+
+def run_pipeline(
+    kind: str,
+    batches: list[pd.PeriodIndex],
+    cds_api_key: str,
+    output_protocol: str,
+    output_path: str,
+    output_storage_options: dict[str, Any],
+    max_concurrent_requests: int = 1,
+    pipeline_depth: int = 1,
+    client=None,
+    write_options: WriteOptions | None = None,
+    cache: DownloadCache | None = None,
+    journal: Journal | None = None,
+    metrics: Metrics | None = None,
+    retry_policy: RetryPolicy | None = None,
+    limiter: ConcurrencyLimiter | None = None,
+    broker: CDSBroker | None = None,
+    download_format: str = "netcdf",
+) -> None:
+    """
+    Download, transform, and write `batches`, overlapping the stages.
+
+    Downloads run in one thread and transforms in another. They're connected to
+    the writer (this thread) by queues holding at most `pipeline_depth` items, so
+    batch N + 1 downloads while batch N is transformed and written. Each day is
+    loaded into memory by the transform stage; `pipeline_depth` bounds how many
+    are held at once. Days are written strictly in order, so appending along
+    `time` stays correct.
+
+    An error in any stage stops the others and is re-raised here.
+    """
+    metrics = metrics or Metrics(kind=kind)
+    downloaded: queue.Queue = queue.Queue(maxsize=pipeline_depth)
+    transformed: queue.Queue = queue.Queue(maxsize=pipeline_depth)
+    stop = threading.Event()
+    done = object()
+
+    def download():
+        try:
+            for batch in batches:
+                label = f"{batch[0]}/{batch[-1]}"
+                td = tempfile.TemporaryDirectory()
+                results: list[FetchResult] = []
+                try:
+                    results = fetch_variables(
+                        KINDS_TO_VARIABLES[kind],
+                        batch,
+                        cds_api_key,
+                        basedir=td.name,
+                        max_concurrent_requests=max_concurrent_requests,
+                        client=client,
+                        cache=cache,
+                        metrics=metrics,
+                        retry_policy=retry_policy,
+                        limiter=limiter,
+                        broker=broker,
+                        download_format=download_format,
+                    )
+                    datasets = check_results(results, label)
+                except BaseException:
+                    close_datasets(
+                        [r.dataset for r in results if r.dataset is not None], cache
+                    )
+                    td.cleanup()
+                    raise
+                try:
+                    _put(downloaded, (batch, td, datasets), stop)
+                except _Stop:
+                    close_datasets(datasets, cache)
+                    td.cleanup()
+                    raise
+            _put(downloaded, done, stop)
+        except _Stop:
+            pass
+        except BaseException as e:
+            _put(downloaded, e, stop)
+
+    def transform_():
+        try:
+            while True:
+                item = _get(downloaded, stop)
+                if item is done or isinstance(item, BaseException):
+                    _put(transformed, item, stop)
+                    return
+                batch, td, datasets = item
+                with td:
+                    try:
+                        for day in zip(*(split_days(ds, batch) for ds in datasets)):
+                            period = day[0][0]
+                            expver = download_expver([x for _, x in day])
+                            ds = combine([x for _, x in day], period, metrics)
+                            with metrics.span("load", period=str(period)) as span:
+                                ds = ds.load()
+                                span["logical_bytes"] = ds.nbytes
+                            _put(transformed, (period, ds, expver), stop)
+                    finally:
+                        close_datasets(datasets, cache)
+        except _Stop:
+            pass
+        except BaseException as e:
+            _put(transformed, e, stop)
+
+    threads = [
+        threading.Thread(target=download, name="era5-download", daemon=True),
+        threading.Thread(target=transform_, name="era5-transform", daemon=True),
+    ]
+    for thread in threads:
+        thread.start()
+
+    N = sum(len(batch) for batch in batches)
+    i = 0
+    finished = False
+    try:
+        while True:
+            item = transformed.get()
+            if item is done:
+                break
+            if isinstance(item, BaseException):
+                raise item
+            period, ds, expver = item
+            i += 1
+            logger.info("Starting write %s - %s [%d/%d]", kind, period, i, N)
+            write_period(
+                ds,
+                period,
+                output_protocol,
+                output_path,
+                output_storage_options,
+                write_options=write_options,
+                journal=journal,
+                metrics=metrics,
+                expver=expver,
+            )
+            logger.info("Finished %s - %s [%d/%d]", kind, period, i, N)
+        finished = True
+    finally:
+        stop.set()
+        for thread in threads:
+            # after a failure, don't wait on a CDS request that may be queued for
+            # hours. The threads are daemons, and clean up after themselves if
+            # their request does finish.
+            thread.join(None if finished else PIPELINE_JOIN_TIMEOUT)
+            if thread.is_alive():
+                logger.warning("Abandoning %s after an error", thread.name)
+        while True:
+            try:
+                item = downloaded.get_nowait()
+            except queue.Empty:
+                break
+            if isinstance(item, tuple):
+                _, td, datasets = item
+                close_datasets(datasets, cache)
+                td.cleanup()
+
+
+EXECUTORS = ["serial", "processes", "dask"]
+
+
+def backfill_batch(
+    kind: str,
+    periods: pd.PeriodIndex,
+    cds_api_key: str,
+    output_protocol: str,
+    output_path: str,
+    output_storage_options: dict[str, Any],
+    write_options: WriteOptions,
+    max_concurrent_requests: int = 1,
+    client=None,
+    retry: dict[str, Any] | None = None,
+    download_format: str = "netcdf",
+) -> dict[str, Any]:
+    """
+    Download, transform, and write one batch into its region of a pre-allocated
+    store. This is the task `run_backfill` runs on its workers, so everything it
+    takes and returns is picklable.
+
+    Returns the worker's name, the periods, and the time taken.
+    """
+    start = time.perf_counter()
+    do_batch(
+        kind,
+        periods,
+        cds_api_key=cds_api_key,
+        output_protocol=output_protocol,
+        output_path=output_path,
+        output_storage_options=output_storage_options,
+        max_concurrent_requests=max_concurrent_requests,
+        client=client,
+        write_options=write_options,
+        retry_policy=RetryPolicy(**(retry or {})),
+        limiter=ConcurrencyLimiter(max_concurrent_requests),
+        download_format=download_format,
+    )
+    return {
+        "worker": f"{socket.gethostname()}-{os.getpid()}",
+        "periods": [str(period) for period in periods],
+        "seconds": time.perf_counter() - start,
+    }
+
+
+def run_backfill(
+    kind: str,
+    batches: list[pd.PeriodIndex],
+    cds_api_key: str,
+    output_protocol: str,
+    output_path: str,
+    output_storage_options: dict[str, Any],
+    write_options: WriteOptions,
+    workers: int,
+    executor: str = "processes",
+    dask_scheduler: str | None = None,
+    max_concurrent_requests: int = 1,
+    client=None,
+    retry: dict[str, Any] | None = None,
+    download_format: str = "netcdf",
+    metrics: Metrics | None = None,
+) -> dict[str, dict[str, float]]:
+    """
+    Backfill `batches` into a region store from `workers` processes.
+
+    With ``executor="processes"`` the workers are a local process pool; with
+    ``"dask"`` they're the workers of the dask.distributed cluster at
+    `dask_scheduler`, or of a new ``LocalCluster``. Each batch is a task, so
+    workers pick up the next batch as they finish and the backfill scales with
+    the number of workers until CDS's limits are reached.
+    `max_concurrent_requests` applies per worker, and the `retry` settings (the
+    `RetryPolicy` arguments) per batch.
+
+    If the store isn't pre-allocated yet, the first batch is written here, to
+    pre-allocate it, before any tasks are submitted. A batch that fails doesn't
+    stop the others, and isn't marked filled, so it's picked up by the next run.
+    Once every task has finished, this commits the backfill: the high-water mark
+    is set to the end of the filled periods at the start of the region, and the
+    metadata is consolidated.
+
+    Returns each worker's progress: the batches and days it wrote, and the time it took.
+    """
+    assert write_options.mode == "region" and write_options.region is not None
+    metrics = metrics or Metrics(kind=kind)
+    store = fsspec.filesystem(output_protocol, **output_storage_options).get_mapper(
+        output_path
+    )
+    task_kwargs = dict(
+        cds_api_key=cds_api_key,
+        output_protocol=output_protocol,
+        output_path=output_path,
+        output_storage_options=output_storage_options,
+        write_options=write_options,
+        max_concurrent_requests=max_concurrent_requests,
+        client=client,
+        retry=retry,
+        download_format=download_format,
+    )
+    if batches and ".zmetadata" not in store:
+        backfill_batch(kind, batches[0], **task_kwargs)
+        batches = batches[1:]
+
+    submit: Callable[..., Any]
+    if executor == "dask":
+        import distributed
+
+        cluster_client = (
+            distributed.Client(dask_scheduler)
+            if dask_scheduler
+            else distributed.Client(
+                distributed.LocalCluster(n_workers=workers, threads_per_worker=1)
+            )
+        )
+        submit = functools.partial(cluster_client.submit, pure=False)
+        as_completed = distributed.as_completed
+        close = cluster_client.close
+    else:
+        pool = concurrent.futures.ProcessPoolExecutor(
+            workers, mp_context=multiprocessing.get_context("spawn")
+        )
+        submit = pool.submit
+        as_completed = concurrent.futures.as_completed
+        close = pool.shutdown
+
+    N = sum(len(batch) for batch in batches)
+    done = 0
+    progress: dict[str, dict[str, float]] = {}
+    failed = []
+    try:
+        futures = {
+            submit(backfill_batch, kind, batch, **task_kwargs): batch
+            for batch in batches
+        }
+        for future in as_completed(futures):
+            batch = futures[future]
+            try:
+                result = future.result()
+            except Exception:
+                logger.exception("Failed %s %s/%s", kind, batch[0], batch[-1])
+                metrics.count("backfill_failed_days", len(batch))
+                failed.append(batch)
+                continue
+            worker = progress.setdefault(
+                result["worker"], {"batches": 0, "days": 0, "seconds": 0.0}
+            )
+            worker["batches"] += 1
+            worker["days"] += len(batch)
+            worker["seconds"] += result["seconds"]
+            done += len(batch)
+            metrics.count("backfill_days", len(batch), worker=result["worker"])
+            logger.info(
+                "Finished %s - %s/%s on %s [%d/%d]. Worker progress: %s",
+                kind,
+                batch[0],
+                batch[-1],
+                result["worker"],
+                done,
+                N,
+                progress,
+            )
+    finally:
+        close()
+
+    with metrics.span("backfill_commit"):
+        commit_backfill(store, write_options.region)
+    if failed:
+        raise RuntimeError(f"Failed to backfill {[f'{b[0]}/{b[-1]}' for b in failed]}")
+    return progress
+
+
+def commit_backfill(store, region: pd.PeriodIndex) -> pd.Period | None:
+    """
+    Commit a backfill of a region store: fold the days written into the
+    manifest, set the high-water mark to the end of the filled periods at the
+    start of `region`, and consolidate the metadata.
+
+    Returns the last of those periods, or None if the first isn't filled yet.
+    """
+    commit_manifest(store)
+    filled = filled_periods(store)
+    last = None
+    for period in region:
+        if period not in filled:
+            break
+        last = period
+    if last is not None:
+        write_high_water_mark(store, last.end_time.floor("h"))
+    zarr.consolidate_metadata(store)
+    return last
+
+
+def derived_path(output_path: str, name: str) -> str:
+    """
+    The path of a store derived from the one at `output_path`, like
+    ``era5/analysis.zarr`` -> ``era5/analysis-timeseries.zarr``.
+    """
+    root, ext = os.path.splitext(output_path.rstrip("/"))
+    return f"{root}-{name}{ext}"
+
+
+def update_timeseries_replica(
+    source,
+    replica,
+    time_chunk: int = 8760,
+    lat_chunk: int = 32,
+    lon_chunk: int = 32,
+    rows_per_pass: int | None = None,
+    max_bytes: int = 2 * 2**30,
+    flush: bool = False,
+) -> int:
+    """
+    Extend a copy of `source` that's chunked for reading time series.
+
+    The replica is chunked ``(time_chunk, lat_chunk, lon_chunk)``. Only whole
+    `time_chunk`-hour blocks are copied, so each replica chunk is written once;
+    `source` buffers the partial block until it's complete, and readers wanting
+    the most recent hours read them from `source`. Pass ``flush=True`` to also
+    copy the trailing partial block. Its chunks are rewritten, with the rest of
+    the block, on the update that completes it.
+
+    Each block is copied one variable at a time, in bands of `rows_per_pass`
+    latitudes, holding ``time_chunk * rows_per_pass * nlon`` values at once. By
+    default `rows_per_pass` is the largest multiple of `lat_chunk` that fits in
+    `max_bytes`: 32 rows, about 1.6 GB, for a year of the full grid. Each band
+    reads whole daily chunks from `source`, so a block's data are read about
+    ``nlat / rows_per_pass`` times; a larger `max_bytes` reads less.
+
+    Returns the number of hours copied.
+    """
+    ds = xr.open_zarr(source, consolidated=True)
+    if rows_per_pass is None:
+        itemsize = max(v.dtype.itemsize for v in ds.data_vars.values())
+        row_bytes = time_chunk * ds.sizes["lon"] * itemsize
+        rows_per_pass = max(max_bytes // row_bytes // lat_chunk, 1) * lat_chunk
+    if rows_per_pass % lat_chunk:
+        raise ValueError("rows_per_pass must be a multiple of lat_chunk")
+    total = ds.sizes["time"]
+    try:
+        (start,) = json.loads(replica["time/.zarray"])["shape"]
+    except KeyError:
+        start = 0
+    copied = 0
+
+    while True:
+        # copy up to the next chunk boundary, which a flushed partial block may offset.
+        boundary = (start // time_chunk + 1) * time_chunk
+        if total < boundary and not (flush and total > start):
+            break
+        n = min(boundary, total) - start
+        logger.info("Copying hours %d-%d to the time series replica", start, start + n)
+        block = ds.isel(time=slice(start, start + n))
+        for var in block.variables.values():
+            var.encoding.pop("preferred_chunks", None)
+            if var.dims == ("time", "lat", "lon"):
+                var.encoding["chunks"] = (time_chunk, lat_chunk, lon_chunk)
+            elif var.dims[:1] == ("time",):
+                var.encoding["chunks"] = (time_chunk,) + var.shape[1:]
+
+        # Grow the arrays and write the coordinates, but none of the data, so
+        # the source's dask chunks not lining up with the replica's is fine.
+        kwargs: dict[str, Any] = {"compute": False, "safe_chunks": False}
+        if start == 0:
+            block.to_zarr(replica, mode="w-", consolidated=True, **kwargs)
+        else:
+            block.to_zarr(
+                replica, mode="a", append_dim="time", consolidated=True, **kwargs
+            )
+
+        region = slice(start, start + n)
+        gridded = [k for k, v in block.data_vars.items() if "lat" in v.dims]
+        others = [k for k, v in block.data_vars.items() if "lat" not in v.dims]
+        if others:
+            block[others].drop_vars(["time"]).load().to_zarr(
+                replica, region={"time": region}, consolidated=False
+            )
+        for i in range(0, block.sizes["lat"], rows_per_pass):
+            band = slice(i, i + rows_per_pass)
+            for name in gridded:
+                block[[name]].isel(lat=band).drop_vars(
+                    ["time", "lat", "lon"]
+                ).load().to_zarr(
+                    replica, region={"time": region, "lat": band}, consolidated=False
+                )
+
+        start += n
+        copied += n
+
+    return copied
+
+
+# The reductions over time kept in the aggregate stores, with their CF cell method.
+REDUCTIONS = {"mean": "mean", "min": "minimum", "max": "maximum", "sum": "sum"}
+AGGREGATE_STORES = ["daily", "monthly"]
+ACCUMULATOR = f"{SIDECAR}/accumulator.json"
+
+
+def aggregations(name: str) -> list[str]:
+    """
+    The reductions kept for variable `name` in the aggregate stores: the sum of
+    an accumulation, the extreme of an hourly maximum or minimum, and the mean,
+    minimum and maximum of anything else.
+    """
+    if name.endswith("_Accumulation"):
+        return ["sum"]
+    if name.endswith("_Maximum"):
+        return ["max"]
+    if name.endswith("_Minimum"):
+        return ["min"]
+    return ["mean", "min", "max"]
+
+
+def reduce_time(values: np.ndarray, stat: str) -> np.ndarray:
+    """
+    Reduce `values` over its first axis, keeping it. Means and sums are taken in
+    float64. Missing values (sea surface temperature over land) stay missing.
+    """
+    if stat in ("mean", "sum"):
+        return getattr(np, stat)(values, axis=0, dtype="float64", keepdims=True)
+    return getattr(np, stat)(values, axis=0, keepdims=True)
+
+
+def aggregate_dataset(
+    like: xr.Dataset,
+    time: pd.Timestamp,
+    arrays: dict[str, np.ndarray],
+    attrs: dict[str, dict[str, Any]],
+) -> xr.Dataset:
+    """
+    A single time step of aggregates on `like`'s grid.
+    """
+    return xr.Dataset(
+        {
+            name: (("time", "lat", "lon"), values.astype("float32"), attrs[name])
+            for name, values in arrays.items()
+        },
+        coords={
+            "time": ("time", [time], like.time.attrs),
+            "lat": like.lat,
+            "lon": like.lon,
+        },
+        attrs={k: v for k, v in like.attrs.items() if not k.startswith("era5:")},
+    )
+
+
+def daily_aggregates(ds: xr.Dataset, period: pd.Period) -> xr.Dataset:
+    """
+    The `aggregations` of each variable over the day `period` of hourly `ds`.
+
+    Each variable is loaded once, reduced with NumPy, and released before the
+    next.
+    """
+    arrays = {}
+    attrs = {}
+    for name in spatial_variables(ds):
+        values = ds[name].values
+        for stat in aggregations(name):
+            key = f"{name}_{stat}"
+            arrays[key] = reduce_time(values, stat)
+            attrs[key] = {**ds[name].attrs, "cell_methods": f"time: {REDUCTIONS[stat]}"}
+        del values
+    return aggregate_dataset(ds, period.start_time, arrays, attrs)
+
+
+def accumulate(accumulator: dict[str, np.ndarray], daily: xr.Dataset) -> None:
+    """
+    Fold a day's aggregates into a month's running `accumulator`: the sums of
+    the daily means and sums, and the extremes of the daily extremes.
+    """
+    for name, var in daily.data_vars.items():
+        stat = str(name).rsplit("_", 1)[1]
+        values = var.values
+        if name not in accumulator:
+            accumulator[str(name)] = values.astype(
+                "float64" if stat in ("mean", "sum") else values.dtype
+            )
+        elif stat == "min":
+            np.minimum(accumulator[str(name)], values, out=accumulator[str(name)])
+        elif stat == "max":
+            np.maximum(accumulator[str(name)], values, out=accumulator[str(name)])
+        else:
+            accumulator[str(name)] += values
+
+
+def monthly_aggregates(
+    daily: xr.Dataset, month: pd.Period, accumulator: dict[str, np.ndarray]
+) -> xr.Dataset:
+    """
+    The month's aggregates from its complete `accumulator`. Every day has 24
+    hours, so the monthly mean is the mean of the daily means.
+    """
+    arrays = {
+        name: values / month.days_in_month if name.endswith("_mean") else values
+        for name, values in accumulator.items()
+    }
+    attrs = {name: daily[name].attrs for name in arrays}
+    return aggregate_dataset(daily, month.start_time, arrays, attrs)
+
+
+def read_accumulator(store) -> tuple[dict[str, Any] | None, dict[str, np.ndarray]]:
+    """
+    The state of the month being accumulated in the monthly `store`, and its
+    arrays. The state is None for a new store.
+    """
+    try:
+        state = json.loads(store[ACCUMULATOR])
+    except KeyError:
+        return None, {}
+    if state["arrays"] is None:
+        return state, {}
+    with np.load(io.BytesIO(store[state["arrays"]])) as f:
+        return state, dict(f)
+
+
+def write_accumulator(
+    store, state: dict[str, Any], accumulator: dict[str, np.ndarray]
+) -> None:
+    """
+    Save the month's `accumulator`, through `state`, last accumulated day.
+
+    The arrays go to a new object that's switched to once it's written, so an
+    interrupted update leaves the previous day's accumulator in place.
+    """
+    previous, _ = read_accumulator(store)
+    state = {**state, "arrays": None}
+    if accumulator:
+        state["arrays"] = f"{SIDECAR}/accumulator/{state['last']}.npz"
+        buffer = io.BytesIO()
+        np.savez(buffer, **accumulator)
+        store[state["arrays"]] = buffer.getvalue()
+    store[ACCUMULATOR] = json.dumps(state).encode()
+    if previous and previous["arrays"] not in (None, state["arrays"]):
+        del store[previous["arrays"]]
+
+
+def append_derived(ds: xr.Dataset, store) -> None:
+    """
+    Append `ds` along ``time`` to a store derived from the hourly one, creating
+    it if needed. Each call's data are one chunk.
+    """
+    if ".zmetadata" in store:
+        # appending replaces the store's attrs, so carry over the ETL's own.
+        existing = json.loads(store[".zattrs"])
+        ds = ds.assign_attrs(
+            {k: v for k, v in existing.items() if k.startswith("era5:")}
+        )
+        ds.to_zarr(store, mode="a", append_dim="time", consolidated=True)
+    else:
+        encoding = {name: {"chunks": var.shape} for name, var in ds.data_vars.items()}
+        # a store without consolidated metadata is left from an interrupted create.
+        ds.assign_attrs({"era5:start": str(ds.indexes["time"][0])}).to_zarr(
+            store, mode="w", encoding=encoding, consolidated=True
+        )
+    write_high_water_mark(store, pd.Timestamp(ds.indexes["time"][-1]))
+
+
+def update_aggregates(
+    ds: xr.Dataset, period: pd.Period, store, daily_store, monthly_store
+) -> None:
+    """
+    Append the aggregates of `period`, just appended to `store` as `ds`, to the
+    daily store, and to the monthly store if it completes a month.
+
+    A month is accumulated a day at a time, in a running accumulator kept in
+    the monthly store, so completing it doesn't read the month again. A month
+    that started before the aggregates did is incomplete, and skipped.
+
+    Days missing from the daily store or the accumulator after an interrupted
+    run are caught up first, from the daily store or, failing that, `store`.
+    """
+    last = read_last_timestamp(daily_store)
+    daily_last = None if last is None else pd.Period(last, freq=FREQ)
+    if daily_last is not None and daily_last > period:
+        return
+    state, accumulator = read_accumulator(monthly_store)
+    accumulated = None if state is None else pd.Period(state["last"], freq=FREQ)
+
+    starts = [period]
+    if daily_last is not None:
+        starts.append(daily_last + 1)
+    if accumulated is not None:
+        starts.append(accumulated + 1)
+    for day in pd.period_range(min(starts), period, freq=FREQ):
+        if day == period:
+            daily = daily_aggregates(ds, day)
+        elif daily_last is not None and day <= daily_last:
+            daily = xr.open_zarr(daily_store).sel(time=[day.start_time]).load()
+        else:
+            logger.info("Catching up the aggregates for %s", day)
+            hourly = xr.open_zarr(store, consolidated=True)
+            daily = daily_aggregates(
+                hourly.sel(time=slice(day.start_time, day.end_time)), day
+            )
+        if daily_last is None or day > daily_last:
+            append_derived(daily, daily_store)
+        if accumulated is not None and day <= accumulated:
+            continue
+
+        month = day.asfreq("M")
+        if state is None or state["month"] != str(month):
+            state = {"month": str(month), "days": 0}
+            accumulator = {}
+        accumulate(accumulator, daily)
+        state = {**state, "days": state["days"] + 1, "last": str(day)}
+        if day == month.asfreq(FREQ, how="end"):
+            if state["days"] != month.days_in_month:
+                logger.warning(
+                    "Skipping the monthly aggregates for %s, which has %d/%d days",
+                    month,
+                    state["days"],
+                    month.days_in_month,
+                )
+            elif (read_last_timestamp(monthly_store) or pd.Timestamp.min) < (
+                month.start_time
+            ):
+                append_derived(
+                    monthly_aggregates(daily, month, accumulator), monthly_store
+                )
+            accumulator = {}
+        write_accumulator(monthly_store, state, accumulator)
+
+
+def derived_start(store) -> pd.Timestamp:
+    """
+    The first time in a store written by `append_derived`.
+    """
+    return pd.Timestamp(json.loads(store[".zattrs"])["era5:start"])
+
+
+def rewrite_aggregates(
+    ds: xr.Dataset, period: pd.Period, daily_store, monthly_store
+) -> None:
+    """
+    Replace the aggregates of `period`, rewritten in place in the hourly store
+    as `ds` (by ``--fill-gaps``), if they were already computed.
+
+    The day is rewritten in the daily store. Its month is recomputed from the
+    daily store, not the hourly one: rewritten in the monthly store if it's
+    complete, or re-accumulated if it's in progress.
+    """
+    last = read_last_timestamp(daily_store)
+    if last is None or not derived_start(daily_store) <= period.start_time <= last:
+        return
+    logger.info("Rewriting the aggregates for %s", period)
+    i = (period - pd.Period(derived_start(daily_store), freq=FREQ)).n
+    daily_aggregates(ds, period).drop_vars(["lat", "lon", "time"]).to_zarr(
+        daily_store, region={"time": slice(i, i + 1)}, consolidated=False
+    )
+
+    month = period.asfreq("M")
+    state, _ = read_accumulator(monthly_store)
+    if state is not None and state["month"] == str(month):
+        end = pd.Period(state["last"], freq=FREQ).end_time
+    else:
+        end = month.end_time
+    days = xr.open_zarr(daily_store).sel(time=slice(month.start_time, end))
+    accumulator: dict[str, np.ndarray] = {}
+    for t in range(days.sizes["time"]):
+        accumulate(accumulator, days.isel(time=[t]).load())
+
+    monthly_last = read_last_timestamp(monthly_store)
+    if monthly_last is not None and month.start_time <= monthly_last:
+        j = (month - pd.Period(derived_start(monthly_store), freq="M")).n
+        monthly_aggregates(days, month, accumulator).drop_vars(
+            ["lat", "lon", "time"]
+        ).to_zarr(monthly_store, region={"time": slice(j, j + 1)}, consolidated=False)
+    elif state is not None and state["month"] == str(month):
+        write_accumulator(monthly_store, state, accumulator)
+
+
+# The coarsening factors of the overview pyramid.
+OVERVIEW_FACTORS = [2, 4, 8]
+
+
+def overview_reduction(name: str) -> str:
+    """
+    The block reduction for variable `name` in the overviews: the extreme of an
+    hourly maximum or minimum, and the mean of anything else.
+    """
+    if name.endswith("_Maximum"):
+        return "max"
+    if name.endswith("_Minimum"):
+        return "min"
+    return "mean"
+
+
+def coarsen_day(ds: xr.Dataset, factors: list[int]) -> dict[int, xr.Dataset]:
+    """
+    Coarsen the variables on the lat/lon grid of `ds` by each of `factors`.
+
+    Each variable is loaded once, reduced to every level, and released before
+    the next. The last row of blocks is padded (721 latitudes don't divide
+    evenly), so its latitude is the block's mean, not a whole step on. Missing
+    values (sea surface temperature over land) are skipped, so a coastal block
+    is the mean of its sea.
+    """
+    levels: dict[int, dict[str, xr.DataArray]] = {factor: {} for factor in factors}
+    for name in spatial_variables(ds):
+        var = ds[name].load()
+        stat = overview_reduction(name)
+        for factor in factors:
+            coarse = getattr(
+                var.coarsen(lat=factor, lon=factor, boundary="pad"), stat
+            )()
+            coarse.attrs = {**var.attrs, "cell_methods": f"area: {REDUCTIONS[stat]}"}
+            levels[factor][name] = coarse.astype("float32")
+        del var
+    attrs = {k: v for k, v in ds.attrs.items() if not k.startswith("era5:")}
+    return {
+        factor: xr.Dataset(variables, attrs={**attrs, "era5:overview_factor": factor})
+        for factor, variables in levels.items()
+    }
+
+
+def update_overviews(
+    ds: xr.Dataset, period: pd.Period, store, overview_stores: dict[int, Any]
+) -> None:
+    """
+    Append `period`, just appended to `store` as `ds`, to each of the
+    `overview_stores`, keyed by coarsening factor.
+
+    Days an overview missed after an interrupted run are caught up first, from
+    `store`.
+    """
+    starts = {}
+    for factor, overview_store in overview_stores.items():
+        last = read_last_timestamp(overview_store)
+        starts[factor] = period if last is None else pd.Period(last, freq=FREQ) + 1
+    for day in pd.period_range(min(starts.values()), period, freq=FREQ):
+        if day == period:
+            day_ds = ds
+        else:
+            logger.info("Catching up the overviews for %s", day)
+            day_ds = xr.open_zarr(store, consolidated=True).sel(
+                time=slice(day.start_time, day.end_time)
+            )
+        factors = [factor for factor, start in starts.items() if start <= day]
+        for factor, coarse in coarsen_day(day_ds, factors).items():
+            append_derived(coarse, overview_stores[factor])
+
+
+def rewrite_overviews(
+    ds: xr.Dataset, period: pd.Period, overview_stores: dict[int, Any]
+) -> None:
+    """
+    Replace `period` in each of the `overview_stores` that has it, after it was
+    rewritten in place in the hourly store as `ds` (by ``--fill-gaps``).
+    """
+    factors = []
+    for factor, overview_store in overview_stores.items():
+        last = read_last_timestamp(overview_store)
+        if (
+            last is not None
+            and derived_start(overview_store) <= period.start_time <= last
+        ):
+            factors.append(factor)
+    for factor, coarse in coarsen_day(ds, factors).items():
+        overview_store = overview_stores[factor]
+        start = (period.start_time - derived_start(overview_store)) // pd.Timedelta(
+            hours=1
+        )
+        coarse.drop_vars(["lat", "lon", "time"]).to_zarr(
+            overview_store,
+            region={"time": slice(start, start + coarse.sizes["time"])},
+            consolidated=False,
+        )
+
+
+HIGH_WATER_MARK = f"{SIDECAR}/high_water_mark.json"
+
+
+def write_high_water_mark(store, last: pd.Timestamp) -> None:
+    """
+    Record the last timestamp written, along with the length of ``time`` it's valid for.
+    """
+    (n,) = json.loads(store["time/.zarray"])["shape"]
+    store[HIGH_WATER_MARK] = json.dumps(
+        {"last": last.isoformat(), "time_length": n}
+    ).encode()
+
+
+def read_last_timestamp(store) -> pd.Timestamp | None:
+    """
+    The last timestamp in a store, or None if nothing has been written.
+
+    This reads the high-water mark object, checked against the shape of ``time``,
+    and falls back to reading only the last chunk of ``time``. Unlike opening the
+    dataset, that's a few small GETs regardless of how long the record is.
+    """
+    try:
+        meta = json.loads(store["time/.zarray"])
+    except KeyError:
+        return None
+    (n,) = meta["shape"]
+    if n == 0:
+        return None
+
+    try:
+        mark = json.loads(store[HIGH_WATER_MARK])
+    except KeyError:
+        mark = {}
+    if mark.get("time_length") == n:
+        return pd.Timestamp(mark["last"])
+
+    logger.info("High-water mark missing or stale. Reading the last 'time' chunk")
+    array = zarr.open_array(store, path="time", mode="r")
+    attrs = array.attrs.asdict()
+    value = np.asarray([array[n - 1]])
+    decoded = xr.coding.times.decode_cf_datetime(
+        value, attrs["units"], attrs.get("calendar", "standard")
+    )
+    return pd.Timestamp(decoded[0])
+
+
+MANIFEST = f"{SIDECAR}/manifest.json"
+# The expver of ERA5T, the preliminary data that's replaced by ERA5 a few months on.
+PRELIMINARY_EXPVER = 5
+
+
+def download_expver(datasets: list[xr.Dataset]) -> list[int] | None:
+    """
+    The experiment versions in a period's downloads, or None if CDS left them out.
+    """
+    values: set[int] = set()
+    for ds in datasets:
+        if "expver" in ds.variables:
+            values.update(int(v) for v in np.unique(ds["expver"].values))
+    return sorted(values) or None
+
+
+def stored_encodings(store) -> dict[str, dict[str, Any]]:
+    """
+    The dtype, filters, fill value, and CF packing of each array in the store,
+    from its consolidated metadata.
+    """
+    metadata = json.loads(store[".zmetadata"])["metadata"]
+    encodings = {}
+    for key, zarray in metadata.items():
+        if not key.endswith("/.zarray"):
+            continue
+        name = key[: -len("/.zarray")]
+        attrs = metadata.get(f"{name}/.zattrs", {})
+        encodings[name] = {
+            "dtype": np.dtype(zarray["dtype"]),
+            "filters": [numcodecs.get_codec(f) for f in zarray["filters"] or []],
+            "_FillValue": zarray["fill_value"],
+            **{k: attrs[k] for k in ["scale_factor", "add_offset"] if k in attrs},
+        }
+    return encodings
+
+
+def as_stored(var: xr.DataArray, encoding: dict[str, Any] | None) -> np.ndarray:
+    """
+    The values of `var` as they read back from an array with `encoding` (from
+    `stored_encodings`), so checksums of what's written match what's read.
+    """
+    values = np.asarray(var.values)
+    if encoding is None:
+        return values
+    for f in encoding["filters"]:
+        values = np.asarray(f.decode(f.encode(values))).reshape(values.shape)
+    if values.dtype.kind == "f" and encoding["dtype"].kind == "i":
+        cf = {
+            k: encoding[k]
+            for k in ["dtype", "_FillValue", "scale_factor", "add_offset"]
+            if k in encoding
+        }  # noqa: E501
+        variable = xr.Variable(var.dims, values, encoding=cf)
+        values = xr.conventions.decode_cf_variable(
+            var.name, xr.conventions.encode_cf_variable(variable)
+        ).values
+    return values
+
+
+def day_checksum(ds: xr.Dataset, encodings: dict[str, dict[str, Any]]) -> str:
+    """
+    The SHA-256 digest of a day's data variables, as read back from the store.
+    """
+    h = hashlib.sha256()
+    for name in sorted(map(str, ds.data_vars)):
+        h.update(name.encode())
+        values = as_stored(ds[name], encodings.get(name))
+        h.update(np.ascontiguousarray(values).tobytes())
+    return h.hexdigest()
+
+
+def manifest_entry(
+    ds: xr.Dataset, store, expver: list[int] | None = None
+) -> dict[str, Any]:
+    """
+    The manifest's record of a day written from `ds` to `store`: the hours present,
+    the experiment versions, the size in memory, and the checksum.
+    """
+    return {
+        "hours": len(ds.time),
+        "expver": expver,
+        "bytes": ds.nbytes,
+        "checksum": day_checksum(ds, stored_encodings(store)),
+    }
+
+
+def read_manifest(store) -> dict[str, Any]:
+    """
+    The store's manifest: which days it has, with their hours, experiment
+    versions, sizes, and checksums, by day.
+
+    This is ``_era5/manifest.json``, plus the days written to a region store
+    that `commit_manifest` hasn't folded into it yet.
+    """
+    try:
+        manifest = json.loads(store[MANIFEST])
+    except KeyError:
+        manifest = {"version": 1, "days": {}}
+    try:
+        paths = store.fs.ls(f"{store.root}/{SIDECAR}/filled", detail=False)
+    except FileNotFoundError:
+        paths = []
+    if paths:
+        for path, data in store.fs.cat(paths).items():
+            day = path.rstrip("/").rsplit("/", 1)[-1]
+            # markers from before the manifest are empty.
+            manifest["days"][day] = json.loads(data or b"{}") or {"hours": 24}
+    return manifest
+
+
+def update_manifest(store, days: dict[str, dict[str, Any]]) -> None:
+    """
+    Add `days` to the store's manifest, replacing it in one PUT.
+
+    Only one process should update a store's manifest at a time: the appender,
+    or the coordinator of a backfill.
+    """
+    try:
+        manifest = json.loads(store[MANIFEST])
+    except KeyError:
+        manifest = {"version": 1, "days": {}}
+    manifest["days"].update(days)
+    manifest["days"] = dict(sorted(manifest["days"].items()))
+    write_json(store.fs, f"{store.root}/{MANIFEST}", manifest)
+
+
+def commit_manifest(store) -> None:
+    """
+    Fold the days written to a region store into its manifest, and remove their
+    markers. Like `update_manifest`, this is for a single coordinating process.
+    """
+    manifest = read_manifest(store)
+    update_manifest(store, manifest["days"])
+    try:
+        store.fs.rm(f"{store.root}/{SIDECAR}/filled", recursive=True)
+    except FileNotFoundError:
+        pass
+
+
+def rebuild_manifest(store) -> dict[str, Any]:
+    """
+    Add the days missing from the store's manifest, such as those of a store
+    written before manifests, from its ``time`` coordinate. Their sizes,
+    checksums, and experiment versions aren't known, so they're recorded as None.
+    """
+    existing = read_manifest(store)["days"]
+    time = xr.open_zarr(store, consolidated=True).indexes["time"]
+    hours = pd.Series(1, index=time).groupby(time.floor("D")).count()
+    days = {
+        str(pd.Period(day, freq=FREQ)): {
+            "hours": int(n),
+            "expver": None,
+            "bytes": None,
+            "checksum": None,
+        }
+        for day, n in hours.items()
+        if str(pd.Period(day, freq=FREQ)) not in existing
+    }
+    update_manifest(store, days)
+    return read_manifest(store)
+
+
+def find_gaps(
+    store, periods: pd.PeriodIndex, preliminary: bool = True
+) -> pd.PeriodIndex:
+    """
+    The days of `periods` that the store's manifest doesn't have all 24 hours of,
+    and, if `preliminary`, those with preliminary (ERA5T) data.
+    """
+    days = read_manifest(store)["days"]
+    gaps = []
+    for period in periods:
+        entry = days.get(str(period))
+        if (
+            entry is None
+            or entry["hours"] != 24
+            or (preliminary and PRELIMINARY_EXPVER in (entry.get("expver") or []))
+        ):
+            gaps.append(period)
+    return pd.PeriodIndex(gaps, freq=FREQ)
+
+
+def verify_manifest(store, periods: pd.PeriodIndex | None = None) -> list[pd.Period]:
+    """
+    The days (of `periods`, or all of them) whose data in the store doesn't match
+    the manifest's checksum. Days without a checksum are skipped.
+    """
+    days = read_manifest(store)["days"]
+    ds = xr.open_zarr(store, consolidated=True)
+    if periods is None:
+        periods = pd.PeriodIndex(sorted(days), freq=FREQ)
+    bad = []
+    for period in periods:
+        entry = days.get(str(period), {})
+        if not entry.get("checksum"):
+            continue
+        day = ds.sel(time=slice(period.start_time, period.end_time))
+        if day_checksum(day, {}) != entry["checksum"]:
+            logger.warning("Checksum mismatch for %s", period)
+            bad.append(period)
+    return bad
+
+
+def fill_gaps(
+    kind: str,
+    cds_api_key: str,
+    output_protocol: str,
+    output_path: str,
+    output_storage_options: dict[str, Any],
+    max_concurrent_requests: int = 1,
+    days_per_request: int = 1,
+    client=None,
+    write_options: WriteOptions | None = None,
+    cache: DownloadCache | None = None,
+    metrics: Metrics | None = None,
+    retry_policy: RetryPolicy | None = None,
+    limiter: ConcurrencyLimiter | None = None,
+    download_format: str = "netcdf",
+) -> pd.PeriodIndex:
+    """
+    Download and write, in place, the days of an append store that its manifest
+    is missing, or has incomplete or preliminary (ERA5T) data for.
+
+    A store without a manifest gets one built from its ``time`` coordinate first.
+    Returns the days that were filled.
+    """
+    write_options = write_options or WriteOptions()
+    store = fsspec.filesystem(output_protocol, **output_storage_options).get_mapper(
+        output_path
+    )
+    if MANIFEST not in store:
+        logger.info("Building a manifest for %s://%s", output_protocol, output_path)
+        rebuild_manifest(store)
+
+    # days are written by their offset from the start, so check there are no jumps.
+    time = xr.open_zarr(store, consolidated=True).indexes["time"]
+    expected = pd.date_range(FIRST_PERIOD.start_time, periods=len(time), freq="h")
+    if not time.equals(expected):
+        raise ValueError(f"The time coordinate of {output_path} isn't contiguous")
+    region = pd.period_range(FIRST_PERIOD, time[-1].floor("D"), freq=FREQ)
+    gaps = find_gaps(store, region)
+    logger.info("Filling %d gaps in %s", len(gaps), output_path)
+
+    for batch in batch_periods(gaps, days_per_request):
+        do_batch(
+            kind,
+            batch,
+            cds_api_key=cds_api_key,
+            output_protocol=output_protocol,
+            output_path=output_path,
+            output_storage_options=output_storage_options,
+            max_concurrent_requests=max_concurrent_requests,
+            client=client,
+            write_options=dataclasses.replace(
+                write_options, mode="region", region=region, preallocate=False
+            ),
+            cache=cache,
+            metrics=metrics,
+            retry_policy=retry_policy,
+            limiter=limiter,
+            download_format=download_format,
+        )
+    commit_manifest(store)
+    return gaps
+
+
+def determine_next_period(
+    output_protocol, output_path, output_storage_options
+) -> tuple[pd.Timestamp, pd.Period]:
+    """
+    Determine the next period to fetch, based on what's present in storage and the present date.
+    """
+    store = fsspec.filesystem(output_protocol, **output_storage_options).get_mapper(
+        output_path
+    )
+    dt = read_last_timestamp(store)
+    if dt is None:
+        # initial write to this
+        return FIRST_LAST_DATETIME, FIRST_PERIOD
+
+    hour = pd.Timedelta(hours=1)
+    if dt.hour != 23:
+        raise ValueError(f"Last hour written '{dt.hour}' is not 23! Check on the data.")
+
+    period = pd.Period(dt + hour, freq=FREQ)
+    return dt, period
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "kind",
+        nargs="+",
+        choices=["forecast", "analysis"],
+        help="The kinds to ingest. Several kinds are ingested concurrently.",
+    )
+    parser.add_argument(
+        "--credential", type=str, default=os.environ.get("ETL_CREDENTIAL")
+    )
+    parser.add_argument("--output-protocol", type=str, default="abfs")
+    parser.add_argument("--output-path", type=str, default=None)
+    # parser.add_argument("--output-storage_options", type=str)
+    parser.add_argument("--cds-api-key", default=os.environ.get("ETL_CDS_API_KEY"))
+    parser.add_argument("--start-period", default=None)
+    parser.add_argument("--end-period", default=None)
+    parser.add_argument(
+        "--max-concurrent-requests",
+        type=int,
+        default=4,
+        help="Number of CDS requests (one per variable) to run at once for each period.",
+    )
+    parser.add_argument("--retry-max-attempts", type=int, default=10)
+    parser.add_argument(
+        "--retry-base-delay",
+        type=float,
+        default=5.0,
+        help="Seconds. Retry delays grow exponentially from this, with jitter.",
+    )
+    parser.add_argument(
+        "--retry-budget",
+        type=int,
+        default=None,
+        help="The most retries for the whole run, across every request.",
+    )
+    parser.add_argument(
+        "--days-per-request",
+        type=int,
+        default=31,
+        help="Maximum number of days (within one month) to fetch in a single CDS request.",
+    )
+    parser.add_argument(
+        "--pipeline-depth",
+        type=int,
+        default=1,
+        help=(
+            "Number of downloaded / transformed batches to queue between stages. "
+            "0 disables pipelining, running download, transform, and write serially."
+        ),
+    )
+    parser.add_argument(
+        "--write-mode",
+        choices=["append", "region"],
+        default="append",
+        help=(
+            "'append' grows the store along time, in order. 'region' pre-allocates "
+            "the store for --region-start/--region-end and fills in missing days."
+        ),
+    )
+    parser.add_argument("--region-start", default=None)
+    parser.add_argument("--region-end", default=None)
+    parser.add_argument(
+        "--preallocate",
+        action="store_true",
+        help=(
+            "With --write-mode=region, pre-allocate the store if needed. Run this "
+            "once, from one worker, before starting parallel workers."
+        ),
+    )
+    parser.add_argument(
+        "--worker-id",
+        default=socket.gethostname(),
+        help="Names this worker's journal in --write-mode=region.",
+    )
+    parser.add_argument(
+        "--encoding-profile",
+        choices=list(ENCODING_PROFILES),
+        default="default",
+        help="Compressor and chunking for new stores. See benchmark.py to compare them.",
+    )
+    parser.add_argument(
+        "--variable-encoding-profile",
+        default=[],
+        action="append",
+        help="Per-variable override of --encoding-profile, like 'sea_surface_temperature=zstd'.",
+    )
+    parser.add_argument(
+        "--packing",
+        choices=PACKINGS,
+        default="none",
+        help=(
+            "Pack variables into int16 when creating the store: 'cf' with CF "
+            "scale_factor / add_offset attributes, 'filter' with a numcodecs "
+            "FixedScaleOffset filter. See PACKED_RANGES for the packed ranges."
+        ),
+    )
+    parser.add_argument(
+        "--streaming-writes",
+        action="store_true",
+        help=(
+            "Write each day one variable at a time, bounding memory by one "
+            "variable-day. The store is the same as without it."
+        ),
+    )
+    parser.add_argument(
+        "--aggregates",
+        action="store_true",
+        help=(
+            "Keep daily and monthly means, minima, maxima, and sums in "
+            "<output-path>-daily.zarr and <output-path>-monthly.zarr."
+        ),
+    )
+    parser.add_argument(
+        "--overviews",
+        action="store_true",
+        help=(
+            "Keep each variable coarsened 2x, 4x, and 8x, for maps, in "
+            "<output-path>-overview-<factor>x.zarr."
+        ),
+    )
+    parser.add_argument(
+        "--cache-dir",
+        default=os.environ.get("ETL_CACHE_DIR"),
+        help="Directory to cache CDS downloads in, so re-runs don't download again.",
+    )
+    parser.add_argument(
+        "--cache-max-bytes",
+        type=lambda x: int(float(x)),
+        default=50 * 2**30,
+        help="Size limit for --cache-dir. Least-recently-used files are evicted.",
+    )
+    parser.add_argument(
+        "--executor",
+        choices=EXECUTORS,
+        default="serial",
+        help=(
+            "With --write-mode=region, spread the batches over --workers processes "
+            "('processes') or dask.distributed workers ('dask')."
+        ),
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=os.cpu_count(),
+        help="The number of workers for --executor.",
+    )
+    parser.add_argument(
+        "--dask-scheduler",
+        default=None,
+        help=(
+            "The address of the dask.distributed scheduler for --executor=dask. By "
+            "default a LocalCluster is started."
+        ),
+    )
+    parser.add_argument(
+        "--download-format",
+        choices=list(DOWNLOAD_FORMATS),
+        default="netcdf",
+        help=(
+            "The format to download from CDS. GRIB skips CDS's conversion to NetCDF "
+            "and is smaller, and is decoded locally with cfgrib."
+        ),
+    )
+    parser.add_argument(
+        "--broker",
+        action="store_true",
+        help=(
+            "Submit every CDS request up front and download each as it completes, "
+            "rather than waiting on requests one at a time."
+        ),
+    )
+    parser.add_argument(
+        "--max-queued-requests",
+        type=int,
+        default=16,
+        help="With --broker, how many requests to keep submitted to CDS at once.",
+    )
+    parser.add_argument(
+        "--broker-state-path",
+        default=None,
+        help=(
+            "Local path for the broker's record of submitted requests. By default "
+            "it's kept in the store, under _era5/cds_requests.json."
+        ),
+    )
+    parser.add_argument(
+        "--journal-path",
+        default=None,
+        help=(
+            "Local path for the ETL journal. By default it's kept in the store, "
+            "under _era5/journal.json."
+        ),
+    )
+    parser.add_argument(
+        "--fill-gaps",
+        action="store_true",
+        help=(
+            "Also write again the days the store's manifest is missing, or has "
+            "incomplete or preliminary (ERA5T) data for. Append stores are filled "
+            "in place, before appending."
+        ),
+    )
+    parser.add_argument(
+        "--timeseries-replica",
+        action="store_true",
+        help=(
+            "Keep a copy of the store chunked for time series reads, at "
+            "<output-path>-timeseries.zarr, updated with each complete year."
+        ),
+    )
+    parser.add_argument(
+        "--timeseries-flush",
+        action="store_true",
+        help="Also copy the trailing partial year to the time series replica.",
+    )
+    parser.add_argument(
+        "--metrics-jsonl",
+        default=os.environ.get("ETL_METRICS_JSONL"),
+        help="Append per-stage timings and counters to this file as JSON lines.",
+    )
+    parser.add_argument(
+        "--metrics-prometheus",
+        default=os.environ.get("ETL_METRICS_PROMETHEUS"),
+        help="Write the run's metrics to this Prometheus textfile at the end.",
+    )
+    parser.add_argument(
+        "--compact-mode",
+        choices=["incremental", "full"],
+        default="incremental",
+        help=(
+            "'incremental' merges just the 'time' chunks appended since the last "
+            "compaction. 'full' rewrites 'time' from the whole dataset."
+        ),
+    )
+
+    return parser.parse_args(args)
+
+
+def prepare():
+    try:
+        import cdsapi  # noqa: F401
+    except ImportError:
+        subprocess.call([sys.executable, "-m", "pip", "install", "git+https://github.com/TomAugspurger/cdsapi.git@loggingfix"])
+
+
+def main(args=None):
+    args = parse_args(args)
+    logger.setLevel(logging.INFO)
+    logger.addHandler(rich.logging.RichHandler())
+
+    metrics = Metrics(
+        jsonl_path=args.metrics_jsonl,
+        prometheus_path=args.metrics_prometheus,
+        kind=",".join(args.kind),
+        run_id=uuid.uuid4().hex,
+    )
+    try:
+        with metrics.span("run"):
+            run(args, metrics)
+    finally:
+        metrics.finish()
+
+
+def run(args, metrics: Metrics) -> None:
+    """
+    Run the ETL for each of ``args.kind``.
+
+    Kinds run concurrently, each into its own store, sharing the retry budget,
+    the CDS concurrency limit, and the download cache. A kind that fails doesn't
+    stop the others; the failures are raised once they've all finished.
+    """
+    kinds = list(dict.fromkeys(args.kind))
+    if len(kinds) > 1:
+        for option in ["output_path", "journal_path", "broker_state_path"]:
+            if getattr(args, option):
+                raise ValueError(
+                    f"--{option.replace('_', '-')} can't be used with more than one kind"
+                )
+    for profile in dict(
+        x.split("=", 1) for x in args.variable_encoding_profile
+    ).values():
+        if profile not in ENCODING_PROFILES:
+            raise ValueError(f"Unknown encoding profile '{profile}'")
+
+    retry_policy = RetryPolicy(
+        max_attempts=args.retry_max_attempts,
+        base_delay=args.retry_base_delay,
+        budget=args.retry_budget,
+    )
+    limiter = ConcurrencyLimiter(args.max_concurrent_requests)
+    cache = (
+        DownloadCache(args.cache_dir, max_bytes=args.cache_max_bytes)
+        if args.cache_dir
+        else None
+    )
+
+    logger.info("Preparing")
+    prepare()
+
+    if len(kinds) == 1:
+        run_kind(kinds[0], args, metrics, retry_policy, limiter, cache)
+        return
+
+    with concurrent.futures.ThreadPoolExecutor(
+        len(kinds), thread_name_prefix="era5-kind"
+    ) as pool:
+        futures = {
+            pool.submit(
+                run_kind,
+                kind,
+                args,
+                metrics.tagged(kind=kind),
+                retry_policy,
+                limiter,
+                cache,
+            ): kind
+            for kind in kinds
+        }
+        failed = []
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                future.result()
+            except Exception:
+                logger.exception("Failed %s", futures[future])
+                failed.append(futures[future])
+    if failed:
+        raise RuntimeError(f"Failed kinds: {sorted(failed)}")
+
+
+def run_kind(
+    kind: str,
+    args,
+    metrics: Metrics,
+    retry_policy: RetryPolicy,
+    limiter: ConcurrencyLimiter,
+    cache: DownloadCache | None,
+) -> None:
+    """
+    Run the ETL for `kind`: plan its periods from its store, then download,
+    transform, and write them.
+    """
+    credential = args.credential
+    output_protocol = args.output_protocol
+    output_path = args.output_path
+    cds_api_key = args.cds_api_key
+    start_period = args.start_period
+    end_period = args.end_period
+    max_concurrent_requests = args.max_concurrent_requests
+    days_per_request = args.days_per_request
+    download_format = args.download_format
+    pipeline_depth = args.pipeline_depth
+    write_mode = args.write_mode
+    compact_mode = args.compact_mode
+    variable_encoding_profiles = dict(
+        x.split("=", 1) for x in args.variable_encoding_profile
+    )
+    # output_storage_options = args.output_storage_options
+
+    # assert kind in
+
+    output_storage_options = {"account_name": "cpdataeuwest", "credential": credential}
+
+    if output_path is None:
+        output_path = f"era5/{kind}.zarr"
+
+    cutoff_period = pd.Period(pd.Timestamp.today() - pd.offsets.DateOffset(months=3, days=1), freq=FREQ)
+    if end_period is None:
+        end_period = cutoff_period
+    else:
+        end_period = pd.Period(end_period, freq=FREQ)
+
+    if end_period > cutoff_period:
+        raise ValueError(
+            f"end_period={end_period} is later than 3 months ago (={cutoff_period})"
+        )
+
+    store = fsspec.filesystem(output_protocol, **output_storage_options).get_mapper(
+        output_path
+    )
+    if args.journal_path:
+        journal = Journal(fsspec.filesystem("file"), args.journal_path)
+    else:
+        journal = Journal.for_store(
+            store, worker=args.worker_id if write_mode == "region" else None
+        )
+    if journal.periods:
+        logger.info("Resuming from journal with periods %s", sorted(journal.periods))
+        journal.recover(store)
+        if cache is None:
+            logger.warning(
+                "No --cache-dir, so downloads for in-flight periods will be repeated"
+            )
+
+    if write_mode == "region":
+        region = read_region(store)
+        if region is None:
+            region = pd.period_range(
+                args.region_start or start_period or FIRST_PERIOD,
+                args.region_end or end_period,
+                freq=FREQ,
+            )
+        filled = filled_periods(store)
+        start_period = (
+            region[0] if start_period is None else pd.Period(start_period, freq=FREQ)
+        )
+        # with --fill-gaps, preliminary (ERA5T) days are written again too.
+        periods = find_gaps(
+            store,
+            pd.PeriodIndex(
+                [p for p in region if start_period <= p <= end_period], freq=FREQ
+            ),
+            preliminary=args.fill_gaps,
+        )
+        if not args.preallocate and ".zmetadata" not in store:
+            raise ValueError(
+                f"{output_path} isn't pre-allocated. Run once with --preallocate, "
+                "before starting parallel workers."
+            )
+        write_options = WriteOptions(
+            mode="region",
+            region=region,
+            preallocate=args.preallocate,
+            encoding_profile=args.encoding_profile,
+            variable_encoding_profiles=variable_encoding_profiles,
+            packing=args.packing,
+            streaming=args.streaming_writes,
+            aggregates=args.aggregates,
+            overviews=args.overviews,
+        )
+        logger.info(
+            "Region %s/%s has %d/%d periods filled",
+            region[0],
+            region[-1],
+            len(filled),
+            len(region),
+        )
+    else:
+        last, next_period = determine_next_period(
+            output_protocol=output_protocol,
+            output_path=output_path,
+            output_storage_options=output_storage_options,
+        )
+
+        if start_period is None:
+            start_period = next_period
+        else:
+            start_period = pd.Period(start_period, freq=FREQ)
+
+        if (start_period - pd.Period(last, freq=FREQ)) != pd.offsets.Day(1):
+            raise ValueError(
+                f"start_period={start_period} is not consecutive with the last timestamp={last}"
+            )
+
+        periods = pd.period_range(start_period, end_period, freq=FREQ)
+        write_options = WriteOptions(
+            encoding_profile=args.encoding_profile,
+            variable_encoding_profiles=variable_encoding_profiles,
+            packing=args.packing,
+            streaming=args.streaming_writes,
+            aggregates=args.aggregates,
+            overviews=args.overviews,
+        )
+        if args.fill_gaps and ".zmetadata" in store:
+            with metrics.span("fill_gaps") as span:
+                span["days"] = len(
+                    fill_gaps(
+                        kind,
+                        cds_api_key,
+                        output_protocol,
+                        output_path,
+                        output_storage_options,
+                        max_concurrent_requests=max_concurrent_requests,
+                        days_per_request=days_per_request,
+                        write_options=write_options,
+                        cache=cache,
+                        metrics=metrics,
+                        retry_policy=retry_policy,
+                        limiter=limiter,
+                        download_format=download_format,
+                    )
+                )
+
+    N = len(periods)
+
+    logger.info("Beginning extract for kind=%s - periods=%s", kind, periods)
+
+    batches = batch_periods(periods, days_per_request)
+    if args.executor != "serial":
+        if write_mode != "region":
+            raise ValueError("--executor needs --write-mode=region")
+        run_backfill(
+            kind,
+            batches,
+            cds_api_key=cds_api_key,
+            output_protocol=output_protocol,
+            output_path=output_path,
+            output_storage_options=output_storage_options,
+            write_options=write_options,
+            workers=args.workers,
+            executor=args.executor,
+            dask_scheduler=args.dask_scheduler,
+            max_concurrent_requests=max_concurrent_requests,
+            retry=dict(
+                max_attempts=args.retry_max_attempts,
+                base_delay=args.retry_base_delay,
+                budget=args.retry_budget,
+            ),
+            download_format=download_format,
+            metrics=metrics,
+        )
+        # compaction and the time series replica are only for append stores.
+        return
+
+    broker = None
+    if args.broker:
+        if args.broker_state_path:
+            broker_fs, broker_state_path = (
+                fsspec.filesystem("file"),
+                args.broker_state_path,
+            )
+        else:
+            broker_fs = store.fs
+            broker_state_path = f"{store.root}/{SIDECAR}/cds_requests.json"
+        broker = CDSBroker(
+            CDSAPIBackend(cds_api_key),
+            broker_fs,
+            broker_state_path,
+            max_queued=args.max_queued_requests,
+        )
+        if broker.requests:
+            logger.info("Resuming %d submitted CDS requests", len(broker.requests))
+        # queue everything now, so CDS works through it while we download and write.
+        for batch in batches:
+            for variable in KINDS_TO_VARIABLES[kind]:
+                params = build_batch_query(variable, batch, download_format)
+                if cache is None or cache.key(CDS_DATASET, params) not in cache:
+                    broker.submit(params)
+
+    try:
+        if pipeline_depth > 0:
+            run_pipeline(
+                kind,
+                batches,
+                cds_api_key=cds_api_key,
+                output_protocol=output_protocol,
+                output_path=output_path,
+                output_storage_options=output_storage_options,
+                max_concurrent_requests=max_concurrent_requests,
+                pipeline_depth=pipeline_depth,
+                write_options=write_options,
+                cache=cache,
+                journal=journal,
+                metrics=metrics,
+                retry_policy=retry_policy,
+                limiter=limiter,
+                broker=broker,
+                download_format=download_format,
+            )
+        else:
+            i = 0
+            for batch in batches:
+                logger.info(
+                    "Starting %s - %s [%d-%d/%d]",
+                    kind,
+                    batch[0],
+                    i + 1,
+                    i + len(batch),
+                    N,
+                )
+                do_batch(
+                    kind,
+                    batch,
+                    cds_api_key=cds_api_key,
+                    output_protocol=output_protocol,
+                    output_path=output_path,
+                    output_storage_options=output_storage_options,
+                    max_concurrent_requests=max_concurrent_requests,
+                    write_options=write_options,
+                    cache=cache,
+                    journal=journal,
+                    metrics=metrics,
+                    retry_policy=retry_policy,
+                    limiter=limiter,
+                    broker=broker,
+                    download_format=download_format,
+                )
+                i += len(batch)
+                logger.info("Finished %s - %s [%d/%d]", kind, batch[-1], i, N)
+    finally:
+        if broker is not None:
+            broker.close()
+
+    if len(periods) and write_mode == "append":
+        # pre-allocated stores are written with a single 'time' chunk.
+        logger.info("Starting compact 'time' dimension")
+        prefix = output_path
+        if output_protocol == "abfs":
+            # strip the container name
+            container_name, prefix = output_path.split("/", 1)
+            account_name = output_storage_options["account_name"]
+
+            cc = azure.storage.blob.ContainerClient(
+                f"https://{account_name}.blob.core.windows.net",
+                container_name,
+                credential=credential,
+            )
+            with metrics.span("compact", mode=compact_mode):
+                if compact_mode == "full":
+                    compact(prefix, cc)
+                else:
+                    compact_incremental(
+                        zarr.ABSStore(prefix=prefix.rstrip("/"), client=cc),
+                        metrics=metrics,
+                    )
+            logger.info("Finished compact 'time' dimension")
+        elif compact_mode == "incremental":
+            with metrics.span("compact", mode=compact_mode):
+                compact_incremental(
+                    fsspec.filesystem(
+                        output_protocol, **output_storage_options
+                    ).get_mapper(output_path),
+                    metrics=metrics,
+                )
+            logger.info("Finished compact 'time' dimension")
+
+    if args.timeseries_replica:
+        if write_mode == "region":
+            logger.warning("The time series replica is only kept for append stores")
+        else:
+            replica_path = derived_path(output_path, "timeseries")
+            logger.info("Updating time series replica %s", replica_path)
+            with metrics.span("timeseries_replica") as span:
+                copied = update_timeseries_replica(
+                    store,
+                    fsspec.filesystem(
+                        output_protocol, **output_storage_options
+                    ).get_mapper(replica_path),
+                    flush=args.timeseries_flush,
+                )
+                span["hours"] = copied
+            logger.info("Copied %d hours to %s", copied, replica_path)
+
+
+def compact(prefix: str, cc: azure.storage.blob.ContainerClient):
+    """
+    Compact the `time` dimension into a single chunk.
+    """
+    # using azure.storage.blob rather than adlfs / fsspec to
+    # avoid any caching issues.
+    prefix = prefix.rstrip("/")
+    store = zarr.ABSStore(prefix=prefix, client=cc)
+    ds = xr.open_dataset(store, engine="zarr", chunks={})
+
+    time = ds["time"]
+    time.encoding["chunks"] = len(
+        time,
+    )
+    time.encoding["preferred_chunks"] = {"time": len(time)}
+    ds["time"].encoding
+
+    new_store = zarr.MemoryStore()
+    ds[["time"]].to_zarr(new_store)
+
+    for k, v in new_store.items():
+        if k.startswith("time/"):
+            name = f"{prefix}/{k}"
+            print(k, "->", name)
+            cc.upload_blob(name, v, overwrite=True)
+
+    zarr.consolidate_metadata(store)
+
+    # Remove any stale fragments
+    KEEP = {".zarray", ".zattrs", "0"}
+
+    for blob in cc.list_blobs(name_starts_with=f"{prefix}/time/"):
+        if blob.name.split("/")[-1] not in KEEP:
+            logger.info("Deleting %s", blob.name)
+            cc.delete_blob(blob)
+
+
+def compact_incremental(store, metrics: Metrics | None = None) -> None:
+    """
+    Merge the `time` chunks appended since the last compaction into the first chunk.
+
+    Unlike `compact`, this reads only the `time` array (the compacted chunk plus
+    the fragments after it), checks that the result is a contiguous hourly range,
+    and updates just its entry in the consolidated metadata. The fragments to
+    delete are known from the old chunk grid, so nothing is listed.
+    """
+    meta = json.loads(store["time/.zarray"])
+    (n,) = meta["shape"]
+    (chunk,) = meta["chunks"]
+    if chunk >= n:
+        logger.info("'time' is already a single chunk of %d", n)
+        return
+
+    n_fragments = -(-n // chunk) - 1
+    logger.info("Merging %d 'time' fragments into chunk 0", n_fragments)
+    array = zarr.open_array(store, path="time", mode="r")
+    values = array[:]
+
+    attrs = json.loads(store["time/.zattrs"])
+    times = pd.DatetimeIndex(
+        xr.coding.times.decode_cf_datetime(
+            values, attrs["units"], attrs.get("calendar", "standard")
+        )
+    )
+    expected = pd.date_range(times[0], periods=n, freq="h")
+    if not times.equals(expected):
+        missing = expected.difference(times)
+        raise ValueError(
+            f"'time' isn't a contiguous hourly range from {times[0]}. "
+            f"Missing {len(missing)} hours, starting at {missing[:1].tolist()}"
+        )
+
+    new_store = zarr.MemoryStore()
+    new = zarr.open_array(
+        new_store,
+        mode="w",
+        shape=n,
+        chunks=n,
+        dtype=array.dtype,
+        compressor=array.compressor,
+        filters=array.filters,
+        fill_value=array.fill_value,
+        order=array.order,
+    )
+    new[:] = values
+
+    store["time/0"] = new_store["0"]
+    store["time/.zarray"] = new_store[".zarray"]
+
+    consolidated = json.loads(store[".zmetadata"])
+    consolidated["metadata"]["time/.zarray"] = json.loads(new_store[".zarray"])
+    store[".zmetadata"] = zarr.util.json_dumps(consolidated)
+
+    if metrics is not None:
+        metrics.count("time_fragments_merged", n_fragments)
+    for i in range(1, n_fragments + 1):
+        logger.info("Deleting time/%d", i)
+        try:
+            del store[f"time/{i}"]
+        except KeyError:
+            pass
 
 
 if __name__ == "__main__":
@@ -1,8 +1,9 @@
 import stactools.core
 
 from stactools.era5.stac import create_collection, create_item
+from stactools.era5.subset import open_subset
 
-__all__ = ["create_collection", "create_item"]
+__all__ = ["create_collection", "create_item", "open_subset"]
 
 stactools.core.use_fsspec()
 
@@ -8,6 +8,10 @@ from stactools.era5 import stac
 logger = logging.getLogger(__name__)
 
 
+def parse_overview_paths(values):
+    return {int(k): v for k, v in (value.split("=", 1) for value in values)}
+
+
 def create_era5_command(cli):
     """Creates the stactools-era5 command line utility."""
 
@@ -48,8 +52,22 @@ def create_era5_command(cli):
         help="Storage options",
         multiple=True,
     )
+    @click.option(
+        "--metadata-only/--open-dataset",
+        default=True,
+        help=(
+            "Build the datacube from the consolidated metadata, or by opening "
+            "the dataset with xarray."
+        ),
+    )
     def create_collection_command(
-        root_path, kind, destination: str, protocol, extra_field, storage_option
+        root_path,
+        kind,
+        destination: str,
+        protocol,
+        extra_field,
+        storage_option,
+        metadata_only,
     ):
         """Creates a STAC Collection
 
@@ -65,6 +83,7 @@ def create_era5_command(cli):
             protocol,
             storage_options,
             extra_fields,
+            metadata_only=metadata_only,
         )
 
         with open(destination, "w") as f:
@@ -78,7 +97,47 @@ def create_era5_command(cli):
     @click.option("--protocol")
     @click.option("--account-name")
     @click.option("--destination", type=click.File("wt"))
-    def create_pc_item(path, kind, protocol, account_name, destination):
+    @click.option(
+        "--timeseries-path",
+        default=None,
+        help="Path to the copy of the store chunked for time series reads.",
+    )
+    @click.option(
+        "--daily-path",
+        default=None,
+        help="Path to the store of daily aggregates.",
+    )
+    @click.option(
+        "--monthly-path",
+        default=None,
+        help="Path to the store of monthly aggregates.",
+    )
+    @click.option(
+        "--overview-path",
+        default=None,
+        help="FACTOR=PATH of a store of overviews coarsened FACTOR times.",
+        multiple=True,
+    )
+    @click.option(
+        "--metadata-only/--open-dataset",
+        default=True,
+        help=(
+            "Build the datacube from the consolidated metadata, or by opening "
+            "the dataset with xarray."
+        ),
+    )
+    def create_pc_item(
+        path,
+        kind,
+        protocol,
+        account_name,
+        destination,
+        timeseries_path,
+        daily_path,
+        monthly_path,
+        overview_path,
+        metadata_only,
+    ):
         import planetary_computer
 
         container_name = path.split("/")[0]
@@ -90,7 +149,85 @@ def create_era5_command(cli):
             kind=kind,
             protocol=protocol,
             storage_options={"account_name": account_name, "credential": credential},
+            timeseries_path=timeseries_path,
+            daily_path=daily_path,
+            monthly_path=monthly_path,
+            overview_paths=parse_overview_paths(overview_path),
+            metadata_only=metadata_only,
         )
         json.dump(item.to_dict(), destination, indent=2)
 
+    @era5.command(
+        "create-items",
+        short_help="Create a STAC item for each month or year of a store.",
+    )
+    @click.option("--path")
+    @click.option("--kind")
+    @click.option("--protocol", default="abfs")
+    @click.option(
+        "--storage-option",
+        default=None,
+        help="Storage options",
+        multiple=True,
+    )
+    @click.option(
+        "--frequency",
+        type=click.Choice(list(stac.ITEM_FREQUENCIES)),
+        default="month",
+        help="The period each item covers.",
+    )
+    @click.option(
+        "--timeseries-path",
+        default=None,
+        help="Path to the copy of the store chunked for time series reads.",
+    )
+    @click.option(
+        "--daily-path",
+        default=None,
+        help="Path to the store of daily aggregates.",
+    )
+    @click.option(
+        "--monthly-path",
+        default=None,
+        help="Path to the store of monthly aggregates.",
+    )
+    @click.option(
+        "--overview-path",
+        default=None,
+        help="FACTOR=PATH of a store of overviews coarsened FACTOR times.",
+        multiple=True,
+    )
+    @click.option(
+        "--destination",
+        type=click.File("wt"),
+        default="-",
+        help="Where to write the items, as newline-delimited JSON.",
+    )
+    def create_items_command(
+        path,
+        kind,
+        protocol,
+        storage_option,
+        frequency,
+        timeseries_path,
+        daily_path,
+        monthly_path,
+        overview_path,
+        destination,
+    ):
+        storage_options = dict(k.split("=", 1) for k in storage_option)
+        items = stac.create_items(
+            path,
+            kind,
+            protocol,
+            storage_options=storage_options,
+            frequency=frequency,
+            timeseries_path=timeseries_path,
+            daily_path=daily_path,
+            monthly_path=monthly_path,
+            overview_paths=parse_overview_paths(overview_path),
+        )
+        n = stac.write_ndjson(items, destination)
+        logger.info("Wrote %d items", n)
+
     return era5
@@ -1,14 +1,21 @@
 from __future__ import annotations
 
+import concurrent.futures
 import copy
-import datetime
+import json
 import pathlib
-from typing import Any
+from collections.abc import Iterable, Iterator, MutableMapping
+from typing import IO, Any
 
 import fsspec
+import numpy as np
+import pandas as pd
 import pystac
+import pystac.extensions.datacube
+import pystac.extensions.item_assets
 import xarray as xr
 import xstac
+import zarr
 
 from stactools.era5.constants import ITEM_ASSETS
 
@@ -30,6 +37,19 @@ AN_VARIABLES = [
     "dew_point_temperature_at_2_metres",
 ]
 KINDS = ["an", "fc"]
+# The period each item covers in `create_items`, and its id's format.
+ITEM_FREQUENCIES = {"month": ("M", "%Y-%m"), "year": ("Y", "%Y")}
+# The aggregate stores kept by the ETL, and the period each time step covers.
+AGGREGATE_PERIODS = {"daily": "day", "monthly": "month"}
+# Attributes xarray consumes when decoding a variable, which xstac never sees.
+CF_ENCODING_ATTRS = {
+    "_ARRAY_DIMENSIONS",
+    "_FillValue",
+    "missing_value",
+    "scale_factor",
+    "add_offset",
+    "coordinates",
+}
 
 
 def create_collection(
@@ -38,26 +58,44 @@ def create_collection(
     protocol: str,
     storage_options: dict[str, Any] | None = None,
     extra_fields: dict[str, Any] = None,
+    metadata_only: bool = True,
 ) -> pystac.Collection:
     """
     Create a collection from a representative `fc` and `an` paths.
+
+    The items for each kind are created concurrently. See `create_item` for
+    `metadata_only`.
     """
     storage_options = storage_options or {}
     extra_fields = extra_fields or {}
 
-    items = [
-        create_item(root_path, kind, protocol, storage_options=storage_options)
-        for root_path, kind in zip(root_paths, kinds)
-    ]
+    with concurrent.futures.ThreadPoolExecutor(max(len(kinds), 1)) as pool:
+        items = list(
+            pool.map(
+                lambda root_path, kind: create_item(
+                    root_path,
+                    kind,
+                    protocol,
+                    storage_options=storage_options,
+                    metadata_only=metadata_only,
+                ),
+                root_paths,
+                kinds,
+            )
+        )
 
     collection_datacube = create_collection_datacube(items)
     # Done with I/O
 
+    start, end = collection_datacube["cube:dimensions"]["time"]["extent"]
     extent = pystac.Extent(
         spatial=pystac.SpatialExtent(bboxes=[[-180.0, -90.0, 180.0, 90.0]]),
         temporal=pystac.TemporalExtent(
             intervals=[
-                [datetime.datetime(1959, 1, 1), None],
+                [
+                    pd.Timestamp(start).to_pydatetime(),
+                    pd.Timestamp(end).to_pydatetime(),
+                ],
             ]
         ),
     )
@@ -160,6 +198,11 @@ def create_item(
     kind: str,
     protocol: str,
     storage_options: dict[str, Any] | None = None,
+    timeseries_path: str | None = None,
+    metadata_only: bool = True,
+    daily_path: str | None = None,
+    monthly_path: str | None = None,
+    overview_paths: dict[int, str] | None = None,
 ) -> pystac.Item:
     """
     Create an ERA5 item from a Zarr group.
@@ -171,11 +214,25 @@ def create_item(
     kind: str
         One of "an" or "fc". This function will list all files under the root
         'path' and filter down to just those for kind 'kind'.
+    timeseries_path: str, optional
+        The path to a copy of the store chunked for time series reads, which
+        is added as the "timeseries" asset.
+    daily_path, monthly_path: str, optional
+        The paths to the stores of daily and monthly aggregates kept by the
+        ETL, which are added as the "daily" and "monthly" assets.
+    overview_paths: dict, optional
+        The paths to the coarsened overviews kept by the ETL, by coarsening
+        factor, which are added as "overview-<factor>x" assets with their
+        resolution.
+    metadata_only: bool, default True
+        Build the datacube from the consolidated metadata and the first and
+        last ``time`` values. Otherwise the dataset is opened and passed to
+        xstac, which decodes the entire ``time`` coordinate for the same
+        result.
     """
     storage_options = storage_options or {}
     fs = fsspec.filesystem(protocol, **storage_options)
     store = fs.get_mapper(path)
-    ds = xr.open_dataset(store, engine="zarr", consolidated=True)
     properties = {"era5:kind": kind, "start_datetime": None, "end_datetime": None}
 
     geometry = {
@@ -200,21 +257,34 @@ def create_item(
         datetime=None,
         properties=properties,
     )
-    item = xstac.xarray_to_stac(
-        ds,
-        template,
-        temporal_dimension="time",
-        x_dimension="lon",
-        y_dimension="lat",
-        reference_system="epsg:4326",
-    )
+    if metadata_only:
+        item = template
+        datacube = metadata_datacube(store)
+        item.properties.update(datacube)
+        start, end = datacube["cube:dimensions"]["time"]["extent"]
+        item.properties["start_datetime"] = start
+        item.properties["end_datetime"] = end
+        pystac.extensions.datacube.DatacubeExtension.add_to(item)
+    else:
+        ds = xr.open_dataset(store, engine="zarr", consolidated=True)
+        item = xstac.xarray_to_stac(
+            ds,
+            template,
+            temporal_dimension="time",
+            x_dimension="lon",
+            y_dimension="lat",
+            reference_system="epsg:4326",
+        )
 
+    open_storage_options = {}
+    if hasattr(fs, "account_name"):
+        open_storage_options["account_name"] = fs.account_name
     asset_extra_fields = {
         "xarray:open_kwargs": {
             "engine": "zarr",
             "chunks": {},
             "consolidated": True,
-            "storage_options": {"account_name": fs.account_name},
+            "storage_options": open_storage_options,
         }
     }
     title = f"Zarr store for '{kind}' variables."
@@ -228,20 +298,275 @@ def create_item(
             extra_fields=asset_extra_fields,
         ),
     )
+    if timeseries_path is not None:
+        item.add_asset(
+            "timeseries",
+            pystac.Asset(
+                f"{protocol}://{timeseries_path}",
+                title=f"Zarr store for '{kind}' variables, chunked for time series.",
+                description=(
+                    "A copy of the 'data' store chunked along time rather than "
+                    "space, for reading long time series at a point or region. "
+                    "It's updated a year at a time, so the most recent hours are "
+                    "only in the 'data' store."
+                ),
+                media_type="application/vnd+zarr",
+                roles=["data"],
+                extra_fields=copy.deepcopy(asset_extra_fields),
+            ),
+        )
+    aggregate_paths = {"daily": daily_path, "monthly": monthly_path}
+    for key, aggregate_path in aggregate_paths.items():
+        if aggregate_path is None:
+            continue
+        item.add_asset(
+            key,
+            pystac.Asset(
+                f"{protocol}://{aggregate_path}",
+                title=f"Zarr store of {key} aggregates of '{kind}' variables.",
+                description=(
+                    f"The {key} mean, minimum, and maximum of each variable, or "
+                    "the sum of accumulations and the extreme of hourly maxima "
+                    "and minima, named like '<variable>_<statistic>'. The time "
+                    f"is the start of each {AGGREGATE_PERIODS[key]}."
+                ),
+                media_type="application/vnd+zarr",
+                roles=["data"],
+                extra_fields=copy.deepcopy(asset_extra_fields),
+            ),
+        )
+    step = abs(item.properties["cube:dimensions"]["lon"]["step"])
+    for factor, overview_path in sorted((overview_paths or {}).items()):
+        resolution = step * factor
+        item.add_asset(
+            f"overview-{factor}x",
+            pystac.Asset(
+                f"{protocol}://{overview_path}",
+                title=f"Zarr store for '{kind}' variables at {resolution}°.",
+                description=(
+                    f"The 'data' store coarsened {factor}x in latitude and "
+                    "longitude, for maps and quick looks. Each block is the mean "
+                    "of its cells, or the extreme for hourly maxima and minima."
+                ),
+                media_type="application/vnd+zarr",
+                roles=["data", "overview"],
+                extra_fields={
+                    **copy.deepcopy(asset_extra_fields),
+                    "era5:overview_factor": factor,
+                    "era5:resolution": resolution,
+                },
+            ),
+        )
     return item
 
 
+def create_items(
+    path: str,
+    kind: str,
+    protocol: str,
+    storage_options: dict[str, Any] | None = None,
+    frequency: str = "month",
+    timeseries_path: str | None = None,
+    daily_path: str | None = None,
+    monthly_path: str | None = None,
+    overview_paths: dict[int, str] | None = None,
+) -> Iterator[pystac.Item]:
+    """
+    Create an ERA5 item for each month or year of a Zarr group.
+
+    The store's item from `create_item` is the template. Each item slices its
+    ``time`` dimension, ``start_datetime``, ``end_datetime`` and the length of
+    its variables' ``time`` axis to the hours in that period.
+
+    The time index is rebuilt from the template's extent and step, since the
+    stores are contiguous, rather than read: ``time`` is stored a day per
+    chunk, so reading it all is one request per day.
+
+    Parameters
+    ----------
+    frequency: str
+        One of "month" or "year".
+    """
+    freq, id_format = ITEM_FREQUENCIES[frequency]
+    storage_options = storage_options or {}
+    template = create_item(
+        path,
+        kind,
+        protocol,
+        storage_options=storage_options,
+        timeseries_path=timeseries_path,
+        daily_path=daily_path,
+        monthly_path=monthly_path,
+        overview_paths=overview_paths,
+    ).to_dict()
+    time = template["properties"]["cube:dimensions"]["time"]
+    start, end = time["extent"]
+    times = pd.date_range(start, end, freq=pd.Timedelta(time["step"])).tz_convert(None)
+    (length,) = {
+        v["shape"][0]
+        for v in template["properties"]["cube:variables"].values()
+        if v["dimensions"][0] == "time"
+    }
+    if len(times) != length:
+        raise ValueError(
+            f"{path} has {length} times between {start} and {end}, not "
+            f"{len(times)}. Is it contiguous?"
+        )
+    ordinals = times.to_period(freq).asi8
+    starts = np.concatenate([[0], np.flatnonzero(np.diff(ordinals)) + 1])
+    stops = np.append(starts[1:], len(times))
+
+    first = format_datetime(times[starts])
+    last = format_datetime(times[stops - 1])
+    suffixes = times[starts].strftime(id_format)
+
+    properties = template["properties"]
+    for i, length in enumerate((stops - starts).tolist()):
+        # Only what's sliced is copied here; from_dict deep-copies the rest.
+        extent = [first[i], last[i]]
+        dimensions = {
+            **properties["cube:dimensions"],
+            "time": {**properties["cube:dimensions"]["time"], "extent": extent},
+        }
+        variables = {
+            k: (
+                {**v, "shape": [length] + v["shape"][1:]}
+                if v["dimensions"][0] == "time"
+                else v
+            )
+            for k, v in properties["cube:variables"].items()
+        }
+        item = {
+            **template,
+            "id": f"{template['id']}-{suffixes[i]}",
+            "properties": {
+                **properties,
+                "start_datetime": extent[0],
+                "end_datetime": extent[1],
+                "cube:dimensions": dimensions,
+                "cube:variables": variables,
+            },
+        }
+        yield pystac.Item.from_dict(item, migrate=False)
+
+
+def write_ndjson(items: Iterable[pystac.Item], destination: IO[str]) -> int:
+    """
+    Write `items` to `destination` as newline-delimited JSON, for bulk
+    loading. Returns the number of items written.
+    """
+    n = 0
+    for item in items:
+        destination.write(json.dumps(item.to_dict()))
+        destination.write("\n")
+        n += 1
+    return n
+
+
+def format_datetime(values: np.ndarray) -> list[str]:
+    return pd.to_datetime(values).strftime("%Y-%m-%dT%H:%M:%SZ").tolist()
+
+
+def read_time_extent(store: MutableMapping) -> tuple[list[str], str | None]:
+    """
+    The first and last ``time`` values, and the step between the first two.
+
+    Only the first and last chunks of ``time`` are read. The step is
+    inferred from the start, since the stores are contiguous and hourly.
+    """
+    time = zarr.open_array(store, path="time", mode="r")
+    units = time.attrs["units"]
+    calendar = time.attrs.get("calendar", "proleptic_gregorian")
+    raw = np.concatenate([time[:2], time[-1:]])
+    values = xr.coding.times.decode_cf_datetime(raw, units, calendar)
+    step = None
+    if len(time) > 1:
+        step = pd.Timedelta(values[1] - values[0]).isoformat()
+    return format_datetime(values[[0, -1]]), step
+
+
+def metadata_datacube(store: MutableMapping) -> dict[str, Any]:
+    """
+    The ``cube:dimensions`` and ``cube:variables`` xstac would produce for
+    the Zarr group `store`, built from its consolidated metadata.
+
+    Only ``time``'s first and last chunks and the ``lat`` and ``lon``
+    coordinates are read.
+    """
+    metadata = json.loads(store[".zmetadata"])["metadata"]
+    arrays = {
+        key.rsplit("/", 1)[0]: (
+            value,
+            metadata.get(key[: -len(".zarray")] + ".zattrs", {}),
+        )
+        for key, value in metadata.items()
+        if key.endswith("/.zarray")
+    }
+    coordinates = set(metadata.get(".zattrs", {}).get("coordinates", "").split())
+    for _, attrs in arrays.values():
+        coordinates.update(attrs.get("coordinates", "").split())
+
+    time_extent, time_step = read_time_extent(store)
+    dimensions: dict[str, Any] = {
+        "time": {
+            "extent": time_extent,
+            "description": arrays["time"][1].get("long_name"),
+            "step": time_step,
+            "type": "temporal",
+        }
+    }
+    for name, axis in [("lon", "x"), ("lat", "y")]:
+        values = zarr.open_array(store, path=name, mode="r")[:]
+        delta = np.diff(values)
+        step = None
+        if len(delta) > 1 and (delta[0] == delta[1:]).all():
+            step = delta[0].item()
+        dimensions[name] = {
+            "axis": axis,
+            "extent": [values.min().item(), values.max().item()],
+            "step": step,
+            "description": arrays[name][1].get("long_name"),
+            "reference_system": "epsg:4326",
+            "type": "spatial",
+        }
+
+    variables = {}
+    for name, (zarray, zattrs) in sorted(arrays.items()):
+        dims = zattrs["_ARRAY_DIMENSIONS"]
+        if name in dims:
+            continue
+        attrs = {k: v for k, v in zattrs.items() if k not in CF_ENCODING_ATTRS}
+        if " since " in attrs.get("units", ""):
+            # decoded to datetimes, so xarray consumes these too.
+            attrs.pop("units")
+            attrs.pop("calendar", None)
+        variables[name] = {
+            "type": "auxiliary" if name in coordinates else "data",
+            "description": attrs.get("description") or attrs.get("long_name"),
+            "dimensions": dims,
+            "unit": attrs.get("units"),
+            "attrs": attrs,
+            "shape": zarray["shape"],
+        }
+        variables[name] = {k: v for k, v in variables[name].items() if v is not None}
+
+    return {"cube:dimensions": dimensions, "cube:variables": variables}
+
+
 def create_collection_datacube(items: list[pystac.Item]) -> dict[str, Any]:
     # generate from 2 items
 
     collection_datacube: dict[str, dict[str, Any]] = {"cube:variables": {}}
+    starts = [item.properties["cube:dimensions"]["time"]["extent"][0] for item in items]
+    ends = [item.properties["cube:dimensions"]["time"]["extent"][1] for item in items]
     for item in items:
         collection_datacube["cube:dimensions"] = copy.deepcopy(
             item.properties["cube:dimensions"]
         )
+        # the ISO 8601 strings sort chronologically.
         collection_datacube["cube:dimensions"]["time"]["extent"] = [
-            "1959-01-01T00:00:00Z",
-            None,
+            min(starts),
+            max(ends),
         ]
         # varies by month, so we set it to null
         collection_datacube["cube:variables"].update(
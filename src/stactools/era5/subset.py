@@ -0,0 +1,270 @@
+"""
+Read a region and time range of an ERA5 Zarr store straight into memory.
+"""
+
+from __future__ import annotations
+
+import collections
+import concurrent.futures
+import itertools
+from typing import Any
+
+import fsspec
+import numcodecs.compat
+import numpy as np
+import pandas as pd
+import xarray as xr
+import zarr
+
+# The index ranges selected along a dimension, in the order they're laid out in
+# the result. Longitude has two when a bbox crosses the edge of the grid.
+Ranges = list[tuple[int, int]]
+# For each chunk, the (chunk, result) slices to copy.
+Copies = dict[tuple[int, ...], list[tuple[tuple[slice, ...], tuple[slice, ...]]]]
+
+
+def open_subset(
+    href: str,
+    variables: list[str] | None = None,
+    time_range: tuple[Any, Any] | None = None,
+    bbox: tuple[float, float, float, float] | None = None,
+    storage_options: dict[str, Any] | None = None,
+    max_workers: int = 16,
+) -> xr.Dataset:
+    """
+    Read `variables` within `time_range` and `bbox` from the Zarr store at
+    `href` into a NumPy-backed dataset.
+
+    Rather than opening the store lazily and slicing it, which builds a task
+    for every chunk in the time range, this maps the query to the keys of the
+    chunks it overlaps and fetches them in batches, with one ``cat`` of up to
+    `max_workers` keys at a time, which fetches them concurrently on the
+    asynchronous filesystems (like ``abfs`` and ``https``). Each chunk is
+    decoded straight into the result, so the memory used is the result plus
+    a batch of compressed chunks.
+
+    Parameters
+    ----------
+    href: str
+        The store's URL, like the href of the "data" asset from `create_item`.
+    variables: list of str, optional
+        The variables to read. By default, every variable along ``time``.
+    time_range: tuple, optional
+        The first and last times to read, inclusive. By default, all of them.
+    bbox: tuple, optional
+        ``(west, south, east, north)`` in degrees. A `west` greater than `east`
+        crosses the antimeridian. The result's longitudes increase from `west`,
+        in its convention (-180 to 180 or 0 to 360). By default, the globe.
+    storage_options: dict, optional
+        Passed to fsspec, like the asset's ``xarray:open_kwargs``.
+
+    Returns
+    -------
+    xarray.Dataset
+        The same as selecting from ``xr.open_zarr(href)``, decoded the same way.
+    """
+    fs, path = fsspec.core.url_to_fs(href, **(storage_options or {}))
+    path = path.rstrip("/")
+    group = zarr.open_consolidated(fs.get_mapper(path), mode="r")
+
+    time_ranges, times = select_time(group["time"], time_range)
+    lat_ranges, lats = select_lat(group["lat"][:], bbox)
+    lon_ranges, lons = select_lon(group["lon"][:], bbox)
+    selections = {"time": time_ranges, "lat": lat_ranges, "lon": lon_ranges}
+
+    if variables is None:
+        variables = [
+            name
+            for name, array in group.arrays()
+            if name != "time" and "time" in array.attrs["_ARRAY_DIMENSIONS"]
+        ]
+
+    results = {}
+    tasks = []
+    for name in variables:
+        array = group[name]
+        dims = array.attrs["_ARRAY_DIMENSIONS"]
+        ranges = [selections.get(dim, [(0, n)]) for dim, n in zip(dims, array.shape)]
+        shape = [sum(stop - start for start, stop in r) for r in ranges]
+        # zarr leaves chunks without a fill value uninitialized; zeros will do.
+        fill_value = 0 if array.fill_value is None else array.fill_value
+        results[name] = np.full(shape, fill_value, dtype=array.dtype)
+        for key, copies in chunk_copies(ranges, array.chunks).items():
+            tasks.append((name, f"{path}/{name}/{chunk_key(array, key)}", copies))
+
+    def copy(task, data) -> None:
+        name, _, copies = task
+        chunk = decode_chunk(data, group[name])
+        for source, target in copies:
+            results[name][target] = chunk[source]
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers) as pool:
+        for i in range(0, len(tasks), max_workers):
+            batch = tasks[slice(i, i + max_workers)]
+            blobs = fs.cat([key for _, key, _ in batch], on_error="return")
+            futures = []
+            for task in batch:
+                data = blobs[task[1]]
+                if isinstance(data, FileNotFoundError):
+                    # never written, so it's all fill value.
+                    continue
+                if isinstance(data, BaseException):
+                    raise data
+                futures.append(pool.submit(copy, task, data))
+            for future in futures:
+                future.result()
+
+    data_vars = {}
+    for name in variables:
+        array = group[name]
+        attrs = variable_attrs(array)
+        if array.fill_value is not None:
+            attrs["_FillValue"] = array.fill_value
+        data_vars[name] = xr.Variable(
+            array.attrs["_ARRAY_DIMENSIONS"], results[name], attrs
+        )
+    ds = xr.decode_cf(xr.Dataset(data_vars, attrs=group.attrs.asdict()))
+    time_attrs = variable_attrs(group["time"])
+    for attr in ["units", "calendar"]:
+        time_attrs.pop(attr, None)
+    return ds.assign_coords(
+        time=xr.Variable("time", times, time_attrs),
+        lat=xr.Variable("lat", lats, variable_attrs(group["lat"])),
+        lon=xr.Variable("lon", lons, variable_attrs(group["lon"])),
+    )
+
+
+def variable_attrs(array: zarr.Array) -> dict[str, Any]:
+    return {k: v for k, v in array.attrs.items() if k != "_ARRAY_DIMENSIONS"}
+
+
+def select_time(
+    time: zarr.Array, time_range: tuple[Any, Any] | None
+) -> tuple[Ranges, pd.DatetimeIndex]:
+    """
+    The range of `time` within `time_range`, and its values.
+
+    The stores are contiguous, so the index is rebuilt from the first and last
+    chunks of `time`. Otherwise all of it is read.
+    """
+    n = time.shape[0]
+    units = time.attrs["units"]
+    calendar = time.attrs.get("calendar", "proleptic_gregorian")
+
+    def decode(values: np.ndarray) -> pd.DatetimeIndex:
+        return pd.DatetimeIndex(
+            xr.coding.times.decode_cf_datetime(values, units, calendar)
+        )
+
+    index = None
+    if n > 1:
+        ends = decode(np.concatenate([time[:2], time[-1:]]))
+        step = ends[1] - ends[0]
+        if ends[-1] - ends[0] == step * (n - 1):
+            index = pd.date_range(ends[0], periods=n, freq=step)
+    if index is None:
+        index = decode(time[:])
+
+    start, stop = 0, n
+    if time_range is not None:
+        start = index.searchsorted(pd.Timestamp(time_range[0]), side="left")
+        stop = index.searchsorted(pd.Timestamp(time_range[1]), side="right")
+    return [(start, stop)], index[start:stop]
+
+
+def select_lat(
+    lat: np.ndarray, bbox: tuple[float, float, float, float] | None
+) -> tuple[Ranges, np.ndarray]:
+    """
+    The range of `lat` within `bbox`, and its values.
+    """
+    if bbox is None:
+        return [(0, len(lat))], lat
+    _, south, _, north = bbox
+    (indices,) = np.nonzero((lat >= south) & (lat <= north))
+    if not len(indices):
+        return [(0, 0)], lat[:0]
+    start, stop = indices[0], indices[-1] + 1
+    return [(start, stop)], lat[start:stop]
+
+
+def select_lon(
+    lon: np.ndarray, bbox: tuple[float, float, float, float] | None
+) -> tuple[Ranges, np.ndarray]:
+    """
+    The ranges of `lon` within `bbox`, in order east from its west edge, and
+    their values in the bbox's convention.
+
+    The stores' longitudes run from 0 to 360, so a bbox crossing 0 (in 0 to
+    360) or 180 (in -180 to 180) selects the end of the grid, then the start.
+    """
+    if bbox is None:
+        return [(0, len(lon))], lon
+    west, _, east, _ = bbox
+    width = 360.0 if east - west >= 360 else (east - west) % 360
+    # degrees east of the west edge, so a bbox is one interval however it wraps.
+    offsets = (lon.astype("float64") - west) % 360
+    order = np.argsort(offsets, kind="stable")
+    indices = order[offsets[order] <= width]
+    if not len(indices):
+        return [(0, 0)], lon[:0]
+    # the indices are increasing, apart from at most one wrap back to 0.
+    breaks = np.flatnonzero(np.diff(indices) != 1) + 1
+    ranges = [(int(run[0]), int(run[-1]) + 1) for run in np.split(indices, breaks)]
+    return ranges, (west + offsets[indices]).astype(lon.dtype)
+
+
+def chunk_copies(ranges: list[Ranges], chunks: tuple[int, ...]) -> Copies:
+    """
+    The chunks overlapping `ranges`, one per dimension, and the slices of each
+    to copy into the result.
+
+    A chunk is listed once, with several copies if a wrapped longitude
+    selection covers it twice.
+    """
+    per_dim = []
+    for dim_ranges, size in zip(ranges, chunks):
+        pieces = []
+        offset = 0
+        for start, stop in dim_ranges:
+            for i in range(start // size, -(-stop // size)):
+                lo = max(start, i * size)
+                hi = min(stop, (i + 1) * size)
+                pieces.append(
+                    (
+                        i,
+                        slice(lo - i * size, hi - i * size),
+                        slice(offset + lo - start, offset + hi - start),
+                    )
+                )
+            offset += stop - start
+        per_dim.append(pieces)
+
+    copies: Copies = collections.defaultdict(list)
+    for combination in itertools.product(*per_dim):
+        key = tuple(piece[0] for piece in combination)
+        copies[key].append(
+            (
+                tuple(piece[1] for piece in combination),
+                tuple(piece[2] for piece in combination),
+            )
+        )
+    return copies
+
+
+def chunk_key(array: zarr.Array, key: tuple[int, ...]) -> str:
+    separator = getattr(array, "_dimension_separator", None) or "."
+    return separator.join(map(str, key))
+
+
+def decode_chunk(data: bytes, array: zarr.Array) -> np.ndarray:
+    """
+    Decompress and unfilter a chunk of `array`, as Zarr does.
+    """
+    chunk: Any = data
+    if array.compressor is not None:
+        chunk = array.compressor.decode(chunk)
+    for codec in reversed(array.filters or []):
+        chunk = codec.decode(chunk)
+    chunk = numcodecs.compat.ensure_ndarray(chunk).view(array.dtype)
+    return chunk.reshape(array.chunks, order=array.order)
@@ -0,0 +1,40 @@
+import pandas as pd
+import xarray as xr
+
+from azure import benchmark, etl
+
+
+def test_synthetic_cds_file(tmp_path):
+    period = pd.Period("1959-01-02", freq="D")
+    path = benchmark.synthetic_cds_file(
+        "t2m", period, str(tmp_path / "t2m.nc"), shape=(24, 5, 8), expver=True
+    )
+    ds = xr.open_dataset(path, mask_and_scale=False)
+    assert ds["t2m"].dtype == "int16"
+    assert {"scale_factor", "add_offset"} <= set(ds["t2m"].attrs)
+    assert "expver" in ds
+
+    result = etl.transform(xr.open_dataset(path))
+    assert list(result.data_vars) == ["air_temperature_at_2_metres"]
+    pd.testing.assert_index_equal(
+        result.indexes["time"],
+        etl.hourly_index(pd.PeriodIndex([period])),
+        check_names=False,
+    )
+
+
+def test_compare():
+    base = {"store": "file", "days": 3, "variables": 4}
+    baseline = [{**base, "write_fresh_seconds": 1.0, "objects": 100, "MBps": 50.0}]
+
+    ok = [{**base, "write_fresh_seconds": 1.1, "objects": 100, "MBps": 10.0}]
+    assert benchmark.compare(ok, baseline, tolerance=0.2) == []
+
+    slow = [{**base, "write_fresh_seconds": 1.5, "objects": 130, "MBps": 50.0}]
+    regressions = benchmark.compare(slow, baseline, tolerance=0.2)
+    assert len(regressions) == 2
+    assert regressions[0].startswith("file write_fresh_seconds: 1 -> 1.5")
+
+    # results without a matching baseline entry are skipped.
+    other = [{**base, "days": 5, "write_fresh_seconds": 9.0}]
+    assert benchmark.compare(other, baseline, tolerance=0.2) == []
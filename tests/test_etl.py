@@ -0,0 +1,1183 @@
+import json
+import os
+import threading
+import time
+
+import fsspec
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+import zarr
+
+from azure import etl
+
+SHORT_NAMES = {v: k for k, v in etl.NAMES.items()}
+
+
+def make_cds_dataset(variable: str, periods: pd.PeriodIndex) -> xr.Dataset:
+    """
+    A small dataset shaped like a CDS NetCDF download for `variable`.
+    """
+    short_name = SHORT_NAMES[etl.filenames_to_keys[variable]]
+    times = pd.date_range(
+        periods[0].start_time, periods[-1].end_time.floor("h"), freq="h"
+    )
+    lat = np.linspace(90, -90, 5, dtype="float32")
+    lon = np.linspace(0, 315, 8, dtype="float32")
+    rng = np.random.default_rng(len(variable))
+    data = rng.uniform(250, 300, (len(times), len(lat), len(lon))).astype("float32")
+    return xr.Dataset(
+        {short_name: (("time", "latitude", "longitude"), data, {"units": "K"})},
+        coords={"time": times, "latitude": lat, "longitude": lon},
+    )
+
+
+class FakeCDSClient:
+    """
+    A local stand-in for ``cdsapi.Client``.
+    """
+
+    def __init__(self, delay=0.0, fail=()):
+        self.delay = delay
+        self.fail = set(fail)
+        self.requests = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        # picklable, for process pools.
+        state = self.__dict__.copy()
+        del state["lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def retrieve(self, name, request, target):
+        with self.lock:
+            self.requests.append(request)
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            time.sleep(self.delay)
+            if request["variable"] in self.fail:
+                raise ValueError(f"request for {request['variable']} failed")
+            days = [int(day) for day in np.atleast_1d(request["day"])]
+            periods = pd.PeriodIndex(
+                [
+                    pd.Period(
+                        year=int(request["year"]),
+                        month=int(request["month"]),
+                        day=day,
+                        freq="D",
+                    )
+                    for day in days
+                ]
+            )
+            with etl.OPEN_LOCK:
+                make_cds_dataset(request["variable"], periods).to_netcdf(target)
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+
+
+def test_fetch_variables_concurrent(tmp_path):
+    client = FakeCDSClient(delay=0.2, fail=["2m_temperature"])
+    variables = etl.AN_VARIABLES
+    results = etl.fetch_variables(
+        variables,
+        pd.period_range("2000-01-01", periods=1, freq="D"),
+        cds_api_key="",
+        basedir=str(tmp_path),
+        max_concurrent_requests=3,
+        client=client,
+    )
+
+    assert client.max_in_flight == 3
+    assert [r.variable for r in results] == variables
+    failed = [r.variable for r in results if not r.ok]
+    assert failed == ["2m_temperature"]
+    assert all(r.dataset is not None for r in results if r.ok)
+
+
+def test_do_one(tmp_path):
+    client = FakeCDSClient()
+    output_path = str(tmp_path / "forecast.zarr")
+    for period in pd.period_range("1959-01-01", "1959-01-02", freq="D"):
+        etl.do_one(
+            "forecast",
+            period,
+            cds_api_key="",
+            output_protocol="file",
+            output_path=output_path,
+            output_storage_options={},
+            max_concurrent_requests=4,
+            client=client,
+        )
+
+    ds = xr.open_dataset(output_path, engine="zarr")
+    assert len(ds.time) == 48
+    assert set(ds.data_vars) == {etl.filenames_to_keys[v] for v in etl.FC_VARIABLES} | {
+        "time1_bounds"
+    }
+
+
+def test_do_batch(tmp_path):
+    client = FakeCDSClient()
+    output_path = str(tmp_path / "forecast.zarr")
+    periods = pd.period_range("1959-01-01", "1959-01-05", freq="D")
+    for batch in etl.batch_periods(periods, days_per_request=3):
+        etl.do_batch(
+            "forecast",
+            batch,
+            cds_api_key="",
+            output_protocol="file",
+            output_path=output_path,
+            output_storage_options={},
+            client=client,
+        )
+
+    assert len(client.requests) == 2 * len(etl.FC_VARIABLES)
+    assert client.requests[0]["day"] == ["1", "2", "3"]
+    ds = xr.open_dataset(output_path, engine="zarr")
+    expected = pd.date_range("1959-01-01", "1959-01-05T23:00", freq="h")
+    pd.testing.assert_index_equal(ds.indexes["time"], expected, check_names=False)
+
+
+class FlakyClient(FakeCDSClient):
+    """
+    Fails each request's first `failures` attempts with `error`.
+    """
+
+    def __init__(self, error, failures):
+        super().__init__()
+        self.error = error
+        self.failures = failures
+        self.attempts = 0
+
+    def retrieve(self, name, request, target):
+        with self.lock:
+            self.attempts += 1
+            fail = self.attempts <= self.failures
+        if fail:
+            raise self.error
+        super().retrieve(name, request, target)
+
+
+class FakeCDSBackend:
+    """
+    A local stand-in for ``etl.CDSAPIBackend``. Requests complete after `polls`
+    status checks; those for variables in `fail` fail.
+    """
+
+    def __init__(self, polls=2, fail=()):
+        self.polls = polls
+        self.fail = set(fail)
+        self.client = FakeCDSClient()
+        self.submitted = {}
+        self.checks = {}
+        self.lock = threading.Lock()
+
+    def submit(self, dataset, params):
+        with self.lock:
+            request_id = f"request-{len(self.submitted)}"
+            self.submitted[request_id] = params
+            self.checks[request_id] = 0
+        return request_id
+
+    def status(self, request_id):
+        with self.lock:
+            self.checks[request_id] += 1
+            if self.checks[request_id] < self.polls:
+                return "queued", None
+        if self.submitted[request_id]["variable"] in self.fail:
+            return "failed", "no data"
+        return "completed", None
+
+    def download(self, request_id, target):
+        self.client.retrieve(etl.CDS_DATASET, self.submitted[request_id], target)
+
+
+def test_classify_error():
+    class HTTPError(Exception):
+        def __init__(self, status_code):
+            self.response = type("Response", (), {"status_code": status_code})()
+
+    assert etl.classify_error(HTTPError(429)) == etl.ErrorClass.throttled
+    assert etl.classify_error(HTTPError(503)) == etl.ErrorClass.retryable
+    assert etl.classify_error(HTTPError(400)) == etl.ErrorClass.fatal
+    assert etl.classify_error(ConnectionResetError()) == etl.ErrorClass.retryable
+    assert (
+        etl.classify_error(Exception("Request has been queued too long."))
+        == etl.ErrorClass.throttled
+    )
+    assert (
+        etl.classify_error(Exception("the request you have submitted is not valid"))
+        == etl.ErrorClass.fatal
+    )
+
+
+def test_retry_backs_off_concurrency():
+    client = FlakyClient(Exception("Too many requests"), failures=2)
+    policy = etl.RetryPolicy(base_delay=0)
+    limiter = etl.ConcurrencyLimiter(4)
+    periods = pd.period_range("1959-01-01", periods=1, freq="D")
+    ds = etl.fetch_days(
+        "2m_temperature",
+        periods,
+        "",
+        client=client,
+        retry_policy=policy,
+        limiter=limiter,
+    )
+    assert len(ds.time) == 24
+    assert policy.retries == 2
+    # halved twice, then one additive increase
+    assert limiter.limit == pytest.approx(1 + 1)
+
+    for _ in range(10):
+        limiter.increase()
+    assert limiter.limit == 4
+
+
+def test_retry_fatal_and_budget():
+    periods = pd.period_range("1959-01-01", periods=1, freq="D")
+
+    client = FlakyClient(ValueError("not valid"), failures=1)
+    with pytest.raises(ValueError):
+        etl.fetch_days("2m_temperature", periods, "", client=client)
+    assert client.attempts == 1
+
+    client = FlakyClient(ConnectionResetError(), failures=5)
+    policy = etl.RetryPolicy(base_delay=0, budget=2)
+    with pytest.raises(RuntimeError, match="budget of 2") as info:
+        etl.fetch_days(
+            "2m_temperature", periods, "", client=client, retry_policy=policy
+        )
+    assert isinstance(info.value.__cause__, ConnectionResetError)
+    assert client.attempts == 3
+
+
+def test_do_batch_validates_every_day_before_writing(tmp_path):
+    class MissingHourClient(FakeCDSClient):
+        def retrieve(self, name, request, target):
+            super().retrieve(name, request, f"{target}.full")
+            with etl.OPEN_LOCK:
+                with xr.open_dataset(f"{target}.full") as ds:
+                    ds.isel(time=slice(-1)).to_netcdf(target)
+
+    output_path = tmp_path / "forecast.zarr"
+    with pytest.raises(ValueError, match="Expected 24 hours for 1959-01-02"):
+        etl.do_batch(
+            "forecast",
+            pd.period_range("1959-01-01", periods=2, freq="D"),
+            "",
+            "file",
+            str(output_path),
+            {},
+            client=MissingHourClient(),
+        )
+    assert not output_path.exists()
+
+
+def test_batch_periods():
+    periods = pd.period_range("2000-01-30", "2000-02-05", freq="D")
+    result = etl.batch_periods(periods, days_per_request=4)
+    assert [len(batch) for batch in result] == [2, 4, 1]
+    assert result[1][0] == pd.Period("2000-02-01", freq="D")
+
+
+def test_do_one_raises_on_failure(tmp_path):
+    client = FakeCDSClient(fail=["total_precipitation"])
+    with pytest.raises(RuntimeError, match="total_precipitation"):
+        etl.do_one(
+            "forecast",
+            etl.FIRST_PERIOD,
+            cds_api_key="",
+            output_protocol="file",
+            output_path=str(tmp_path / "forecast.zarr"),
+            output_storage_options={},
+            client=client,
+        )
+
+
+def test_run_pipeline(tmp_path):
+    client = FakeCDSClient()
+    output_path = str(tmp_path / "analysis.zarr")
+    periods = pd.period_range("1959-01-01", "1959-01-04", freq="D")
+    etl.run_pipeline(
+        "analysis",
+        etl.batch_periods(periods, days_per_request=1),
+        cds_api_key="",
+        output_protocol="file",
+        output_path=output_path,
+        output_storage_options={},
+        max_concurrent_requests=2,
+        pipeline_depth=2,
+        client=client,
+    )
+
+    ds = xr.open_dataset(output_path, engine="zarr")
+    expected = pd.date_range("1959-01-01", "1959-01-04T23:00", freq="h")
+    pd.testing.assert_index_equal(ds.indexes["time"], expected, check_names=False)
+
+
+def test_broker(tmp_path):
+    periods = pd.period_range("1959-01-01", "1959-01-04", freq="D")
+    batches = etl.batch_periods(periods, days_per_request=2)
+    state_path = str(tmp_path / "cds_requests.json")
+    fs = fsspec.filesystem("file")
+
+    # a run that stops after submitting leaves its request IDs behind.
+    backend = FakeCDSBackend(polls=1000)
+    broker = etl.CDSBroker(backend, fs, state_path, max_queued=100, poll_interval=0.01)
+    for batch in batches:
+        for variable in etl.AN_VARIABLES:
+            broker.submit(etl.build_batch_query(variable, batch))
+    deadline = time.monotonic() + 10
+    while len(backend.submitted) < len(batches) * len(etl.AN_VARIABLES):
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+    broker.close()
+
+    # the next run picks them up rather than submitting them again.
+    backend.polls = 2
+    broker = etl.CDSBroker(backend, fs, state_path, max_queued=4, poll_interval=0.01)
+    assert len(broker.requests) == len(backend.submitted)
+    output_path = str(tmp_path / "analysis.zarr")
+    try:
+        etl.run_pipeline(
+            "analysis",
+            batches,
+            cds_api_key="",
+            output_protocol="file",
+            output_path=output_path,
+            output_storage_options={},
+            max_concurrent_requests=4,
+            pipeline_depth=2,
+            broker=broker,
+        )
+    finally:
+        broker.close()
+
+    assert len(backend.submitted) == len(batches) * len(etl.AN_VARIABLES)
+    assert broker.requests == {}
+    assert json.loads(fs.cat_file(state_path))["requests"] == {}
+    ds = xr.open_dataset(output_path, engine="zarr")
+    expected = pd.date_range("1959-01-01", "1959-01-04T23:00", freq="h")
+    pd.testing.assert_index_equal(ds.indexes["time"], expected, check_names=False)
+
+
+def test_broker_failed_request(tmp_path):
+    backend = FakeCDSBackend(fail=["2m_temperature"])
+    broker = etl.CDSBroker(
+        backend,
+        fsspec.filesystem("file"),
+        str(tmp_path / "state.json"),
+        poll_interval=0.01,
+    )
+    params = etl.build_batch_query(
+        "2m_temperature", pd.period_range("1959-01-01", periods=1, freq="D")
+    )
+    try:
+        with pytest.raises(etl.CDSRequestFailed, match="no data"):
+            broker.result(params, str(tmp_path / "t2m.nc"))
+    finally:
+        broker.close()
+    # forgotten, so a retry submits it again.
+    assert broker.requests == {}
+
+
+def test_run_pipeline_raises(tmp_path):
+    client = FakeCDSClient(fail=["2m_temperature"])
+    with pytest.raises(RuntimeError, match="2m_temperature"):
+        etl.run_pipeline(
+            "analysis",
+            etl.batch_periods(pd.period_range("1959-01-01", periods=3, freq="D")),
+            cds_api_key="",
+            output_protocol="file",
+            output_path=str(tmp_path / "analysis.zarr"),
+            output_storage_options={},
+            client=client,
+        )
+
+
+def test_run_pipeline_write_error_doesnt_wait_for_downloads(tmp_path, monkeypatch):
+    class SlowClient(FakeCDSClient):
+        def retrieve(self, name, request, target):
+            if request["day"] != ["1"]:
+                time.sleep(60)
+            super().retrieve(name, request, target)
+
+    def write_period(*args, **kwargs):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(etl, "write_period", write_period)
+    monkeypatch.setattr(etl, "PIPELINE_JOIN_TIMEOUT", 0.5)
+    t0 = time.perf_counter()
+    with pytest.raises(OSError, match="disk full"):
+        etl.run_pipeline(
+            "forecast",
+            etl.batch_periods(pd.period_range("1959-01-01", periods=3, freq="D")),
+            cds_api_key="",
+            output_protocol="file",
+            output_path=str(tmp_path / "forecast.zarr"),
+            output_storage_options={},
+            max_concurrent_requests=4,
+            client=SlowClient(),
+        )
+    assert time.perf_counter() - t0 < 30
+
+
+def test_write_region_out_of_order(tmp_path):
+    client = FakeCDSClient()
+    output_path = str(tmp_path / "forecast.zarr")
+    region = pd.period_range("1959-01-01", "1959-01-04", freq="D")
+    write_options = etl.WriteOptions(mode="region", region=region)
+    with pytest.raises(FileNotFoundError, match="pre-allocated"):
+        etl.do_one(
+            "forecast",
+            region[2],
+            cds_api_key="",
+            output_protocol="file",
+            output_path=output_path,
+            output_storage_options={},
+            client=client,
+            write_options=write_options,
+        )
+
+    # a pre-allocation that crashed before writing its metadata is redone.
+    store = fsspec.get_mapper(output_path)
+    store[".zattrs"] = b"{}"
+    write_options = etl.WriteOptions(mode="region", region=region, preallocate=True)
+    for period in [region[2], region[0]]:
+        etl.do_one(
+            "forecast",
+            period,
+            cds_api_key="",
+            output_protocol="file",
+            output_path=output_path,
+            output_storage_options={},
+            client=client,
+            write_options=write_options,
+        )
+
+    assert etl.filled_periods(store) == {region[0], region[2]}
+    assert etl.read_region(store).equals(region)
+    journal = etl.Journal.for_store(store, worker="worker-1")
+    assert journal.path.endswith("_era5/journal-worker-1.json")
+
+    ds = xr.open_dataset(output_path, engine="zarr")
+    pd.testing.assert_index_equal(
+        ds.indexes["time"], etl.hourly_index(region), check_names=False
+    )
+    tp = ds["precipitation_amount_1hour_Accumulation"]
+    assert tp.isel(time=slice(0, 24)).notnull().all()
+    assert tp.isel(time=slice(24, 48)).isnull().all()
+    assert tp.isel(time=slice(48, 72)).notnull().all()
+
+
+@pytest.mark.parametrize("executor", ["processes", "dask"])
+def test_run_backfill(tmp_path, executor):
+    if executor == "dask":
+        pytest.importorskip("distributed")
+    output_path = str(tmp_path / "analysis.zarr")
+    region = pd.period_range("1959-01-01", "1959-01-06", freq="D")
+    write_options = etl.WriteOptions(mode="region", region=region, preallocate=True)
+    metrics = etl.Metrics()
+    progress = etl.run_backfill(
+        "analysis",
+        etl.batch_periods(region[1:], days_per_request=2),
+        cds_api_key="",
+        output_protocol="file",
+        output_path=output_path,
+        output_storage_options={},
+        write_options=write_options,
+        workers=2,
+        executor=executor,
+        client=FakeCDSClient(),
+        metrics=metrics,
+    )
+
+    # the coordinator pre-allocated with the first batch; the workers wrote the rest.
+    assert sum(worker["days"] for worker in progress.values()) == 3
+    assert metrics.counters["backfill_days"] == 3
+    store = fsspec.get_mapper(output_path)
+    assert etl.filled_periods(store) == set(region[1:])
+    # 1959-01-01 isn't filled, so nothing is committed as complete yet.
+    assert etl.HIGH_WATER_MARK not in store
+
+    etl.write_period(
+        etl.combine([make_cds_dataset(v, region[:1]) for v in etl.AN_VARIABLES]),
+        region[0],
+        "file",
+        output_path,
+        {},
+        write_options,
+    )
+    assert etl.commit_backfill(store, region) == region[-1]
+    assert etl.read_last_timestamp(store) == pd.Timestamp("1959-01-06T23:00")
+    ds = xr.open_dataset(output_path, engine="zarr")
+    assert int(ds["air_temperature_at_2_metres"].isnull().sum()) == 0
+
+
+def test_compact_incremental(tmp_path):
+    client = FakeCDSClient()
+    output_path = str(tmp_path / "forecast.zarr")
+    store = fsspec.get_mapper(output_path)
+    periods = pd.period_range("1959-01-01", periods=5, freq="D")
+
+    for i, period in enumerate(periods, 1):
+        etl.do_one("forecast", period, "", "file", output_path, {}, client=client)
+        if i in (3, 5):
+            etl.compact_incremental(store)
+            time_keys = sorted(k for k in store if k.startswith("time/"))
+            assert time_keys == ["time/.zarray", "time/.zattrs", "time/0"]
+
+    ds = xr.open_dataset(output_path, engine="zarr")
+    assert ds.time.encoding["chunks"] == (120,)
+    pd.testing.assert_index_equal(
+        ds.indexes["time"], etl.hourly_index(periods), check_names=False
+    )
+
+
+def test_download_cache(tmp_path):
+    client = FakeCDSClient()
+    cache = etl.DownloadCache(str(tmp_path / "cache"))
+    periods = pd.period_range("2000-01-01", periods=2, freq="D")
+
+    first = etl.fetch_days("2m_temperature", periods, "", client=client, cache=cache)
+    second = etl.fetch_days("2m_temperature", periods, "", client=client, cache=cache)
+    assert len(client.requests) == 1
+    xr.testing.assert_identical(first.load(), second.load())
+
+    # a corrupt entry is downloaded again
+    key = cache.key(etl.CDS_DATASET, client.requests[0])
+    with open(cache.path(key), "ab") as f:
+        f.write(b"garbage")
+    etl.fetch_days("2m_temperature", periods, "", client=client, cache=cache)
+    assert len(client.requests) == 2
+
+    # the ETL releases its downloads once they're written, so they can be evicted.
+    small = etl.DownloadCache(str(tmp_path / "small"), max_bytes=0)
+    etl.do_batch(
+        "forecast",
+        pd.period_range(etl.FIRST_PERIOD, periods=2, freq="D"),
+        "",
+        "file",
+        str(tmp_path / "forecast.zarr"),
+        {},
+        client=client,
+        cache=small,
+    )
+    assert not list((tmp_path / "small").glob("*.nc"))
+
+
+def test_download_cache_evicts(tmp_path):
+    cache = etl.DownloadCache(str(tmp_path), max_bytes=25, part_max_age=60)
+    stale = cache.temporary_path()
+    with open(stale, "wb") as f:
+        f.write(b"x" * 100)
+    os.utime(stale, (time.time() - 120,) * 2)
+
+    def size():
+        return sum(p.stat().st_size for p in tmp_path.glob("*.nc"))
+
+    pinned = None
+    for i in range(5):
+        tmp = cache.temporary_path()
+        with open(tmp, "wb") as f:
+            f.write(b"x" * 10)
+        path = cache.put(str(i), tmp)
+        if i == 0:
+            # held open until the end; never evicted while pinned.
+            pinned = path
+        else:
+            cache.release(path)
+        assert size() <= 25 + 10
+        time.sleep(0.01)
+
+    assert not os.path.exists(stale)
+    assert os.path.exists(pinned)
+    assert cache.get("1") is None
+    assert cache.get("4") is not None
+
+    # once released, it's evicted like any other entry.
+    cache.release(pinned)
+    tmp = cache.temporary_path()
+    with open(tmp, "wb") as f:
+        f.write(b"x" * 10)
+    cache.release(cache.put("5", tmp))
+    assert not os.path.exists(pinned)
+    assert size() <= 25
+
+
+def test_journal_recovers_partial_append(tmp_path):
+    client = FakeCDSClient()
+    output_path = str(tmp_path / "forecast.zarr")
+    store = fsspec.get_mapper(output_path)
+    journal = etl.Journal.for_store(store)
+    periods = pd.period_range("1959-01-01", periods=3, freq="D")
+    for period in periods[:2]:
+        etl.do_one(
+            "forecast",
+            period,
+            "",
+            "file",
+            output_path,
+            {},
+            client=client,
+            journal=journal,
+        )
+    assert journal.periods == {}
+    assert journal.state["last_committed"] == "1959-01-02"
+
+    # Simulate a crash partway through appending the third day.
+    journal.begin(periods[2], 48)
+    name = "precipitation_amount_1hour_Accumulation"
+    zarr.open_array(store, path=name, mode="r+").resize(72, 5, 8)
+
+    journal = etl.Journal.for_store(store)
+    assert journal.periods == {"1959-01-03": {"time_length": 48}}
+    journal.recover(store)
+    assert set(etl.time_lengths(store).values()) == {48}
+    assert journal.periods == {}
+
+    etl.do_one(
+        "forecast",
+        periods[2],
+        "",
+        "file",
+        output_path,
+        {},
+        client=client,
+        journal=journal,
+    )
+    assert journal.periods == {}
+    ds = xr.open_dataset(output_path, engine="zarr")
+    pd.testing.assert_index_equal(
+        ds.indexes["time"], etl.hourly_index(periods), check_names=False
+    )
+
+
+def test_journal_recovers_complete_append(tmp_path):
+    client = FakeCDSClient()
+    output_path = str(tmp_path / "forecast.zarr")
+    store = fsspec.get_mapper(output_path)
+    periods = pd.period_range("1959-01-01", periods=2, freq="D")
+    etl.do_one("forecast", periods[0], "", "file", output_path, {}, client=client)
+    metadata = store[".zmetadata"]
+
+    # Simulate a crash after every array was appended, but before the
+    # consolidated metadata was updated.
+    journal = etl.Journal.for_store(store)
+    journal.begin(periods[1], 24)
+    etl.do_one("forecast", periods[1], "", "file", output_path, {}, client=client)
+    store[".zmetadata"] = metadata
+
+    journal = etl.Journal.for_store(store)
+    journal.recover(store)
+    assert journal.periods == {}
+    assert journal.state["last_committed"] == "1959-01-02"
+    ds = xr.open_dataset(output_path, engine="zarr")
+    pd.testing.assert_index_equal(
+        ds.indexes["time"], etl.hourly_index(periods), check_names=False
+    )
+
+
+def test_read_last_timestamp(tmp_path):
+    client = FakeCDSClient()
+    output_path = str(tmp_path / "forecast.zarr")
+    store = fsspec.get_mapper(output_path)
+    assert etl.read_last_timestamp(store) is None
+
+    for period in pd.period_range("1959-01-01", periods=2, freq="D"):
+        etl.do_one("forecast", period, "", "file", output_path, {}, client=client)
+
+    expected = pd.Timestamp("1959-01-02T23:00")
+    assert etl.read_last_timestamp(store) == expected
+
+    # a stale or missing high-water mark falls back to the last chunk of time
+    store[etl.HIGH_WATER_MARK] = b'{"last": "1959-01-01T23:00", "time_length": 24}'
+    assert etl.read_last_timestamp(store) == expected
+    del store[etl.HIGH_WATER_MARK]
+    assert etl.read_last_timestamp(store) == expected
+
+    last, period = etl.determine_next_period("file", output_path, {})
+    assert last == expected
+    assert period == pd.Period("1959-01-03", freq="D")
+
+
+def to_cfgrib(ds: xr.Dataset, accumulated: bool) -> xr.Dataset:
+    """
+    `ds`, a NetCDF-shaped download, shaped as cfgrib decodes the GRIB download of
+    the same request.
+    """
+    (name,) = ds.data_vars
+    attrs = {"GRIB_paramId": 0, "GRIB_shortName": name, **ds[name].attrs}
+    coords = {
+        "number": 0,
+        "surface": 0.0,
+        "latitude": (
+            "latitude",
+            ds.latitude.data.astype("float64"),
+            {"units": "degrees_north", "stored_direction": "decreasing"},
+        ),
+        "longitude": (
+            "longitude",
+            ds.longitude.data.astype("float64"),
+            {"units": "degrees_east"},
+        ),
+    }
+    valid = ds.indexes["time"]
+    if accumulated:
+        # fields valid at each hour come from the last 06 or 18 UTC forecast before it.
+        six = pd.Timedelta("6h")
+        reference = (valid - pd.Timedelta("1h") - six).floor("12h") + six
+        times = reference.unique()
+        steps = pd.timedelta_range("1h", "12h", freq="h")
+        data = np.full((len(times), len(steps)) + ds[name].shape[1:], np.nan, "float32")
+        for i, (t, r) in enumerate(zip(valid, reference)):
+            data[times.get_loc(r), steps.get_loc(t - r)] = ds[name].values[i]
+        grid = times.values[:, None] + steps.values[None, :]
+        dims = ("time", "step", "latitude", "longitude")
+        coords.update(time=times, step=steps, valid_time=(("time", "step"), grid))
+    else:
+        data = ds[name].values
+        dims = ("time", "latitude", "longitude")
+        coords.update(time=valid, step=pd.Timedelta(0), valid_time=("time", valid))
+    return xr.Dataset(
+        {name: (dims, data, attrs)},
+        coords=coords,
+        attrs={"GRIB_edition": 1, "Conventions": "CF-1.7", "history": "cfgrib"},
+    )
+
+
+@pytest.mark.parametrize(
+    "variable, accumulated",
+    [("2m_temperature", False), ("total_precipitation", True)],
+)
+def test_normalize_grib(variable, accumulated):
+    periods = pd.period_range("1959-01-01", "1959-01-02", freq="D")
+    netcdf = make_cds_dataset(variable, periods)
+    (name,) = netcdf.data_vars
+    netcdf[name].attrs["long_name"] = name
+    netcdf["time"].attrs["long_name"] = "time"
+    netcdf.attrs.update(etl.CDS_NETCDF_ATTRS)
+    grib = to_cfgrib(netcdf, accumulated)
+
+    result = etl.transform(etl.normalize_grib(grib))
+    xr.testing.assert_identical(result, etl.transform(netcdf))
+    assert ("time1_bounds" in result) == accumulated
+
+
+def test_manifest(tmp_path):
+    output_path = str(tmp_path / "analysis.zarr")
+    store = fsspec.get_mapper(output_path)
+    periods = pd.period_range("1959-01-01", periods=3, freq="D")
+    etl.do_batch(
+        "analysis", periods, "", "file", output_path, {}, client=FakeCDSClient()
+    )
+
+    manifest = etl.read_manifest(store)
+    assert list(manifest["days"]) == [str(p) for p in periods]
+    entry = manifest["days"]["1959-01-02"]
+    assert entry["hours"] == 24 and entry["expver"] is None and entry["bytes"] > 0
+    assert etl.verify_manifest(store) == []
+    assert list(etl.find_gaps(store, pd.period_range("1959-01-01", periods=5))) == list(
+        pd.period_range("1959-01-04", periods=2, freq="D")
+    )
+
+    name = "air_temperature_at_2_metres"
+    zarr.open_array(store, path=name, mode="r+")[30] = 0
+    assert etl.verify_manifest(store) == [periods[1]]
+
+    with_expver = make_cds_dataset("2m_temperature", periods[:1]).assign(
+        expver=("time", np.full(24, 5))
+    )
+    assert etl.download_expver([with_expver, with_expver]) == [5]
+
+    # appends must continue the store.
+    ds = etl.combine([make_cds_dataset(v, periods[-1:] + 2) for v in etl.AN_VARIABLES])
+    with pytest.raises(ValueError, match="ending at 1959-01-03 23:00"):
+        etl.write_period(ds, periods[-1] + 2, "file", output_path, {})
+
+
+def test_fill_gaps(tmp_path):
+    client = FakeCDSClient()
+    output_path = str(tmp_path / "analysis.zarr")
+    store = fsspec.get_mapper(output_path)
+    periods = pd.period_range("1959-01-01", periods=3, freq="D")
+    # one day per request, so the same day downloads the same data again.
+    for period in periods:
+        etl.do_one("analysis", period, "", "file", output_path, {}, client=client)
+    etl.compact_incremental(store)
+
+    name = "air_temperature_at_2_metres"
+    expected = xr.open_zarr(store)[name].load()
+    zarr.open_array(store, path=name, mode="r+")[24:48] = 0
+    # a preliminary day, and one missing from the manifest.
+    etl.update_manifest(store, {"1959-01-02": {"hours": 24, "expver": [5]}})
+    manifest = json.loads(store[etl.MANIFEST])
+    del manifest["days"]["1959-01-03"]
+    store[etl.MANIFEST] = json.dumps(manifest).encode()
+
+    client.requests.clear()
+    filled = etl.fill_gaps("analysis", "", "file", output_path, {}, client=client)
+
+    assert list(filled) == list(periods[1:])
+    assert {day for r in client.requests for day in r["day"]} == {"2", "3"}
+    xr.testing.assert_identical(xr.open_zarr(store)[name].load(), expected)
+    assert etl.verify_manifest(store) == []
+    assert list(etl.find_gaps(store, periods)) == []
+    assert not store.fs.exists(f"{store.root}/{etl.SIDECAR}/filled")
+
+
+def test_encoding_profiles(tmp_path):
+    client = FakeCDSClient()
+    output_path = str(tmp_path / "forecast.zarr")
+    name = "precipitation_amount_1hour_Accumulation"
+    write_options = etl.WriteOptions(
+        encoding_profile="zstd", variable_encoding_profiles={name: "zstd-tiled"}
+    )
+    for period in pd.period_range("1959-01-01", periods=2, freq="D"):
+        etl.do_one(
+            "forecast",
+            period,
+            "",
+            "file",
+            output_path,
+            {},
+            client=client,
+            write_options=write_options,
+        )
+
+    group = zarr.open_group(output_path, mode="r")
+    assert group[name].chunks == (24, 5, 8)
+    assert group[name].compressor.cname == "zstd"
+    profiles = group.attrs["era5:encoding_profiles"]
+    assert profiles[name]["name"] == "zstd-tiled"
+    assert profiles["air_temperature_at_2_metres_1hour_Maximum"]["name"] == "zstd"
+    assert "time1_bounds" not in profiles
+
+
+@pytest.mark.parametrize("packing", ["cf", "filter"])
+def test_packing(tmp_path, packing):
+    name = "air_temperature_at_2_metres"
+    periods = pd.period_range("1959-01-01", periods=2, freq="D")
+    for path, write_options in [
+        ("float.zarr", etl.WriteOptions()),
+        ("packed.zarr", etl.WriteOptions(packing=packing)),
+    ]:
+        for period in periods:
+            ds = etl.transform(
+                make_cds_dataset("2m_temperature", pd.PeriodIndex([period]))
+            )
+            # as opened from a CDS download, packed with that file's own range.
+            ds[name].encoding.update(
+                dtype="int16", scale_factor=0.001, add_offset=275.0
+            )
+            etl.write_period(
+                ds, period, "file", str(tmp_path / path), {}, write_options
+            )
+
+    expected = xr.open_dataset(tmp_path / "float.zarr", engine="zarr")[name]
+    result = xr.open_dataset(tmp_path / "packed.zarr", engine="zarr")[name]
+    parameters = etl.packing_parameters(name, packing)
+    assert result.dtype == ("float64" if packing == "cf" else "float32")
+    # plus float32 rounding at the top of the range.
+    bound = parameters["max_error"] + np.spacing(np.float32(parameters["valid_max"]))
+    assert float(abs(result - expected).max()) <= bound
+    assert len(result.time) == 48
+
+    assert zarr.open_group(str(tmp_path / "float.zarr"))[name].dtype == "float32"
+    array = zarr.open_group(str(tmp_path / "packed.zarr"), mode="r")[name]
+    if packing == "cf":
+        assert array.dtype == "int16"
+    else:
+        assert array.dtype == "float32"
+        assert array.filters[0].astype == "<i2"
+    assert (
+        zarr.open_group(str(tmp_path / "packed.zarr"), mode="r").attrs["era5:packing"][
+            name
+        ]
+        == parameters
+    )
+
+    assert etl.verify_manifest(fsspec.get_mapper(str(tmp_path / "packed.zarr"))) == []
+
+    # values that don't fit raise rather than wrapping around.
+    ds = etl.transform(
+        make_cds_dataset("2m_temperature", pd.PeriodIndex([periods[-1] + 1]))
+    )
+    ds[name][0, 0, 0] = 400.0
+    with pytest.raises(ValueError, match="outside its packed range"):
+        etl.write_period(
+            ds,
+            periods[-1] + 1,
+            "file",
+            str(tmp_path / "packed.zarr"),
+            {},
+            etl.WriteOptions(packing=packing),
+        )
+
+
+def test_update_timeseries_replica(tmp_path):
+    client = FakeCDSClient()
+    output_path = str(tmp_path / "forecast.zarr")
+    replica_path = etl.derived_path(output_path, "timeseries")
+    assert replica_path == str(tmp_path / "forecast-timeseries.zarr")
+    source, replica = fsspec.get_mapper(output_path), fsspec.get_mapper(replica_path)
+
+    # 4 rows of 48 hours, 8 longitudes, and 8-byte values per pass.
+    kwargs = dict(time_chunk=48, lat_chunk=2, lon_chunk=4, max_bytes=4 * 48 * 8 * 8)
+    for i, period in enumerate(pd.period_range("1959-01-01", periods=5, freq="D")):
+        etl.do_one("forecast", period, "", "file", output_path, {}, client=client)
+        etl.update_timeseries_replica(source, replica, **kwargs)
+
+    expected = xr.open_dataset(output_path, engine="zarr")
+    result = xr.open_dataset(replica_path, engine="zarr")
+    assert len(result.time) == 96
+    name = "precipitation_amount_1hour_Accumulation"
+    assert result[name].encoding["chunks"] == (48, 2, 4)
+    xr.testing.assert_identical(result, expected.isel(time=slice(96)))
+
+    assert etl.update_timeseries_replica(source, replica, flush=True, **kwargs) == 24
+    result = xr.open_dataset(replica_path, engine="zarr")
+    xr.testing.assert_identical(result, expected)
+
+
+def test_metrics(tmp_path):
+    jsonl = tmp_path / "metrics.jsonl"
+    prom = tmp_path / "era5.prom"
+    metrics = etl.Metrics(str(jsonl), str(prom), kind="forecast")
+
+    output_path = str(tmp_path / "forecast.zarr")
+    periods = pd.period_range("1959-01-01", periods=2, freq="D")
+    etl.do_batch(
+        "forecast",
+        periods,
+        "",
+        "file",
+        output_path,
+        {},
+        client=FakeCDSClient(),
+        metrics=metrics,
+    )
+    summary = metrics.finish()
+
+    records = [json.loads(line) for line in jsonl.read_text().splitlines()]
+    spans = [r for r in records if r["type"] == "span"]
+    downloads = [r for r in spans if r["stage"] == "download"]
+    assert {r["variable"] for r in downloads} == set(etl.FC_VARIABLES)
+    assert all(r["bytes"] > 0 and r["kind"] == "forecast" for r in downloads)
+    writes = [r for r in spans if r["stage"] == "write"]
+    assert [r["period"] for r in writes] == ["1959-01-01", "1959-01-02"]
+    transforms = [r for r in spans if r["stage"] == "transform"]
+    assert {(r["period"], r["variable"]) for r in transforms} == {
+        (str(period), SHORT_NAMES[etl.filenames_to_keys[v]])
+        for period in periods
+        for v in etl.FC_VARIABLES
+    }
+    assert records[-1]["type"] == "summary"
+
+    stages = summary["stages"]
+    assert stages["download"]["count"] == len(etl.FC_VARIABLES)
+    assert stages["write"]["count"] == stages["combine"]["count"] == 2
+    assert stages["write"]["logical_bytes"] == sum(r["logical_bytes"] for r in writes)
+
+    text = prom.read_text()
+    assert 'era5_etl_stage_count_total{stage="write",kind="forecast"} 2' in text
+    assert "era5_etl_peak_rss_bytes" in text
+
+
+def test_kinds_share_limiter_and_metrics(tmp_path):
+    # as `run` does for several kinds: concurrently, into separate stores.
+    client = FakeCDSClient(delay=0.05)
+    metrics = etl.Metrics(kind="analysis,forecast")
+    limiter = etl.ConcurrencyLimiter(3)
+    periods = pd.period_range("1959-01-01", periods=2, freq="D")
+    threads = [
+        threading.Thread(
+            target=etl.do_batch,
+            args=(kind, periods, "", "file", str(tmp_path / f"{kind}.zarr"), {}),
+            kwargs=dict(
+                max_concurrent_requests=3,
+                client=client,
+                metrics=metrics.tagged(kind=kind),
+                limiter=limiter,
+            ),
+        )
+        for kind in ["analysis", "forecast"]
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert client.max_in_flight <= 3
+    for kind in ["analysis", "forecast"]:
+        ds = xr.open_dataset(tmp_path / f"{kind}.zarr", engine="zarr")
+        assert len(ds.time) == 48
+        assert metrics.stages[("write", kind)]["count"] == 2
+    assert metrics.summary()["stages"]["write"]["count"] == 4
+
+
+@pytest.mark.parametrize("mode", ["append", "region"])
+def test_streaming_writes(tmp_path, mode):
+    client = FakeCDSClient()
+    periods = pd.period_range("1959-01-01", "1959-01-03", freq="D")
+    stores = {}
+    for streaming in [False, True]:
+        output_path = str(tmp_path / f"streaming-{streaming}.zarr")
+        write_options = etl.WriteOptions(
+            mode=mode,
+            region=periods if mode == "region" else None,
+            preallocate=mode == "region",
+            streaming=streaming,
+        )
+        for period in periods:
+            etl.do_one(
+                "forecast",
+                period,
+                cds_api_key="",
+                output_protocol="file",
+                output_path=output_path,
+                output_storage_options={},
+                client=client,
+                write_options=write_options,
+            )
+        store = fsspec.get_mapper(output_path)
+        stores[streaming] = {
+            k: store[k] for k in store if not k.startswith(etl.SIDECAR)
+        }
+
+    assert stores[True].keys() == stores[False].keys()
+    for key, value in stores[False].items():
+        assert stores[True][key] == value, key
+
+
+def test_aggregates(tmp_path):
+    client = FakeCDSClient()
+    output_path = str(tmp_path / "forecast.zarr")
+    periods = pd.period_range("1959-01-01", "1959-02-01", freq="D")
+    for period in periods:
+        etl.do_one(
+            "forecast",
+            period,
+            cds_api_key="",
+            output_protocol="file",
+            output_path=output_path,
+            output_storage_options={},
+            client=client,
+            # days the aggregates missed are caught up from the hourly store.
+            write_options=etl.WriteOptions(aggregates=period.day not in (20, 21)),
+        )
+
+    hourly = xr.open_zarr(output_path).load()
+    daily = xr.open_zarr(str(tmp_path / "forecast-daily.zarr")).load()
+    monthly = xr.open_zarr(str(tmp_path / "forecast-monthly.zarr")).load()
+    assert set(daily.data_vars) == {
+        "air_temperature_at_2_metres_1hour_Maximum_max",
+        "air_temperature_at_2_metres_1hour_Minimum_min",
+        "precipitation_amount_1hour_Accumulation_sum",
+        "integral_wrt_time_of_surface_direct_downwelling_shortwave_flux_in_air_1hour_Accumulation_sum",  # noqa: E501
+    }
+    assert daily["precipitation_amount_1hour_Accumulation_sum"].attrs[
+        "cell_methods"
+    ] == ("time: sum")
+
+    for ds, freq in [(daily, "D"), (monthly, "MS")]:
+        expected = {
+            "air_temperature_at_2_metres_1hour_Maximum_max": hourly[
+                "air_temperature_at_2_metres_1hour_Maximum"
+            ]
+            .resample(time=freq)
+            .max(),
+            "precipitation_amount_1hour_Accumulation_sum": hourly[
+                "precipitation_amount_1hour_Accumulation"
+            ]
+            .resample(time=freq)
+            .sum(),
+        }
+        if freq == "MS":
+            # February isn't complete.
+            expected = {k: v.isel(time=[0]) for k, v in expected.items()}
+        for name, values in expected.items():
+            np.testing.assert_allclose(ds[name], values, rtol=1e-5)
+            pd.testing.assert_index_equal(ds.indexes["time"], values.indexes["time"])
+
+    store = fsspec.get_mapper(str(tmp_path / "forecast-monthly.zarr"))
+    state, accumulator = etl.read_accumulator(store)
+    assert state["month"] == "1959-02" and state["days"] == 1
+    np.testing.assert_allclose(
+        accumulator["precipitation_amount_1hour_Accumulation_sum"],
+        daily["precipitation_amount_1hour_Accumulation_sum"].isel(time=[-1]),
+    )
+
+    # a day rewritten in place is re-aggregated, along with its month.
+    day = pd.Period("1959-01-10", freq="D")
+    rewritten = hourly.sel(time="1959-01-10") + 1
+    etl.rewrite_aggregates(
+        rewritten,
+        day,
+        fsspec.get_mapper(str(tmp_path / "forecast-daily.zarr")),
+        store,
+    )
+    name = "precipitation_amount_1hour_Accumulation_sum"
+    after = xr.open_zarr(str(tmp_path / "forecast-daily.zarr"))[name]
+    np.testing.assert_allclose(
+        after.sel(time="1959-01-10"),
+        daily[name].sel(time="1959-01-10") + 24,
+        rtol=1e-6,
+    )
+    after = xr.open_zarr(str(tmp_path / "forecast-monthly.zarr"))[name]
+    np.testing.assert_allclose(
+        after.isel(time=0), monthly[name].isel(time=0) + 24, rtol=1e-5
+    )
+
+
+def test_overviews(tmp_path):
+    client = FakeCDSClient()
+    output_path = str(tmp_path / "forecast.zarr")
+    for period in pd.period_range("1959-01-01", "1959-01-03", freq="D"):
+        etl.do_one(
+            "forecast",
+            period,
+            cds_api_key="",
+            output_protocol="file",
+            output_path=output_path,
+            output_storage_options={},
+            client=client,
+            # a day the overviews missed is caught up from the hourly store.
+            write_options=etl.WriteOptions(overviews=period.day != 2),
+        )
+
+    hourly = xr.open_zarr(output_path).load()
+    maximum = "air_temperature_at_2_metres_1hour_Maximum"
+    precipitation = "precipitation_amount_1hour_Accumulation"
+    for factor, shape in [(2, (3, 4)), (4, (2, 2)), (8, (1, 1))]:
+        path = str(tmp_path / f"forecast-overview-{factor}x.zarr")
+        overview = xr.open_zarr(path).load()
+        assert overview.attrs["era5:overview_factor"] == factor
+        assert overview[precipitation].shape == (72,) + shape
+        assert overview[maximum].attrs["cell_methods"] == "area: maximum"
+        coarsen = hourly.coarsen(lat=factor, lon=factor, boundary="pad")
+        xr.testing.assert_allclose(overview[maximum], coarsen.max()[maximum])
+        xr.testing.assert_allclose(
+            overview[precipitation], coarsen.mean()[precipitation]
+        )
+
+    # a day rewritten in place is rewritten in the overviews too.
+    day = hourly.sel(time="1959-01-02")
+    etl.rewrite_overviews(
+        day + 1,
+        pd.Period("1959-01-02", freq="D"),
+        {2: fsspec.get_mapper(str(tmp_path / "forecast-overview-2x.zarr"))},
+    )
+    overview = xr.open_zarr(str(tmp_path / "forecast-overview-2x.zarr"))
+    expected = day.coarsen(lat=2, lon=2, boundary="pad").mean()[precipitation] + 1
+    xr.testing.assert_allclose(overview[precipitation].sel(time="1959-01-02"), expected)
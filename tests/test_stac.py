@@ -1,5 +1,12 @@
+import datetime
+import json
+
+import numpy as np
+import pandas as pd
 import planetary_computer.sas
+import pystac
 import pytest
+import xarray as xr
 
 from stactools.era5 import stac
 
@@ -26,3 +33,145 @@ def test_create_item(kind):
         "storage_options": {"account_name": "cpdataeuwest"},
     }
     assert result.id == f"era5-{kind}"
+
+
+def make_store(path, times):
+    lat = np.linspace(90, -90, 5, dtype="float32")
+    lon = np.linspace(0, 315, 8, dtype="float32")
+    data = np.random.default_rng(0).uniform(250, 300, (len(times), 5, 8))
+    bounds = np.stack([times - pd.Timedelta("1h"), times], axis=1)
+    attrs = {"long_name": "2 metre temperature", "units": "K"}
+    ds = xr.Dataset(
+        {
+            "air_temperature_at_2_metres": (("time", "lat", "lon"), data, attrs),
+            "time1_bounds": (("time", "nv"), bounds),
+        },
+        coords={"time": times, "lat": lat, "lon": lon},
+    )
+    ds.time.attrs["long_name"] = "time"
+    ds.lat.attrs["long_name"] = "latitude"
+    ds.lon.attrs["long_name"] = "longitude"
+    encoding = {
+        "air_temperature_at_2_metres": {
+            "dtype": "int16",
+            "scale_factor": 0.01,
+            "add_offset": 275.0,
+            "_FillValue": -32767,
+        },
+        "time": {"chunks": (24,)},
+    }
+    ds.to_zarr(str(path), encoding=encoding, consolidated=True)
+
+
+@pytest.fixture
+def no_validate(monkeypatch):
+    # Validation fetches the extension schemas over the network.
+    monkeypatch.setattr(pystac.Item, "validate", lambda self: [])
+    monkeypatch.setattr(pystac.Collection, "validate", lambda self: [])
+
+
+def test_create_item_metadata_only(tmp_path, no_validate):
+    times = pd.date_range("1959-01-01", periods=72, freq="h")
+    make_store(tmp_path / "forecast.zarr", times)
+    path = str(tmp_path / "forecast.zarr")
+
+    expected = stac.create_item(
+        path, kind="forecast", protocol="file", metadata_only=False
+    ).to_dict()
+    result = stac.create_item(path, kind="forecast", protocol="file").to_dict()
+
+    assert result == expected
+    assert result["properties"]["end_datetime"] == "1959-01-03T23:00:00Z"
+
+
+def test_create_item_aggregate_assets(tmp_path, no_validate):
+    times = pd.date_range("1959-01-01", periods=48, freq="h")
+    make_store(tmp_path / "forecast.zarr", times)
+
+    item = stac.create_item(
+        str(tmp_path / "forecast.zarr"),
+        kind="fc",
+        protocol="file",
+        daily_path="era5/forecast-daily.zarr",
+        monthly_path="era5/forecast-monthly.zarr",
+    )
+
+    assert item.assets["daily"].href == "file://era5/forecast-daily.zarr"
+    assert item.assets["monthly"].href == "file://era5/forecast-monthly.zarr"
+    assert "timeseries" not in item.assets
+
+
+def test_create_item_overview_assets(tmp_path, no_validate):
+    times = pd.date_range("1959-01-01", periods=48, freq="h")
+    make_store(tmp_path / "forecast.zarr", times)
+
+    item = stac.create_item(
+        str(tmp_path / "forecast.zarr"),
+        kind="fc",
+        protocol="file",
+        overview_paths={4: "era5/forecast-overview-4x.zarr"},
+    )
+
+    asset = item.assets["overview-4x"]
+    assert asset.href == "file://era5/forecast-overview-4x.zarr"
+    # the test grid's step is 45 degrees.
+    assert asset.extra_fields["era5:resolution"] == 180.0
+    assert asset.extra_fields["era5:overview_factor"] == 4
+
+
+def test_create_collection_extent(tmp_path, no_validate):
+    make_store(tmp_path / "an.zarr", pd.date_range("1959-01-01", periods=48, freq="h"))
+    make_store(
+        tmp_path / "fc.zarr", pd.date_range("1959-01-01T07", periods=72, freq="h")
+    )
+
+    collection = stac.create_collection(
+        (str(tmp_path / "an.zarr"), str(tmp_path / "fc.zarr")),
+        ("an", "fc"),
+        "file",
+    )
+
+    extent = collection.extra_fields["cube:dimensions"]["time"]["extent"]
+    assert extent == ["1959-01-01T00:00:00Z", "1959-01-04T06:00:00Z"]
+    (interval,) = collection.extent.temporal.intervals
+    assert interval[1] == datetime.datetime(1959, 1, 4, 6, tzinfo=datetime.timezone.utc)
+
+
+@pytest.mark.parametrize("frequency", ["month", "year"])
+def test_create_items(tmp_path, no_validate, frequency):
+    times = pd.date_range("1959-12-30", "1960-02-01T23:00", freq="h")
+    make_store(tmp_path / "forecast.zarr", times)
+
+    with open(tmp_path / "items.ndjson", "w") as f:
+        n = stac.write_ndjson(
+            stac.create_items(
+                str(tmp_path / "forecast.zarr"), "fc", "file", frequency=frequency
+            ),
+            f,
+        )
+    with open(tmp_path / "items.ndjson") as f:
+        items = [json.loads(line) for line in f]
+
+    expected = {
+        "month": [
+            ("era5-fc-1959-12", "1959-12-30T00:00:00Z", "1959-12-31T23:00:00Z", 48),
+            ("era5-fc-1960-01", "1960-01-01T00:00:00Z", "1960-01-31T23:00:00Z", 744),
+            ("era5-fc-1960-02", "1960-02-01T00:00:00Z", "1960-02-01T23:00:00Z", 24),
+        ],
+        "year": [
+            ("era5-fc-1959", "1959-12-30T00:00:00Z", "1959-12-31T23:00:00Z", 48),
+            ("era5-fc-1960", "1960-01-01T00:00:00Z", "1960-02-01T23:00:00Z", 768),
+        ],
+    }[frequency]
+    assert n == len(items) == len(expected)
+    for item, (item_id, start, end, hours) in zip(items, expected):
+        properties = item["properties"]
+        assert item["id"] == item_id
+        assert (properties["start_datetime"], properties["end_datetime"]) == (
+            start,
+            end,
+        )
+        assert properties["cube:dimensions"]["time"]["extent"] == [start, end]
+        variables = properties["cube:variables"]
+        assert variables["air_temperature_at_2_metres"]["shape"] == [hours, 5, 8]
+        assert variables["time1_bounds"]["shape"] == [hours, 2]
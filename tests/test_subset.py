@@ -0,0 +1,95 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+
+from stactools.era5 import open_subset
+
+
+@pytest.fixture
+def store(tmp_path):
+    times = pd.date_range("1959-01-01", periods=72, freq="h")
+    lat = np.linspace(90, -90, 13, dtype="float32")
+    lon = np.arange(0, 360, 15, dtype="float32")
+    rng = np.random.default_rng(0)
+    shape = (len(times), len(lat), len(lon))
+    sst = rng.uniform(270, 300, shape)
+    sst[:, :3] = np.nan
+    ds = xr.Dataset(
+        {
+            "air_temperature_at_2_metres": (
+                ("time", "lat", "lon"),
+                rng.uniform(250, 300, shape).astype("float32"),
+                {"units": "K"},
+            ),
+            "sea_surface_temperature": (("time", "lat", "lon"), sst, {"units": "K"}),
+            "time1_bounds": (
+                ("time", "nv"),
+                np.stack([times - pd.Timedelta("1h"), times], axis=1),
+            ),
+        },
+        coords={"time": times, "lat": lat, "lon": lon},
+        attrs={"institution": "ECMWF"},
+    )
+    ds.lat.attrs["long_name"] = "latitude"
+    ds.lon.attrs["long_name"] = "longitude"
+    encoding = {
+        "air_temperature_at_2_metres": {"chunks": (24, 5, 7)},
+        "sea_surface_temperature": {
+            "chunks": (24, 5, 7),
+            "dtype": "int16",
+            "scale_factor": 0.001,
+            "add_offset": 285.0,
+            "_FillValue": -32768,
+        },
+        "time": {"chunks": (24,)},
+    }
+    path = str(tmp_path / "analysis.zarr")
+    ds.to_zarr(path, encoding=encoding, consolidated=True)
+    return path
+
+
+@pytest.mark.parametrize(
+    "bbox",
+    [None, (20.0, -30.0, 100.0, 40.0), (-10.0, -90.0, 10.0, 90.0), (300, 0, 30, 60)],
+)
+def test_open_subset(store, bbox):
+    time_range = ("1959-01-01T20:00", "1959-01-02T05:00")
+    result = open_subset(f"file://{store}", time_range=time_range, bbox=bbox)
+
+    expected = xr.open_zarr(store).sel(time=slice(*time_range))
+    if bbox is not None:
+        west, south, east, north = bbox
+        expected = expected.sel(lat=slice(north, south))
+        # roll the grid to start at the west edge, in the bbox's convention.
+        lon = (expected.lon - west) % 360
+        expected = (
+            expected.assign_coords(
+                lon=((lon + west).astype("float32").assign_attrs(expected.lon.attrs))
+            )
+            .sortby(lon)
+            .sel(lon=slice(west, west + (east - west) % 360))
+        )
+    xr.testing.assert_identical(result, expected.load())
+    assert not any(v.chunks for v in result.variables.values())
+    assert result.sizes["time"] == 10
+
+
+def test_open_subset_variables(store):
+    # a chunk that was never written reads as the fill value.
+    os.remove(os.path.join(store, "sea_surface_temperature", "0.0.0"))
+    result = open_subset(
+        store,
+        variables=["sea_surface_temperature"],
+        time_range=("1959-01-01", "1959-01-02"),
+        bbox=(0, -30, 30, 90),
+    )
+
+    assert list(result.data_vars) == ["sea_surface_temperature"]
+    assert result.sea_surface_temperature.encoding["dtype"] == "int16"
+    sst = result.sea_surface_temperature
+    assert sst.isel(time=slice(0, 24), lat=slice(0, 5)).isnull().all()
+    assert sst.isel(lat=slice(5, None)).notnull().all()
+    assert sst.isel(time=slice(24, None), lat=slice(3, None)).notnull().all()